@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+# 訓練済みpipeline(pickle)を，読み込みが速くworker process間でメモリを共有できる形式(compact model)で保存・読み込みする
+# pickleの大部分は NgramCountVectorizer の n-gram語彙(dict) と MultinomialNB の feature_log_prob_ であり，
+# 読み込み時にpython objectとして復元するため時間がかかり，workerごとにheap上へ複製される.
+# compact modelでは語彙をn-gramのhash値で整列した配列と文字列table, NBのparameterをnumpy配列として保存し，
+# 読み込み時は読み取り専用でmemory mapする (page cacheを全workerで共有する). 分類結果はpickleのpipelineと同一.
+#
+# compact model (directory):
+#   meta.json                          : format version, pipelineの構成, parameter, 特徴量抽出器の状態のうちdict以外の値
+#   <name>.vocab_hashes.npy            : n-gramのhash値(uint64, 昇順)
+#   <name>.vocab_feature_idx.npy       : hash値の並びに対応する特徴量の列番号(int64)
+#   <name>.vocab_offsets.npy           : 文字列tableでの各n-gramの開始位置(uint64, 個数+1)
+#   <name>.vocab_strings.bin           : hash値の並びでn-gram(utf-8)を連結した文字列table. hash値の一致を文字列で確認する
+#   <name>.<attr>.keys_offsets.npy     : 特徴量抽出器の辞書(キーワード, 人名辞書)の見出しの文字列table (dictの順)
+#   <name>.<attr>.keys_strings.bin
+#   <name>.<attr>.values_offsets.npy   : 見出しに対応する値(辞書名, 読み)の文字列table
+#   <name>.<attr>.values_strings.bin
+#   classifier.feature_log_prob.npy    : MultinomialNB.feature_log_prob_
+#   classifier.class_log_prior.npy     : MultinomialNB.class_log_prior_
+#   classifier.classes.npy             : MultinomialNB.classes_
+#   (<name> は FeatureUnion内の特徴量抽出器の名前. NgramHashingVectorizer は語彙を持たないためparameterのみmeta.jsonに保存する)
+
+# python compact_model.py --pickle_path /app/src/PPI_classifier/models/NB_pipeline_202503.pkl --output_dir /app/src/PPI_classifier/models/NB_pipeline_202503
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import sys
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+from sklearn.pipeline import Pipeline, FeatureUnion
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.feature_extraction.text import CountVectorizer
+
+### PROJ
+PROJ_PATH = str(Path(__file__).resolve().parents[2])
+sys.path.append(PROJ_PATH)
+from src.PPI_classifier.extract_keyword_features_controller import KeywordFeaturesExtractor, FullnameFeaturesExtractor, SentenceContainTargetAndWord
+from src.PPI_classifier.extract_features_controller import NgramCountVectorizer, NgramHashingVectorizer, TokenizedText
+from src.mecab.MeCabClass import MeCabClass
+from src.PPI_classifier.linear_scorer import transform_features
+
+COMPACT_MODEL_VERSION = 2      # 2: 特徴量抽出器の辞書をmeta.jsonから文字列tableに移動
+META_FILENAME = 'meta.json'
+# 学習不要な特徴量抽出器. 状態のうち辞書(キーワード, 人名辞書)は文字列table, それ以外はmeta.jsonに保存する
+STATE_TRANSFORMER_CLASSES = {cls.__name__: cls for cls in [KeywordFeaturesExtractor, FullnameFeaturesExtractor, SentenceContainTargetAndWord]}
+
+
+def hash_ngram(encoded_ngram: bytes) -> bytes:
+    """n-gram(utf-8)の64bit hash値 (little endian 8byte). process, 実行環境によらず同じ値となるblake2bを用いる"""
+    return hashlib.blake2b(encoded_ngram, digest_size=8).digest()
+
+
+def _save_string_table(prefix: str, encoded: list):
+    """文字列(utf-8)のlistを 開始位置の配列(prefix_offsets.npy, 個数+1) + 連結した文字列(prefix_strings.bin) として保存する"""
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum(np.array([len(b) for b in encoded], dtype=np.uint64), out=offsets[1:])
+    np.save(prefix + '_offsets.npy', offsets)
+    with open(prefix + '_strings.bin', 'wb') as f:
+        f.write(b''.join(encoded))
+
+def _load_string_table(prefix: str) -> tuple:
+    """_save_string_tableで保存した文字列tableを読み取り専用でmemory mapする
+    Returns:
+        offsets: numpy.memmap
+        strings: mmap.mmap (空の場合はb'')
+    """
+    offsets = np.load(prefix + '_offsets.npy', mmap_mode='r')
+    with open(prefix + '_strings.bin', 'rb') as f:
+        # 空fileはmmapできない
+        strings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+    return offsets, strings
+
+
+class MappedVocabulary(object):
+    def __init__(self, model_dir: str, name: str) -> None:
+        """compact modelのn-gram語彙. 配列と文字列tableを読み取り専用でmemory mapする"""
+        prefix = os.path.join(model_dir, name)
+        self.hashes = np.load(prefix + '.vocab_hashes.npy', mmap_mode='r')
+        self.feature_idx = np.load(prefix + '.vocab_feature_idx.npy', mmap_mode='r')
+        self.offsets, self.strings = _load_string_table(prefix + '.vocab')
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def get_indices(self, ngrams: list) -> list:
+        """n-gram -> 特徴量の列番号 (語彙に無いn-gramはNone). hash値の一致したn-gramは文字列tableで一致を確認する"""
+        unique_ngrams = list(dict.fromkeys(ngrams))
+        if len(unique_ngrams) == 0 or len(self.hashes) == 0:
+            return [None] * len(ngrams)
+        encoded = [ngram.encode('utf-8') for ngram in unique_ngrams]
+        query = np.frombuffer(b''.join([hash_ngram(b) for b in encoded]), dtype='<u8')
+        positions = np.minimum(np.searchsorted(self.hashes, query), len(self.hashes) - 1)
+        found = np.nonzero(self.hashes[positions] == query)[0]
+
+        ngram2idx = {}
+        found_positions = positions[found]
+        for i, start, end, feature_idx in zip(found.tolist(), self.offsets[found_positions].tolist(),
+                                              self.offsets[found_positions + 1].tolist(), self.feature_idx[found_positions].tolist()):
+            if self.strings[start:end] == encoded[i]:
+                ngram2idx[unique_ngrams[i]] = feature_idx
+        return [ngram2idx.get(ngram) for ngram in ngrams]
+
+
+class MappedStringDict(Mapping):
+    def __init__(self, model_dir: str, name: str) -> None:
+        """compact modelの特徴量抽出器の辞書 (str -> str, 読み取り専用). 見出しと値の文字列tableをmemory mapする
+        特徴量抽出器は keys() の走査(automatonの作成)と len() のみを用いるため，dictとしてheapに展開しない.
+        keys()の順は保存元のdictと同一. [key] による参照は初回に見出し -> 位置の索引を作成する
+        Args:
+            name: <特徴量抽出器の名前>.<属性名>
+        """
+        self.model_dir = model_dir
+        self.name = name
+        prefix = os.path.join(model_dir, name)
+        self._key_offsets, self._key_strings = _load_string_table(prefix + '.keys')
+        self._value_offsets, self._value_strings = _load_string_table(prefix + '.values')
+        self._key2idx = None
+
+    @staticmethod
+    def _iter_strings(offsets, strings):
+        offsets = offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield strings[start:end].decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self._key_offsets) - 1
+
+    def __iter__(self):
+        return self._iter_strings(self._key_offsets, self._key_strings)
+
+    def __getitem__(self, key):
+        if self._key2idx is None:
+            self._key2idx = {k: i for i, k in enumerate(self)}
+        idx = self._key2idx[key]
+        start, end = int(self._value_offsets[idx]), int(self._value_offsets[idx + 1])
+        return self._value_strings[start:end].decode('utf-8')
+
+    def __getstate__(self):
+        """memory mapはpickleできないため，model_dirから開き直す"""
+        return {'model_dir': self.model_dir, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['model_dir'], state['name'])
+
+
+class MappedNgramCountVectorizer(NgramCountVectorizer):
+    def __init__(self, model_dir: str, name: str, vectorizer_params: dict) -> None:
+        """compact modelの語彙を用いるNgramCountVectorizer. 出力はNgramCountVectorizer.transform()と同一
+        Args:
+            vectorizer_params: CountVectorizerのparameter (n-gramの作成方法. 語彙はMappedVocabulary)
+        """
+        self.MeCabCtr = MeCabClass()
+        self.model_dir = model_dir
+        self.name = name
+        self.vectorizer_params = vectorizer_params
+        self.vectorizer = CountVectorizer(**dict(vectorizer_params, dtype=np.dtype(vectorizer_params['dtype']).type))
+        self.vocabulary = MappedVocabulary(model_dir, name)
+
+    def fit(self, X, y=None):
+        raise TypeError("a compact model cannot be refit: fit a pipeline with NgramCountVectorizer and export it with export_compact_model()")
+
+    def get_n_features(self) -> int:
+        return len(self.vocabulary)
+
+    def get_feature_indices(self, ngrams: list) -> list:
+        return self.vocabulary.get_indices(ngrams)
+
+    def transform(self, X):
+        """分かち書き結果からn-gramを作成して語彙を引く (" ".join(tokens)をCountVectorizerで変換した場合と同一)"""
+        if len(X) > 0 and all(isinstance(text, TokenizedText) for text in X):
+            return self.transform_tokens([text.tokens for text in X])
+        return self.transform_tokens([self.MeCabCtr.get_wakati_by_parseNode(text) for text in X])
+
+    def __getstate__(self):
+        """memory mapはpickleできないため，model_dirから開き直す"""
+        return {'model_dir': self.model_dir, 'name': self.name, 'vectorizer_params': self.vectorizer_params}
+
+    def __setstate__(self, state):
+        self.__init__(state['model_dir'], state['name'], state['vectorizer_params'])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# export
+
+def _get_jsonable_params(estimator, exclude=()) -> dict:
+    params = {k: v for k, v in estimator.get_params(deep=False).items() if k not in exclude}
+    try:
+        json.dumps(params)
+    except TypeError as e:
+        raise ValueError(f"{type(estimator).__name__} has parameters that cannot be exported: {params}") from e
+    return params
+
+def _export_vocabulary(output_dir: str, name: str, vocabulary: dict):
+    """n-gram語彙を hash値の昇順の配列 + 文字列table で保存する"""
+    terms = list(vocabulary.keys())
+    encoded = [term.encode('utf-8') for term in terms]
+    hashes = np.frombuffer(b''.join([hash_ngram(b) for b in encoded]), dtype='<u8') if len(terms) > 0 else np.zeros(0, dtype='<u8')
+    order = np.argsort(hashes, kind='stable')
+    sorted_hashes = hashes[order]
+    if len(sorted_hashes) > 1 and np.any(sorted_hashes[1:] == sorted_hashes[:-1]):
+        raise ValueError(f"{name}: hash collision in the vocabulary")
+
+    prefix = os.path.join(output_dir, name)
+    np.save(prefix + '.vocab_hashes.npy', sorted_hashes)
+    np.save(prefix + '.vocab_feature_idx.npy', np.array([vocabulary[terms[i]] for i in order], dtype=np.int64))
+    _save_string_table(prefix + '.vocab', [encoded[i] for i in order])
+
+def _export_transformer_state(output_dir: str, name: str, transformer) -> tuple:
+    """学習不要な特徴量抽出器の状態を保存する. dict(キーワード, 人名辞書)は見出しと値の文字列table, それ以外はmeta.jsonに保存する
+    Returns:
+        state: meta.jsonに保存する状態 (dict以外)
+        mapped_state: 文字列tableとして保存した属性名のlist (MappedStringDictで読み込む)
+    """
+    state, mapped_state = {}, []
+    for key, value in transformer.__getstate__().items():
+        if not isinstance(value, dict):
+            state[key] = value
+            continue
+        if not all(isinstance(k, str) and isinstance(v, str) for k, v in value.items()):
+            raise ValueError(f"{name}.{key}: only dict(str -> str) can be exported")
+        prefix = os.path.join(output_dir, f'{name}.{key}')
+        _save_string_table(prefix + '.keys', [k.encode('utf-8') for k in value.keys()])
+        _save_string_table(prefix + '.values', [v.encode('utf-8') for v in value.values()])
+        mapped_state.append(key)
+    return state, mapped_state
+
+def export_compact_model(pipeline, output_dir: str):
+    """訓練済みpipeline(get_NB_classifier_pipelineの構成)をcompact modelとして保存する
+    Args:
+        pipeline: Pipeline([('features', FeatureUnion([...])), ('classifier', MultinomialNB())])
+    """
+    steps = pipeline.steps
+    if len(steps) != 2 or not isinstance(steps[0][1], FeatureUnion) or not isinstance(steps[1][1], MultinomialNB):
+        raise ValueError(f"unsupported pipeline: expected [FeatureUnion, MultinomialNB], got {[type(step).__name__ for _, step in steps]}")
+    (features_name, feature_union), (classifier_name, classifier) = steps
+    os.makedirs(output_dir, exist_ok=True)
+
+    transformers = []
+    for name, transformer in feature_union.transformer_list:
+        if type(transformer) is NgramCountVectorizer:
+            vectorizer_params = _get_jsonable_params(transformer.vectorizer, exclude=['dtype'])
+            vectorizer_params['dtype'] = np.dtype(transformer.vectorizer.dtype).name
+            _export_vocabulary(output_dir, name, transformer.vectorizer.vocabulary_)
+            transformers.append({'name': name, 'class': 'NgramCountVectorizer', 'vectorizer_params': vectorizer_params})
+        elif type(transformer) is NgramHashingVectorizer:
+            transformers.append({'name': name, 'class': 'NgramHashingVectorizer',
+                                 'params': {'ngram_range': list(transformer.ngram_range), 'n_features': transformer.n_features}})
+        elif type(transformer).__name__ in STATE_TRANSFORMER_CLASSES and type(transformer) is STATE_TRANSFORMER_CLASSES[type(transformer).__name__]:
+            state, mapped_state = _export_transformer_state(output_dir, name, transformer)
+            transformers.append({'name': name, 'class': type(transformer).__name__, 'state': state, 'mapped_state': mapped_state})
+        else:
+            raise ValueError(f"unsupported transformer: {name}={type(transformer).__name__}")
+
+    np.save(os.path.join(output_dir, 'classifier.feature_log_prob.npy'), np.ascontiguousarray(classifier.feature_log_prob_))
+    np.save(os.path.join(output_dir, 'classifier.class_log_prior.npy'), classifier.class_log_prior_)
+    np.save(os.path.join(output_dir, 'classifier.classes.npy'), classifier.classes_, allow_pickle=False)
+    meta = {
+        'version': COMPACT_MODEL_VERSION,
+        'features': {'name': features_name, 'params': _get_jsonable_params(feature_union, exclude=['transformer_list']),
+                     'transformers': transformers},
+        'classifier': {'name': classifier_name, 'params': _get_jsonable_params(classifier), 'n_features_in': int(classifier.n_features_in_)},
+    }
+    with open(os.path.join(output_dir, META_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    print(f'exported compact model -> {output_dir}')
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# load
+
+def is_compact_model(model_path: str) -> bool:
+    return os.path.isfile(os.path.join(model_path, META_FILENAME))
+
+def load_compact_model(model_dir: str) -> Pipeline:
+    """compact modelからpipelineを作成する. 配列は読み取り専用でmemory mapする
+    Returns:
+        `Pipeline`: 保存元のpipelineと同じ構成 (NgramCountVectorizer -> MappedNgramCountVectorizer). predictの結果は保存元と同一
+    """
+    with open(os.path.join(model_dir, META_FILENAME), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != COMPACT_MODEL_VERSION:
+        raise ValueError(f"unsupported compact model version: {meta.get('version')} (expected {COMPACT_MODEL_VERSION})")
+
+    transformer_list = []
+    for transformer_info in meta['features']['transformers']:
+        if transformer_info['class'] == 'NgramCountVectorizer':
+            transformer = MappedNgramCountVectorizer(model_dir, transformer_info['name'], transformer_info['vectorizer_params'])
+        elif transformer_info['class'] == 'NgramHashingVectorizer':
+            params = transformer_info['params']
+            transformer = NgramHashingVectorizer(ngram_range=tuple(params['ngram_range']), n_features=params['n_features'])
+        else:
+            cls = STATE_TRANSFORMER_CLASSES[transformer_info['class']]
+            state = dict(transformer_info['state'])
+            for key in transformer_info['mapped_state']:
+                state[key] = MappedStringDict(model_dir, f"{transformer_info['name']}.{key}")
+            transformer = cls.__new__(cls)  # pickleの復元と同様に，辞書fileを読み込まず状態を設定する
+            transformer.__setstate__(state)
+        transformer_list.append((transformer_info['name'], transformer))
+    feature_union = FeatureUnion(transformer_list, **meta['features']['params'])
+
+    classifier = MultinomialNB(**meta['classifier']['params'])
+    classifier.feature_log_prob_ = np.load(os.path.join(model_dir, 'classifier.feature_log_prob.npy'), mmap_mode='r')
+    classifier.class_log_prior_ = np.load(os.path.join(model_dir, 'classifier.class_log_prior.npy'))
+    classifier.classes_ = np.load(os.path.join(model_dir, 'classifier.classes.npy'))
+    classifier.n_features_in_ = meta['classifier']['n_features_in']
+    return Pipeline([(meta['features']['name'], feature_union), (meta['classifier']['name'], classifier)])
+
+
+### test
+def test_compact_model(pickle_path: str, model_dir: str, texts: list):
+    """compact modelの特徴量と分類結果(predict, predict_proba)がpickleのpipelineと同一か. 読み込み時間とRSSの増分を比較する"""
+    import resource
+    def load_with_usage(load_func):
+        s_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        s_time = time.perf_counter()
+        pipeline = load_func()
+        elapsed_time = time.perf_counter() - s_time
+        return pipeline, elapsed_time, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - s_rss) / 1024
+
+    # 先に読み込んだ方のmax RSSの増分が大きく出るため，compact modelを先に読み込む
+    compact_pipeline, compact_time, compact_rss = load_with_usage(lambda: load_compact_model(model_dir))
+    with open(pickle_path, 'rb') as f:
+        pickled_pipeline, pickle_time, pickle_rss = load_with_usage(lambda: pickle.load(f))
+    print(f'load pickle: {pickle_time:.3f} sec, +{pickle_rss:.1f} MB (max RSS)')
+    print(f'load compact: {compact_time:.3f} sec, +{compact_rss:.1f} MB (max RSS)')
+
+    X = transform_features(pickled_pipeline, texts)
+    X_compact = transform_features(compact_pipeline, texts)
+    assert X.shape == X_compact.shape and (X != X_compact).nnz == 0
+    mecab = MeCabClass()
+    tokenized_texts = [TokenizedText(text, mecab.get_wakati_by_parseNode(text)) for text in texts]
+    assert (X != transform_features(compact_pipeline, tokenized_texts)).nnz == 0
+    assert list(pickled_pipeline.predict(texts)) == list(compact_pipeline.predict(texts))
+    assert np.array_equal(pickled_pipeline.predict_proba(texts), compact_pipeline.predict_proba(texts))
+    assert pickle.loads(pickle.dumps(compact_pipeline)).predict(texts).tolist() == compact_pipeline.predict(texts).tolist()
+    print(f'OK: {len(texts)} texts')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a trained pipeline (pickle) to the compact, memory-mappable model format.')
+    parser.add_argument('--pickle_path', type=str,
+                        help='Trained pipeline (pickle)', required=True)
+    parser.add_argument('--output_dir', type=str,
+                        help='Output directory of the compact model', required=True)
+    args = parser.parse_args()
+
+    with open(args.pickle_path, 'rb') as f:
+        trained_pipeline = pickle.load(f)
+    export_compact_model(trained_pipeline, args.output_dir)
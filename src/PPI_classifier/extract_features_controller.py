@@ -8,7 +8,9 @@ import os
 from pathlib import Path
 from collections import Counter
 
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer, HashingVectorizer
 from sklearn.pipeline import FeatureUnion, Pipeline
 from sklearn.base import BaseEstimator, TransformerMixin
 
@@ -142,6 +144,16 @@ class MeCabFullnameDetector(BaseEstimator, TransformerMixin):
         return [[self.get_fullname_count(text)] for text in X]
 
 # --------------------------------------------------------------------------------
+class TokenizedText(str):
+    """MeCabの分かち書き結果(tokens)を保持する文字列
+    str として扱えるため他の特徴量抽出器にはそのまま渡り，NgramCountVectorizer は再度MeCabで解析せずに tokens を利用する
+    """
+    def __new__(cls, text: str, tokens: list):
+        obj = super().__new__(cls, text)
+        obj.tokens = tokens
+        return obj
+
+
 class NgramCountVectorizer(BaseEstimator, TransformerMixin):
     def __init__(self, ngram_range=(1, 2)):
         self.MeCabCtr = MeCabClass()
@@ -158,8 +170,64 @@ class NgramCountVectorizer(BaseEstimator, TransformerMixin):
     
     def transform(self, X):
         """fit()で得た情報で文章をtf-idf変換"""
+        if len(X) > 0 and all(isinstance(text, TokenizedText) for text in X):
+            # 分かち書き済み: MeCab解析, " ".join, token_patternによる再分割を行わない
+            return self.transform_tokens([text.tokens for text in X])
         tokenized_texts = [" ".join(self.MeCabCtr.get_wakati_by_parseNode(text)) for text in X]
         return self.vectorizer.transform(tokenized_texts)
+
+    def _analyze_tokens(self, tokens: list) -> list:
+        """分かち書き済みtokenのlistからn-gramを作成する
+        vectorizerのanalyzer(preprocess -> token_pattern -> n-gram)を " ".join(tokens) に適用した結果と同一.
+        MeCabの表層形は空白を含まないため，preprocessとtoken_patternの適用はtokenごとに行ってよい
+        """
+        preprocess = self.vectorizer.build_preprocessor()
+        tokenize = self.vectorizer.build_tokenizer()
+        is_default_pattern = self.vectorizer.token_pattern == r"(?u)\b\w+\b"
+        words = []
+        for token in tokens:
+            token = preprocess(token)
+            if is_default_pattern and token.isalnum():
+                # \w の定義は str.isalnum() + "_" であり，全文字が\wのtokenはそのまま1単語
+                words.append(token)
+            else:
+                words.extend(tokenize(token))
+        return self.vectorizer._word_ngrams(words, self.vectorizer.get_stop_words())
+
+    def get_n_features(self) -> int:
+        return len(self.vectorizer.vocabulary_)
+
+    def get_feature_indices(self, ngrams: list) -> list:
+        """n-gram -> 特徴量の列番号 (語彙に無いn-gramはNone)"""
+        vocabulary = self.vectorizer.vocabulary_
+        return [vocabulary.get(ngram) for ngram in ngrams]
+
+    def transform_tokens(self, token_lists: list):
+        """分かち書き済みtokenのlistを入力とするtransform. 出力はtransform()と同一のcsr_matrix
+        語彙の参照(get_feature_indices)はbatch内の全文書のn-gramをまとめて1回で行う
+        """
+        ngram_lists = [self._analyze_tokens(tokens) for tokens in token_lists]
+        batch_feature_indices = self.get_feature_indices([ngram for ngrams in ngram_lists for ngram in ngrams])
+        j_indices = []
+        values = []
+        indptr = [0]
+        start = 0
+        for ngrams in ngram_lists:
+            feature_counter = {}
+            for feature_idx in batch_feature_indices[start:start + len(ngrams)]:
+                if feature_idx is not None:
+                    feature_counter[feature_idx] = feature_counter.get(feature_idx, 0) + 1
+            start += len(ngrams)
+            j_indices.extend(feature_counter.keys())
+            values.extend(feature_counter.values())
+            indptr.append(len(j_indices))
+
+        X = sp.csr_matrix((np.asarray(values, dtype=np.intc), np.asarray(j_indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+                          shape=(len(token_lists), self.get_n_features()), dtype=self.vectorizer.dtype)
+        X.sort_indices()
+        if self.vectorizer.binary:
+            X.data.fill(1)
+        return X
     
     def __getstate__(self):
         """pipeline保存時にjoblib, Pickle を利用．MeCabのタガーなどを含めて保存できないため, Picle保存時にMeCabCtrを削除"""
@@ -172,6 +240,34 @@ class NgramCountVectorizer(BaseEstimator, TransformerMixin):
         self.__dict__.update(state)
         self.MeCabCtr =  MeCabClass()  # 復元時に再作成
 
+# --------------------------------------------------------------------------------
+class NgramHashingVectorizer(NgramCountVectorizer):
+    def __init__(self, ngram_range=(1, 2), n_features=2**20):
+        """NgramCountVectorizer の語彙(dict)の代わりに，n-gramのhash値(murmurhash3)を特徴量の列番号とする (hashing trick)
+        - 語彙を持たないため，modelの大きさ, 読み込み時間, workerごとのメモリが訓練データの量によらず一定 (n_features)
+        - 異なるn-gramが同じ列に割り当てられる場合がある (n_featuresが大きいほど少ない)
+        - MultinomialNBの入力のため，符号の反転(alternate_sign)と正規化(norm)は行わず出現回数を特徴量とする
+        """
+        self.MeCabCtr = MeCabClass()
+        self.ngram_range = ngram_range
+        self.n_features = n_features
+        self.vectorizer = HashingVectorizer(ngram_range=ngram_range, token_pattern=r"(?u)\b\w+\b", n_features=n_features,
+                                            alternate_sign=False, norm=None)
+
+    def fit(self, X, y=None):
+        """語彙の獲得は不要 (HashingVectorizerは状態を持たない) としてselfを返す"""
+        return self
+
+    def get_n_features(self) -> int:
+        return self.n_features
+
+    def transform_tokens(self, token_lists: list):
+        """分かち書き済みtokenのlistを入力とするtransform. 出力は " ".join(tokens) をHashingVectorizerで変換した場合と同一"""
+        X = self.vectorizer._get_hasher().transform(self._analyze_tokens(tokens) for tokens in token_lists)
+        if self.vectorizer.binary:
+            X.data.fill(1)
+        return X
+
 # --------------------------------------------------------------------------------
 class NgramTfidfVectorizer(BaseEstimator, TransformerMixin):
     def __init__(self, ngram_range=(1, 2)):
@@ -259,6 +355,19 @@ def union_features():
                "うわぁマジかよ…隣に住んでる中村さんが統合失調症で通院してるって知って衝撃なんだけど。いつもニコニコしてて優しい人なのに。最近様子がおかしかったと思ったら、薬の副作用で体調崩してたらしい。家族も大変そう。orz でも頑張って治療続けてるみたい。リモートワークに切り替えたのもそのせいだったのね。誰にも言えない秘密だけど、応援したい(｀・ω・´)ﾉ"]
     prepared = pipeline.fit_transform(samples)
     print(prepared)
+def test_ngram_tokenized_text(trained_pipeline, texts: list):
+    """TokenizedText(分かち書き済み)を入力した場合に，n-gram特徴量と分類結果が通常の入力と同一になるか (NgramCountVectorizer, NgramHashingVectorizer)"""
+    mecab = MeCabClass()
+    tokenized_texts = [TokenizedText(text, mecab.get_wakati_by_parseNode(text)) for text in texts]
+    ngram_vectorizer = [transformer for _, transformer in trained_pipeline.named_steps['features'].transformer_list
+                        if isinstance(transformer, NgramCountVectorizer)][0]
+    X = ngram_vectorizer.transform(texts)
+    X_tokenized = ngram_vectorizer.transform(tokenized_texts)
+    assert (X != X_tokenized).nnz == 0
+    assert list(trained_pipeline.predict(texts)) == list(trained_pipeline.predict(tokenized_texts))
+    print(f'OK: {len(texts)} texts')
+
+
 if __name__ == '__main__':
     
     ### Test
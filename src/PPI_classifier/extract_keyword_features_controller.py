@@ -5,6 +5,8 @@ import os
 from pathlib import Path
 from collections import Counter
 import re
+import time
+from bisect import bisect_right
 from sklearn.pipeline import FeatureUnion, Pipeline
 from sklearn.base import BaseEstimator, TransformerMixin
 
@@ -14,6 +16,8 @@ SRC_PATH = str(Path(__file__).resolve().parents[1])
 # print(SRC_PATH)
 sys.path.append(SRC_PATH)
 
+from PPI_classifier.keyword_automaton import KeywordAutomaton
+
 class KeywordFeaturesExtractor(BaseEstimator, TransformerMixin):
     def __init__(self, keyword_list_file_paths: list, exist_flag=False) -> None:
         self.exist_flag = exist_flag    # True-> 出現していれば1, そうでなければ0 , False -> 出現頻度
@@ -37,20 +41,22 @@ class KeywordFeaturesExtractor(BaseEstimator, TransformerMixin):
 
         return keywordDB
     
+    def get_keyword_automaton(self):
+        """NGkeywordDBの全keywordを1回のtext走査で数えるautomaton. 初回呼び出し時に作成する (学習済みpickleには保存しない)"""
+        automaton = self.__dict__.get('_NGkeyword_automaton')
+        if automaton is None:
+            automaton = KeywordAutomaton(list(self.NGkeywordDB.keys()))
+            self._NGkeyword_automaton = automaton
+        return automaton
+
     def extract_ng_keywords(self, text):
-        keyword_count_list = []
-        for word in self.NGkeywordDB.keys():
-            if self.exist_flag is False:
-                # 出現頻度
-                keyword_count_list.append(text.count(word))
-            else:
-                # 出現していれば1, そうでなければ0
-                if word in text:
-                    keyword_count_list.append(1)
-                else:
-                    keyword_count_list.append(0)
-            
-        return keyword_count_list
+        """NGkeywordDBの並びで各keywordの特徴量を返す. textの走査は1回のみ (text.count(word) をkeywordごとに呼び出した場合と同一)"""
+        keyword_count_list = self.get_keyword_automaton().count(text)
+        if self.exist_flag is False:
+            # 出現頻度
+            return keyword_count_list
+        # 出現していれば1, そうでなければ0
+        return [1 if count > 0 else 0 for count in keyword_count_list]
     
     def fit(self, X, y=None):
         """学習は不要としてselfを返す"""    
@@ -58,6 +64,12 @@ class KeywordFeaturesExtractor(BaseEstimator, TransformerMixin):
     
     def transform(self, X):
         return [self.extract_ng_keywords(text) for text in X]
+
+    def __getstate__(self):
+        """pipeline保存時にautomatonは保存しない (読み込み後の初回利用時に再作成)"""
+        state = dict(super().__getstate__())    # BaseEstimator.__getstate__ は self.__dict__ そのものを返すため，copyしてから除く
+        state.pop('_NGkeyword_automaton', None)
+        return state
     
 
 class FullnameFeaturesExtractor(BaseEstimator, TransformerMixin):
@@ -83,8 +95,24 @@ class FullnameFeaturesExtractor(BaseEstimator, TransformerMixin):
                     firstname_dict[word] = furigana
         return lastname_dic, firstname_dict
     
+    def get_name_automata(self):
+        """姓, 名それぞれの全見出しを1回のtext走査で数えるautomaton. 初回呼び出し時に作成する (学習済みpickleには保存しない)"""
+        automata = self.__dict__.get('_name_automata')
+        if automata is None:
+            automata = (KeywordAutomaton(list(self.lastname_dic.keys())), KeywordAutomaton(list(self.firstname_dict.keys())))
+            self._name_automata = automata
+        return automata
+
     def count_first_and_last(self, text):
+        """ 姓, 名の見出しごとの text.count(w) の合計. 姓, 名それぞれtextの走査は1回のみ
+        Returns:
+            list: [count_lastname, count_firstname]
         """
+        lastname_automaton, firstname_automaton = self.get_name_automata()
+        return [lastname_automaton.total_count(text), firstname_automaton.total_count(text)]
+
+    def count_first_and_last_by_loop(self, text):
+        """ count_first_and_last の見出しごとにtext.countを呼び出す実装 (benchmark比較用)
         Returns:
             list: [count_lastname, count_firstname]
         """
@@ -102,6 +130,12 @@ class FullnameFeaturesExtractor(BaseEstimator, TransformerMixin):
     def transform(self, X):
         return [self.count_first_and_last(text) for text in X]
 
+    def __getstate__(self):
+        """pipeline保存時にautomatonは保存しない (読み込み後の初回利用時に再作成)"""
+        state = dict(super().__getstate__())    # BaseEstimator.__getstate__ は self.__dict__ そのものを返すため，copyしてから除く
+        state.pop('_name_automata', None)
+        return state
+
 class SentenceContainTargetAndWord(BaseEstimator, TransformerMixin):
     def __init__(self, keyword_list_file_paths:list) -> None:
         """ TODO 
@@ -190,14 +224,92 @@ class SentenceContainTargetAndWord(BaseEstimator, TransformerMixin):
                 if is_contain_ng is True:
                     first_or_last__NG_count += 1
         return first_or_last__NG_count, len(split_text)
-    
+
+    # count_match_sentence: 文ごとに含まれる語の種類 (bit mask)
+    LASTNAME_FLAG = 1
+    FIRSTNAME_FLAG = 2
+    NG_WORD_FLAG = 4
+
+    def get_sentence_automaton(self):
+        """ 姓, 名, NG wordをまとめたautomatonと keyword id -> 種類(bit mask) の対応. 初回呼び出し時に作成する (学習済みpickleには保存しない)
+        Returns:
+            KeywordAutomaton: 姓, 名, NG wordの全見出し ('' を含む場合はautomaton外で扱う)
+            list: keyword id -> bit mask
+            int: '' が含まれる種類のbit mask ('' はどの文にも含まれる)
+        """
+        sentence_automaton = self.__dict__.get('_sentence_automaton')
+        if sentence_automaton is None:
+            keyword2flags = {}
+            for words, flag in [(self.lastname_dic.keys(), self.LASTNAME_FLAG),
+                                (self.firstname_dict.keys(), self.FIRSTNAME_FLAG),
+                                (self.NGkeywordDB.keys(), self.NG_WORD_FLAG)]:
+                for w in words:
+                    keyword2flags[w] = keyword2flags.get(w, 0) | flag
+            empty_flags = keyword2flags.pop('', 0)
+            automaton = KeywordAutomaton(list(keyword2flags.keys()))
+            sentence_automaton = (automaton, list(keyword2flags.values()), empty_flags)
+            self._sentence_automaton = sentence_automaton
+        return sentence_automaton
+
+    def split_sentence_spans(self, text):
+        """ count_match_sentence_by_loop の文分割 (re.split -> 空の要素を削除 -> strip) と同じ文を text 上の位置 [start, end) で返す
+        Returns:
+            list: [(start, end), ...]  text[start:end] == 各文.strip()
+        """
+        spans = []
+        piece_start = 0
+        for m in re.finditer(r"[。!?]\n?", text):
+            self._append_stripped_span(text, piece_start, m.start(), spans)
+            piece_start = m.end()
+        self._append_stripped_span(text, piece_start, len(text), spans)
+        return spans
+
+    def _append_stripped_span(self, text, start, end, spans):
+        if start >= end:
+            return  # 空の要素は文に含めない
+        piece = text[start:end]
+        stripped_start = start + len(piece) - len(piece.lstrip())
+        if stripped_start == end:
+            spans.append((start, start))    # 空白のみの要素は空文字の文として数える
+            return
+        spans.append((stripped_start, end - (len(piece) - len(piece.rstrip()))))
+
     def count_match_sentence(self, text):
         """ 1記事中のtextを句点でくぎり，各文に対して，target(人名を表す) and NG wordが含まれいている文の数をカウント
+        textを1回だけ走査して姓, 名, NG wordの出現位置を求め，出現位置から各文に含まれる語の種類を求める (計算量は辞書サイズに依存しない)
         Returns:
             int:first_or_last__NG_count: (姓or名) and NG_word が含まれいている文の数
             int: first_and_last__NG_count: (姓and名) and NG_word が含まれいている文の数   ここでの姓or名は姓，名が含んでいることを意図し，連続で並んでいることは考慮しない
             int: len(split_text): 分割した文の数 (改行,空文字のみの文は除外)
         """
+        automaton, keyword_flags, empty_flags = self.get_sentence_automaton()
+        spans = self.split_sentence_spans(text)
+        span_starts = [start for start, _ in spans]
+        sentence_flags = [empty_flags] * len(spans)
+        for start, end, keyword_id in automaton.iter_matches(text):
+            idx = bisect_right(span_starts, start) - 1
+            if idx >= 0 and end <= spans[idx][1]:   # 文の中に収まる出現のみ
+                sentence_flags[idx] |= keyword_flags[keyword_id]
+
+        last_or_first = self.LASTNAME_FLAG | self.FIRSTNAME_FLAG
+        last_and_first_ng = self.LASTNAME_FLAG | self.FIRSTNAME_FLAG | self.NG_WORD_FLAG
+        first_or_last__NG_count = 0
+        first_and_last__NG_count = 0
+        for flags in sentence_flags:
+            if flags & last_or_first and flags & self.NG_WORD_FLAG:
+                first_or_last__NG_count += 1
+                if flags & last_and_first_ng == last_and_first_ng:
+                    first_and_last__NG_count += 1
+
+        return first_or_last__NG_count, first_and_last__NG_count, len(spans)
+
+    def count_match_sentence_by_loop(self, text):
+        """ count_match_sentence の文ごとに全見出しを in で確認する実装 (比較用)
+        Returns:
+            int:first_or_last__NG_count: (姓or名) and NG_word が含まれいている文の数
+            int: first_and_last__NG_count: (姓and名) and NG_word が含まれいている文の数
+            int: len(split_text): 分割した文の数 (改行,空文字のみの文は除外)
+        """
         split_text = re.split(r"[。!?]\n?", text)
         split_text = [s.strip() for s in split_text if s]   # 空の要素を削除（末尾に記号があると空文字ができるため）
         first_or_last__NG_count = 0
@@ -236,6 +348,12 @@ class SentenceContainTargetAndWord(BaseEstimator, TransformerMixin):
     def transform(self, X):
         return [self.count_match(text) for text in X]
 
+    def __getstate__(self):
+        """pipeline保存時にautomatonは保存しない (読み込み後の初回利用時に再作成)"""
+        state = dict(super().__getstate__())    # BaseEstimator.__getstate__ は self.__dict__ そのものを返すため，copyしてから除く
+        state.pop('_sentence_automaton', None)
+        return state
+
 
 
 def union_features():
@@ -265,6 +383,47 @@ def union_features():
     print(prepared)
     print(" ".join([str(x) for x in prepared[2]]))
 
+def benchmark_count_first_and_last(doc_sizes=(1000, 10000, 100000), n_repeat=3):
+    """ FullnameFeaturesExtractor.count_first_and_last: automaton版と見出しごとのtext.countのloop版を比較
+    """
+    samples = ["この前、友達と行ったライブ会場で、めっちゃ有名なギタリストの佐藤健太さんを見かけたんだけど、なんか、ライブが終わった後に、すごい落ち込んでたんだよね。",
+               "Facebookでちょっとした騒ぎになってた話、あの山田彩音さんが、若い頃に一度結婚してその後離婚したことがあるって知ってた？😲 ",
+               "うわぁマジかよ…隣に住んでる中村さんが統合失調症で通院してるって知って衝撃なんだけど。いつもニコニコしてて優しい人なのに。"]
+    extractor = FullnameFeaturesExtractor()
+    extractor.get_name_automata()   # automatonの作成時間は計測に含めない
+    base_text = "".join(samples)
+    for doc_size in doc_sizes:
+        text = (base_text * (doc_size // len(base_text) + 1))[:doc_size]
+        doc_bytes = len(text.encode('utf-8'))
+
+        s_time = time.time()
+        for _ in range(n_repeat):
+            loop_ret = extractor.count_first_and_last_by_loop(text)
+        loop_time = (time.time() - s_time) / n_repeat
+
+        s_time = time.time()
+        for _ in range(n_repeat):
+            automaton_ret = extractor.count_first_and_last(text)
+        automaton_time = (time.time() - s_time) / n_repeat
+
+        assert loop_ret == automaton_ret
+        print(f"{doc_size} chars ({doc_bytes/1024:.0f}KB): loop {loop_time*1000:.2f} ms, automaton {automaton_time*1000:.2f} ms, x{loop_time/automaton_time:.1f}")
+
+def test_count_match_sentence(keyword_list_file_paths, texts, n_random=2000, seed=0):
+    """ SentenceContainTargetAndWord.count_match_sentence が全見出しをloopで確認する実装と一致するか
+    Args:
+        texts: list(str) 確認に用いる文書. 加えて文書の断片と区切り記号, 空白をランダムに組み合わせた文書でも確認する
+    """
+    import random
+    extractor = SentenceContainTargetAndWord(keyword_list_file_paths)
+    random.seed(seed)
+    fragments = [t[i:i + random.randint(1, 8)] for t in texts for i in range(0, len(t), 5)] + ["。", "!", "?", "\n", " ", "　", "。\n", "\n\n"]
+    random_texts = ["".join(random.choices(fragments, k=random.randint(0, 30))) for _ in range(n_random)]
+    for text in list(texts) + random_texts:
+        assert extractor.count_match_sentence(text) == extractor.count_match_sentence_by_loop(text), text
+    print(f"OK: {len(texts) + n_random} texts")
+
+
 if __name__ == '__main__':
     
     ### Test
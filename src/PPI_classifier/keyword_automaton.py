@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# 複数keywordの出現回数を1回のtext走査で数えるための Aho-Corasick automaton
+# keywordごとに text.count(keyword) を呼び出す場合と同じ結果(重複なしの出現回数)を返す
+
+
+class KeywordAutomaton(object):
+    def __init__(self, keywords: list) -> None:
+        """
+        Args:
+            keywords: list(str) 出力(count)はこの並び順
+        """
+        self.keywords = list(keywords)
+        self.keyword_lengths = [len(w) for w in self.keywords]
+        self.empty_keyword_ids = [i for i, w in enumerate(self.keywords) if len(w) == 0]   # '' は automaton に登録せず別途扱う
+
+        self.goto, self.fail, self.outputs = self._build(self.keywords)
+
+    def _build(self, keywords: list) -> tuple:
+        """trie(goto) を作成し，幅優先で failure link と出力(keyword id)を設定する
+        Returns:
+            goto: list(dict) {文字: 遷移先state}
+            fail: list(int) failure link
+            outputs: list(tuple) stateに到達した時点で末尾が一致するkeyword id (failure link先の出力を含む)
+        """
+        goto = [{}]
+        outputs = [[]]
+        for keyword_id, keyword in enumerate(keywords):
+            if len(keyword) == 0:
+                continue
+            state = 0
+            for ch in keyword:
+                next_state = goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][ch] = next_state
+                    goto.append({})
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(keyword_id)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())     # 深さ1のstateのfailure linkはroot
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, next_state in goto[state].items():
+                fail_state = fail[state]
+                while fail_state != 0 and ch not in goto[fail_state]:
+                    fail_state = fail[fail_state]
+                fail[next_state] = goto[fail_state].get(ch, 0)
+                outputs[next_state] = outputs[next_state] + outputs[fail[next_state]]
+                queue.append(next_state)
+
+        return goto, fail, [tuple(o) for o in outputs]
+
+    def count(self, text: str) -> list:
+        """各keywordの出現回数 ([text.count(w) for w in keywords] と同一)
+        text.count は重複しない出現を左から数えるため，keywordごとに直前に数えた出現の終了位置より後から始まる出現のみを数える
+        Returns:
+            `list`: [int, ...] keywordsの並び順
+        """
+        goto, fail, outputs, keyword_lengths = self.goto, self.fail, self.outputs, self.keyword_lengths
+        counts = [0] * len(self.keywords)
+        next_start = [0] * len(self.keywords)   # keywordごとの次に数えてよい出現の開始位置
+        state = 0
+        for pos, ch in enumerate(text):
+            next_state = goto[state].get(ch)
+            while next_state is None and state != 0:
+                state = fail[state]
+                next_state = goto[state].get(ch)
+            state = next_state if next_state is not None else 0
+
+            matched_ids = outputs[state]
+            if matched_ids:
+                for keyword_id in matched_ids:
+                    if pos - keyword_lengths[keyword_id] + 1 >= next_start[keyword_id]:
+                        counts[keyword_id] += 1
+                        next_start[keyword_id] = pos + 1
+
+        for keyword_id in self.empty_keyword_ids:
+            counts[keyword_id] = len(text) + 1  # ''.count と同様
+        return counts
+
+    def total_count(self, text: str) -> int:
+        """全keywordの出現回数の合計 (sum(text.count(w) for w in keywords) と同一)"""
+        goto, fail, outputs, keyword_lengths = self.goto, self.fail, self.outputs, self.keyword_lengths
+        total = 0
+        next_start = {}     # 出現したkeywordのみ保持
+        state = 0
+        for pos, ch in enumerate(text):
+            next_state = goto[state].get(ch)
+            while next_state is None and state != 0:
+                state = fail[state]
+                next_state = goto[state].get(ch)
+            state = next_state if next_state is not None else 0
+
+            matched_ids = outputs[state]
+            if matched_ids:
+                for keyword_id in matched_ids:
+                    if pos - keyword_lengths[keyword_id] + 1 >= next_start.get(keyword_id, 0):
+                        total += 1
+                        next_start[keyword_id] = pos + 1
+
+        return total + len(self.empty_keyword_ids) * (len(text) + 1)
+
+    def contains_any(self, text: str) -> bool:
+        """いずれかのkeywordがtextに含まれるか (any(w in text for w in keywords) と同一). 最初の出現で走査を終了する"""
+        if len(self.empty_keyword_ids) > 0:
+            return True     # '' はどのtextにも含まれる
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        state = 0
+        for ch in text:
+            next_state = goto[state].get(ch)
+            while next_state is None and state != 0:
+                state = fail[state]
+                next_state = goto[state].get(ch)
+            state = next_state if next_state is not None else 0
+            if outputs[state]:
+                return True
+        return False
+
+    def iter_matches(self, text: str):
+        """重なりを含む全ての出現を返す generator ('' の出現は返さない)
+        Returns:
+            `generator`: (start, end, keyword_id)  text[start:end] == keywords[keyword_id]
+        """
+        goto, fail, outputs, keyword_lengths = self.goto, self.fail, self.outputs, self.keyword_lengths
+        state = 0
+        for pos, ch in enumerate(text):
+            next_state = goto[state].get(ch)
+            while next_state is None and state != 0:
+                state = fail[state]
+                next_state = goto[state].get(ch)
+            state = next_state if next_state is not None else 0
+
+            for keyword_id in outputs[state]:
+                yield pos + 1 - keyword_lengths[keyword_id], pos + 1, keyword_id
+
+
+### test
+def test_count(n_trials=3000, seed=0):
+    """小さい文字種のランダムなkeyword, textで str.count と一致するか"""
+    import random
+    random.seed(seed)
+    for _ in range(n_trials):
+        keywords = list(dict.fromkeys(''.join(random.choices('ab', k=random.randint(0, 4))) for _ in range(random.randint(1, 8))))
+        automaton = KeywordAutomaton(keywords)
+        for _ in range(5):
+            text = ''.join(random.choices('abc', k=random.randint(0, 20)))
+            assert automaton.count(text) == [text.count(w) for w in keywords], (keywords, text)
+            assert automaton.total_count(text) == sum(text.count(w) for w in keywords), (keywords, text)
+            assert automaton.contains_any(text) == any(w in text for w in keywords), (keywords, text)
+            expected = sorted((i, i + len(w), k) for k, w in enumerate(keywords) if w for i in range(len(text)) if text.startswith(w, i))
+            assert sorted(automaton.iter_matches(text)) == expected, (keywords, text)
+    print(f'OK: {n_trials} trials')
+
+
+if __name__ == '__main__':
+    test_count()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# MultinomialNB pipeline の推論を，特徴量抽出器ごとの処理とFeatureUnionを経由せずに行う
+# MultinomialNBの推論は 特徴量(出現回数) と feature_log_prob_ の疎な内積 + class_log_prior_ であるため，
+# 文書ごとに非ゼロの特徴量(列番号, 値)のみを直接求めて疎行列を作成し，内積を計算する.
+# - キーワード(NG word), 姓, 名 の出現回数と文ごとの出現は，全見出しをまとめた1つのautomatonで1回だけtextを走査して求める
+#   (特徴量抽出器ごとでは NG word, 姓, 名, 文ごとの判定 の4回走査し，NG wordは辞書の全見出し分の出現回数のlistを作成していた)
+# - n-gramは NgramCountVectorizer.transform() (語彙 または hash) の疎行列の各行を，FeatureUnionでの列のoffsetをずらして追加する
+# 作成する疎行列は pipeline[:-1].transform() と同一 (値, 列の並び) である.
+# 推論は MultinomialNB を呼び出さず，構築時に取り出した feature_log_prob_.T (W), class_log_prior_ (b) で X @ W + b を計算する (predict, predict_proba の結果はpipelineと同一).
+
+import sys
+from bisect import bisect_right
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import logsumexp
+from sklearn.pipeline import FeatureUnion
+from sklearn.naive_bayes import MultinomialNB
+
+### PROJ
+PROJ_PATH = str(Path(__file__).resolve().parents[2])
+sys.path.append(PROJ_PATH)
+from src.PPI_classifier.keyword_automaton import KeywordAutomaton
+from src.PPI_classifier.extract_keyword_features_controller import KeywordFeaturesExtractor, FullnameFeaturesExtractor, SentenceContainTargetAndWord
+from src.PPI_classifier.extract_features_controller import NgramCountVectorizer
+
+
+class NBLinearScorer(object):
+    def __init__(self, pipeline) -> None:
+        """
+        Args:
+            pipeline: 訓練済み Pipeline([('features', FeatureUnion([...])), ('classifier', MultinomialNB())])
+                FeatureUnionは KeywordFeaturesExtractor, FullnameFeaturesExtractor, SentenceContainTargetAndWord, NgramCountVectorizer(とsubclass) のみ対応
+        """
+        unsupported_reason = self.get_unsupported_reason(pipeline)
+        if unsupported_reason is not None:
+            raise ValueError(f"unsupported pipeline: {unsupported_reason}")
+        feature_union, classifier = pipeline.steps[0][1], pipeline.steps[-1][1]
+
+        # MultinomialNBのjoint log likelihood: X @ W + b
+        self.W = np.array(classifier.feature_log_prob_.T, dtype=np.float64)    # (n_features, n_classes)
+        self.b = np.array(classifier.class_log_prior_, dtype=np.float64)       # (n_classes,)
+        self.classes = np.array(classifier.classes_)
+
+        # 特徴量抽出器ごとの列の範囲 (FeatureUnionの並び順)
+        self.blocks = []    # [(transformer, offset)]
+        offset = 0
+        for _, transformer in feature_union.transformer_list:
+            self.blocks.append((transformer, offset))
+            offset += self._get_n_output_features(transformer)
+        self.n_features = offset
+
+        # 全特徴量抽出器の見出しをまとめたautomaton. 見出しごとに数える対象を保持する
+        keyword2id = {}
+        self.count_columns = []     # keyword id -> [列番号, ...] 見出しごとの出現回数 (KeywordFeaturesExtractor)
+        self.total_columns = []     # keyword id -> [列番号, ...] 出現回数の合計に加える列 (FullnameFeaturesExtractor)
+        self.sentence_flags = []    # keyword id -> [(block番号, bit mask), ...] 文ごとの出現 (SentenceContainTargetAndWord)
+        self.exist_flag_columns = set()
+        def get_keyword_id(keyword):
+            keyword_id = keyword2id.get(keyword)
+            if keyword_id is None:
+                keyword_id = len(keyword2id)
+                keyword2id[keyword] = keyword_id
+                self.count_columns.append([])
+                self.total_columns.append([])
+                self.sentence_flags.append([])
+            return keyword_id
+
+        for block_idx, (transformer, offset) in enumerate(self.blocks):
+            if isinstance(transformer, KeywordFeaturesExtractor):
+                for i, keyword in enumerate(transformer.NGkeywordDB.keys()):
+                    self.count_columns[get_keyword_id(keyword)].append(offset + i)
+                    if transformer.exist_flag is True:
+                        self.exist_flag_columns.add(offset + i)
+            elif isinstance(transformer, FullnameFeaturesExtractor):
+                for i, words in enumerate([transformer.lastname_dic.keys(), transformer.firstname_dict.keys()]):
+                    for w in words:
+                        self.total_columns[get_keyword_id(w)].append(offset + i)
+            elif isinstance(transformer, SentenceContainTargetAndWord):
+                sentence_automaton, keyword_flags, _ = transformer.get_sentence_automaton()
+                for keyword, flags in zip(sentence_automaton.keywords, keyword_flags):
+                    self.sentence_flags[get_keyword_id(keyword)].append((block_idx, flags))
+
+        # '' はautomatonに登録せず (KeywordAutomatonと同様) 文書ごとに別途加える
+        empty_id = keyword2id.pop('', None)
+        self.empty_count_columns = self.count_columns[empty_id] if empty_id is not None else []
+        self.empty_total_columns = self.total_columns[empty_id] if empty_id is not None else []
+        self.automaton = KeywordAutomaton(list(keyword2id.keys()))
+        keyword_ids = list(keyword2id.values())
+        self.count_columns = [self.count_columns[i] for i in keyword_ids]
+        self.total_columns = [self.total_columns[i] for i in keyword_ids]
+        self.sentence_flags = [self.sentence_flags[i] for i in keyword_ids]
+
+    @staticmethod
+    def get_unsupported_reason(pipeline):
+        """対応していないpipelineの場合は理由(str), 対応している場合はNone"""
+        if len(pipeline.steps) != 2 or not isinstance(pipeline.steps[0][1], FeatureUnion) or not isinstance(pipeline.steps[-1][1], MultinomialNB):
+            return f"expected [FeatureUnion, MultinomialNB], got {[type(step).__name__ for _, step in pipeline.steps]}"
+        feature_union = pipeline.steps[0][1]
+        if feature_union.transformer_weights is not None:
+            return "FeatureUnion.transformer_weights"
+        for name, transformer in feature_union.transformer_list:
+            if not isinstance(transformer, (KeywordFeaturesExtractor, FullnameFeaturesExtractor, SentenceContainTargetAndWord, NgramCountVectorizer)):
+                return f"transformer {name}={type(transformer).__name__}"
+        return None
+
+    def _get_n_output_features(self, transformer) -> int:
+        if isinstance(transformer, KeywordFeaturesExtractor):
+            return len(transformer.NGkeywordDB)
+        if isinstance(transformer, FullnameFeaturesExtractor):
+            return 2
+        if isinstance(transformer, SentenceContainTargetAndWord):
+            return 4
+        return transformer.get_n_features()
+
+    def _get_keyword_features(self, text: str) -> tuple:
+        """1回のtext走査で キーワード, 姓, 名 の特徴量を求める
+        Returns:
+            dict: {列番号: 値} KeywordFeaturesExtractor, FullnameFeaturesExtractor の非ゼロの特徴量
+            dict: {block番号: [(start, end, bit mask), ...]} SentenceContainTargetAndWord の見出しの出現位置
+        """
+        counts = {}
+        next_start = {}     # keyword id -> 次に数えてよい出現の開始位置 (text.countと同様に重複しない出現を数える)
+        sentence_matches = {}
+        count_columns, total_columns, sentence_flags = self.count_columns, self.total_columns, self.sentence_flags
+        for start, end, keyword_id in self.automaton.iter_matches(text):
+            for block_idx, flags in sentence_flags[keyword_id]:
+                sentence_matches.setdefault(block_idx, []).append((start, end, flags))
+            if start >= next_start.get(keyword_id, 0):
+                next_start[keyword_id] = end
+                for column in count_columns[keyword_id]:
+                    counts[column] = counts.get(column, 0) + 1
+                for column in total_columns[keyword_id]:
+                    counts[column] = counts.get(column, 0) + 1
+
+        for column in self.empty_count_columns + self.empty_total_columns:
+            counts[column] = counts.get(column, 0) + len(text) + 1  # ''.count と同様
+        for column in self.exist_flag_columns.intersection(counts.keys()):
+            counts[column] = 1
+        return counts, sentence_matches
+
+    def _get_sentence_features(self, transformer: SentenceContainTargetAndWord, text: str, matches: list) -> list:
+        """SentenceContainTargetAndWord.count_match と同一の特徴量を，見出しの出現位置から求める"""
+        _, _, empty_flags = transformer.get_sentence_automaton()
+        spans = transformer.split_sentence_spans(text)
+        span_starts = [start for start, _ in spans]
+        sentence_flags = [empty_flags] * len(spans)
+        for start, end, flags in matches:
+            idx = bisect_right(span_starts, start) - 1
+            if idx >= 0 and end <= spans[idx][1]:   # 文の中に収まる出現のみ
+                sentence_flags[idx] |= flags
+
+        last_or_first = transformer.LASTNAME_FLAG | transformer.FIRSTNAME_FLAG
+        last_and_first_ng = transformer.LASTNAME_FLAG | transformer.FIRSTNAME_FLAG | transformer.NG_WORD_FLAG
+        first_or_last__NG_count = 0
+        first_and_last__NG_count = 0
+        for flags in sentence_flags:
+            if flags & last_or_first and flags & transformer.NG_WORD_FLAG:
+                first_or_last__NG_count += 1
+                if flags & last_and_first_ng == last_and_first_ng:
+                    first_and_last__NG_count += 1
+        sentence_num = len(spans)
+        if sentence_num == 0:
+            return [0, 0, 0, 0]
+        return [first_or_last__NG_count, first_and_last__NG_count, (first_or_last__NG_count/sentence_num)*100, (first_and_last__NG_count/sentence_num)*100]
+
+    def transform(self, texts: list):
+        """pipeline[:-1].transform(texts) と同一の疎行列 (csr_matrix, float64, 各行の列番号は昇順)
+        Args:
+            texts: list(str). TokenizedTextを与えた場合，n-gram特徴量はMeCabで再解析せずに分かち書き結果を利用する
+        """
+        texts = list(texts)
+        ngram_matrices = {block_idx: sp.csr_matrix(transformer.transform(texts))
+                          for block_idx, (transformer, _) in enumerate(self.blocks) if isinstance(transformer, NgramCountVectorizer)}
+        indices = []
+        data = []
+        indptr = [0]
+        for row, text in enumerate(texts):
+            counts, sentence_matches = self._get_keyword_features(text)
+            for block_idx, (transformer, offset) in enumerate(self.blocks):
+                if isinstance(transformer, (KeywordFeaturesExtractor, FullnameFeaturesExtractor)):
+                    block_columns = sorted(column for column in counts if offset <= column < offset + self._get_n_output_features(transformer))
+                    indices.extend(block_columns)
+                    data.extend(counts[column] for column in block_columns)
+                elif isinstance(transformer, SentenceContainTargetAndWord):
+                    for i, value in enumerate(self._get_sentence_features(transformer, text, sentence_matches.get(block_idx, []))):
+                        if value != 0:
+                            indices.append(offset + i)
+                            data.append(value)
+                else:
+                    X_ngram = ngram_matrices[block_idx]
+                    start, end = X_ngram.indptr[row], X_ngram.indptr[row + 1]
+                    indices.extend((X_ngram.indices[start:end] + offset).tolist())
+                    data.extend(X_ngram.data[start:end].tolist())
+            indptr.append(len(indices))
+
+        return sp.csr_matrix((np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+                             shape=(len(texts), self.n_features))
+
+    def joint_log_likelihood(self, X):
+        """MultinomialNB の joint log likelihood. X: transform() の疎行列. Returns: ndarray (n_samples, n_classes)"""
+        return X @ self.W + self.b
+
+    def predict_from_features(self, X):
+        """transform() の疎行列から MultinomialNB.predict と同一のlabelを求める"""
+        return self.classes[np.argmax(self.joint_log_likelihood(X), axis=1)]
+
+    def predict_proba_from_features(self, X):
+        """transform() の疎行列から MultinomialNB.predict_proba と同一の確率を求める (joint log likelihoodをclass方向に正規化したsoftmax)"""
+        jll = self.joint_log_likelihood(X)
+        return np.exp(jll - logsumexp(jll, axis=1)[:, np.newaxis])
+
+    def predict(self, texts: list):
+        return self.predict_from_features(self.transform(texts))
+
+    def predict_proba(self, texts: list):
+        return self.predict_proba_from_features(self.transform(texts))
+
+
+def transform_features(pipeline, texts):
+    """pipelineの分類器より前のstepの変換 (pipeline[:-1].transform(texts) と同一)
+    NOTE: slicingで作成したPipelineはfit済みと判定されず，sklearn 1.6ではFutureWarning(1.8以降はerror)となるため，各stepのtransformを順に適用する
+    """
+    X = texts
+    for _, step in pipeline.steps[:-1]:
+        X = step.transform(X)
+    return X
+
+
+### test
+def test_linear_scorer(trained_pipeline, texts: list, batch_size=256):
+    """特徴量, predict, predict_probaがpipelineと同一か. 特徴量抽出から推論までの1文書あたりの処理時間を比較する"""
+    import time
+    from src.mecab.MeCabClass import MeCabClass
+    from src.PPI_classifier.extract_features_controller import TokenizedText
+    scorer = NBLinearScorer(trained_pipeline)
+    mecab = MeCabClass()
+    tokenized_texts = [TokenizedText(text, mecab.get_wakati_by_parseNode(text)) for text in texts]
+
+    X = transform_features(trained_pipeline, tokenized_texts)
+    X_scorer = scorer.transform(tokenized_texts)
+    assert X.shape == X_scorer.shape and (X != X_scorer).nnz == 0
+    assert (transform_features(trained_pipeline, texts) != scorer.transform(texts)).nnz == 0
+    classifier = trained_pipeline.steps[-1][1]
+    assert np.array_equal(classifier.predict_joint_log_proba(X), scorer.joint_log_likelihood(X_scorer))
+    assert list(trained_pipeline.predict(tokenized_texts)) == list(scorer.predict(tokenized_texts))
+    assert np.array_equal(trained_pipeline.predict_proba(tokenized_texts), scorer.predict_proba(tokenized_texts))
+
+    for name, predict in [('pipeline', trained_pipeline.predict), ('scorer', scorer.predict)]:
+        s_time = time.perf_counter()
+        for i in range(0, len(tokenized_texts), batch_size):
+            predict(tokenized_texts[i:i + batch_size])
+        print(f"{name}: {(time.perf_counter() - s_time) / len(texts) * 1000:.4f} ms/doc")
+    print(f'OK: {len(texts)} texts')
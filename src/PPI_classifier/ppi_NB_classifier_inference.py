@@ -6,6 +6,7 @@ from pathlib import Path
 import pprint
 import time
 import pickle
+import json
 
 import pandas as pd
 from sklearn.pipeline import Pipeline, FeatureUnion
@@ -18,22 +19,62 @@ PROJ_PATH = str(Path(__file__).resolve().parents[2])
 # print(SRC_PATH)
 sys.path.append(PROJ_PATH)
 from src.PPI_classifier.extract_keyword_features_controller import KeywordFeaturesExtractor, FullnameFeaturesExtractor, SentenceContainTargetAndWord
-from src.PPI_classifier.extract_features_controller import NgramCountVectorizer
+from src.PPI_classifier.extract_features_controller import NgramCountVectorizer, NgramHashingVectorizer
+from src.PPI_classifier.compact_model import is_compact_model, load_compact_model
+from src.PPI_classifier.linear_scorer import NBLinearScorer
 
 
 class PPI_NaiveBaysianClassifier(object):
     def __init__(self) -> None:
         self.pipeline = None
+        self.scorer = None
   
     def set_pipeline(self, pipeline):
         self.pipeline = pipeline
+        self.scorer = None
+
+    def get_scorer(self):
+        """pipelineと同一の特徴量(疎行列)を特徴量抽出器を経由せずに求める NBLinearScorer. 初回呼び出し時に作成する
+        Returns:
+            NBLinearScorer: 対応していない構成のpipelineの場合はNone
+        """
+        if self.scorer is None and self.pipeline is not None and NBLinearScorer.get_unsupported_reason(self.pipeline) is None:
+            self.scorer = NBLinearScorer(self.pipeline)
+        return self.scorer
+
+    def load_pipeline(self, model_path: str):
+        """訓練済みpipelineを読み込む
+        Args:
+            model_path: pickle, または compact model(directory. compact_model.pyで作成). compact modelは配列を memory map して読み込む
+        """
+        if is_compact_model(model_path):
+            pipeline = load_compact_model(model_path)
+        else:
+            with open(model_path, 'rb') as f:
+                pipeline = pickle.load(f)
+        self.set_pipeline(pipeline)
+        return pipeline
 
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # NB classifier の作成と保存, 推論テストコード
 
-def get_NB_classifier_pipeline():
+NGRAM_FEATURIZERS = ['count', 'hashing']
+
+def get_NB_classifier_pipeline(ngram_featurizer='count', n_features=2**20):
+    """
+    Args:
+        ngram_featurizer: 'count' -> NgramCountVectorizer (訓練データから獲得した語彙. 現行model)
+                          'hashing' -> NgramHashingVectorizer (語彙を持たずn-gramのhash値で列を決める. modelの大きさはn_featuresで一定)
+        n_features: ngram_featurizer='hashing'の場合の特徴量の次元数
+    """
+    if ngram_featurizer == 'count':
+        ngram_vectorizer = NgramCountVectorizer(ngram_range=(1, 3))
+    elif ngram_featurizer == 'hashing':
+        ngram_vectorizer = NgramHashingVectorizer(ngram_range=(1, 3), n_features=n_features)
+    else:
+        raise ValueError(f"unknown ngram_featurizer: {ngram_featurizer}")
     ppi_ng_dic_files = ['/app/data/db/medical_history_ja_202410.txt',
                         '/app/data/db/criminal_history_ja_202410.txt',
                         '/app/data/db/religion_ja_202412.txt',
@@ -46,7 +87,7 @@ def get_NB_classifier_pipeline():
             ('keywords', KeywordFeaturesExtractor(ppi_ng_dic_files, exist_flag=False)),  # keyword not use MeCab
             ('fullname_count', FullnameFeaturesExtractor()),    # fullname not use MeCab
             ('secret_degree', SentenceContainTargetAndWord(ppi_ng_dic_files)), # sentence num containe target and NG word
-            ('ngram_count', NgramCountVectorizer(ngram_range=(1, 3))),  # ngram use MeCab
+            ('ngram_count', ngram_vectorizer),  # ngram use MeCab
         ])),
         # ----- sparse matrix algorithm -----
         ('classifier', MultinomialNB())
@@ -62,12 +103,26 @@ def print_results(y_test, y_pred):
     print(confusion_matrix(y_test, y_pred, labels=[1, 0]))  # 上から Positive, Negative
     return eval_dict
 
-def train_NB_classifier(pipeline_save=True):
+def measure_throughput(pipeline, texts: list, batch_size=256) -> float:
+    """filterと同様にbatch_size件ずつpredictした場合の throughput (docs/sec)"""
+    texts = list(texts)
+    s_time = time.time()
+    for i in range(0, len(texts), batch_size):
+        pipeline.predict(texts[i:i + batch_size])
+    return len(texts) / (time.time() - s_time)
+
+def measure_model_size(pipeline) -> tuple:
+    """pickleの大きさ(MB)と読み込み時間(sec)"""
+    pickled = pickle.dumps(pipeline)
+    s_time = time.time()
+    pickle.loads(pickled)
+    return len(pickled) / 10**6, time.time() - s_time
+
+def train_NB_classifier(pipeline_save=True, ngram_featurizers=('count', 'hashing')):
     """ 2025/03 分類器の訓練と評価，訓練済みpipelineの保存
     dataset: cc + synthetic(geminiのみ)
+    ngram_featurizers: 訓練するn-gram特徴量の種類 (get_NB_classifier_pipeline). 複数指定した場合は精度, 推論速度, modelの大きさを並べて表示する
     """
-    PPIClassifier = PPI_NaiveBaysianClassifier()
-    
     # Dataset - Train
     from src.PPI_classifier.data_controller import PPIDatasetController
     from sklearn.model_selection import train_test_split
@@ -86,32 +141,55 @@ def train_NB_classifier(pipeline_save=True):
     # Test Dataset
     test_df = DataCtr.ano_test20241007()
 
-    # Pipeline
-    pipeline = get_NB_classifier_pipeline()
-    PPIClassifier.set_pipeline(pipeline)
-    PPIClassifier.pipeline.fit(X_train, y_train)    # Train
-
-    # Evaluation
-    # valid
-    s_time = time.time()
-    y_pred = PPIClassifier.pipeline.predict(X_valid)
-    print_results(y_valid, y_pred)
-    elapsed_time = time.time() - s_time
-    print(f'valid-predict elapsed_time: {elapsed_time}, proc/1instance: {elapsed_time/len(y_valid):.5f}')
-
-    # test
-    s_time = time.time()
-    test_y_pred = PPIClassifier.pipeline.predict(test_df['text'])
-    print_results(test_df['is_privacy'], test_y_pred)
-    elapsed_time = time.time() - s_time
-    print(f'test-predict elapsed_time: {elapsed_time}, proc/1instance: {elapsed_time/len(test_y_pred):.5f}')
-
-    # Save
-    if pipeline_save:
-        save_pipeline_path = PROJ_PATH+'/src/PPI_classifier/models/tmp/NB_pipeline_202503_2.pkl'
-        with open(save_pipeline_path, 'wb') as f:
-            pickle.dump(PPIClassifier.pipeline, f)
-        print(f'saved model -> {save_pipeline_path}')
+    comparison = {}
+    for ngram_featurizer in ngram_featurizers:
+        print(f"----- ngram_featurizer: {ngram_featurizer} -----")
+        PPIClassifier = PPI_NaiveBaysianClassifier()
+
+        # Pipeline
+        pipeline = get_NB_classifier_pipeline(ngram_featurizer=ngram_featurizer)
+        PPIClassifier.set_pipeline(pipeline)
+        PPIClassifier.pipeline.fit(X_train, y_train)    # Train
+
+        # Evaluation
+        # valid
+        s_time = time.time()
+        y_pred = PPIClassifier.pipeline.predict(X_valid)
+        valid_eval = print_results(y_valid, y_pred)
+        elapsed_time = time.time() - s_time
+        print(f'valid-predict elapsed_time: {elapsed_time}, proc/1instance: {elapsed_time/len(y_valid):.5f}')
+
+        # test
+        s_time = time.time()
+        test_y_pred = PPIClassifier.pipeline.predict(test_df['text'])
+        test_eval = print_results(test_df['is_privacy'], test_y_pred)
+        elapsed_time = time.time() - s_time
+        print(f'test-predict elapsed_time: {elapsed_time}, proc/1instance: {elapsed_time/len(test_y_pred):.5f}')
+
+        # throughputはpickle化(measure_model_size)の前に計測する (pickle化の影響を受けない状態のpipelineで比較する)
+        docs_per_sec = measure_throughput(PPIClassifier.pipeline, test_df['text'])
+        model_mb, load_time = measure_model_size(PPIClassifier.pipeline)
+        comparison[ngram_featurizer] = {
+            'valid_accuracy': valid_eval['accuracy'], 'valid_macro_f1': valid_eval['macro avg']['f1-score'],
+            'test_accuracy': test_eval['accuracy'], 'test_macro_f1': test_eval['macro avg']['f1-score'],
+            'docs_per_sec': docs_per_sec,
+            'model_MB': model_mb, 'load_sec': load_time,
+        }
+
+        # Save
+        if pipeline_save:
+            suffix = '' if ngram_featurizer == 'count' else f'_{ngram_featurizer}'
+            save_pipeline_path = PROJ_PATH+f'/src/PPI_classifier/models/tmp/NB_pipeline_202503_2{suffix}.pkl'
+            with open(save_pipeline_path, 'wb') as f:
+                pickle.dump(PPIClassifier.pipeline, f)
+            print(f'saved model -> {save_pipeline_path}')
+
+    # 比較 (現行model: count)
+    print(f"{'featurizer':<10} {'valid_acc':>9} {'valid_f1':>9} {'test_acc':>9} {'test_f1':>9} {'docs/sec':>9} {'model_MB':>9} {'load_sec':>9}")
+    for ngram_featurizer, result in comparison.items():
+        print(f"{ngram_featurizer:<10} {result['valid_accuracy']:>9.4f} {result['valid_macro_f1']:>9.4f} {result['test_accuracy']:>9.4f} {result['test_macro_f1']:>9.4f}"
+              f" {result['docs_per_sec']:>9.1f} {result['model_MB']:>9.1f} {result['load_sec']:>9.3f}")
+    return comparison
 
 
 def test_load_inference():
@@ -143,6 +221,35 @@ def test_load_inference():
     test_df['is_privacy_by_classifier'] = y_ret
     test_df.to_json(PROJ_PATH+'/src/PPI_classifier/tmp_output/tmp/test_out.jsonl', orient='records', force_ascii=False, lines=True)
 
+def benchmark_batch_predict(input_jsonl_path: str, text_key='text', batch_sizes=(1, 32, 256, 1024), max_docs=4096):
+    """ batch sizeごとのpredictのthroughput(docs/sec)を計測する
+    Args:
+        input_jsonl_path: 計測に用いるjsonl (text_keyの値を分類器に入力)
+    """
+    trained_pipeline_path = PROJ_PATH + '/src/PPI_classifier/models/NB_pipeline_202503.pkl'
+    with open(trained_pipeline_path, 'rb') as f:
+        trained_pipeline = pickle.load(f)
+    PPICls = PPI_NaiveBaysianClassifier()
+    PPICls.set_pipeline(trained_pipeline)
+
+    texts = []
+    with open(input_jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            texts.append(json.loads(line)[text_key])
+            if len(texts) >= max_docs:
+                break
+
+    results = {}
+    for batch_size in batch_sizes:
+        s_time = time.time()
+        for i in range(0, len(texts), batch_size):
+            PPICls.pipeline.predict(texts[i:i + batch_size])
+        elapsed_time = time.time() - s_time
+        results[batch_size] = len(texts) / elapsed_time
+        print(f"batch_size={batch_size}: {results[batch_size]:.1f} docs/sec ({len(texts)} docs, {elapsed_time:.3f} sec)")
+    return results
+
 if __name__ == "__main__":
     train_NB_classifier(pipeline_save=True)
-    # test_load_inference()
\ No newline at end of file
+    # test_load_inference()
+    # benchmark_batch_predict('/app/data/test_filter/sample.jsonl')
\ No newline at end of file
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+# respect_PI_filter.py のend-to-end throughput benchmark
+# 合成した日本語jsonl corpus (reject率, 文書長, 人名・NGワードを含む文書の割合を指定) に対して
+# n_workersごとにrespect_PI_filter.pyを実行し，docs/sec, MB/sec, peak RSSをjsonで出力する.
+# corpusとstand-in分類器はseedから決定的に作成するため，同じ引数で実行した結果はcommit間で比較できる.
+
+# python benchmark_filter.py --output_json /app/src/filtering/tmp_output/tmp/bench.json --n_workers 1 2 4
+# python benchmark_filter.py --output_json bench_prefilter.json --n_workers 4 --filter_args "--ng_prefilter --json_backend orjson"
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+### SRC
+SRC_PATH = str(Path(__file__).resolve().parents[1])
+PROJ_PATH = str(Path(__file__).resolve().parents[2])
+sys.path.append(PROJ_PATH)
+
+BENCHMARK_VERSION = 1
+FILTER_SCRIPT = SRC_PATH + '/filtering/respect_PI_filter.py'
+DEFAULT_MODEL_PATH = PROJ_PATH + '/src/PPI_classifier/models/NB_pipeline_202503.pkl'
+NAME_DIC_FILE = PROJ_PATH + '/data/db/name_dic/unpack_jinmei30/JINMEI30_cutTop.TXT'
+NG_DIC_FILES = [PROJ_PATH + '/data/db/medical_history_ja_202410.txt',
+                PROJ_PATH + '/data/db/criminal_history_ja_202410.txt',
+                PROJ_PATH + '/data/db/religion_ja_202412.txt',
+                ]
+RSS_SAMPLING_INTERVAL = 0.05    # sec
+
+# 人名・NGワードを含まない文 (文書の大部分を占める)
+FILLER_SENTENCES = ['今日は朝から雨が降っていたので、家で本を読んで過ごしました。',
+                    '駅前に新しいカフェができたらしく、週末に行ってみるつもりです。',
+                    'このレシピは材料が少なく、初めての人でも簡単に作れます。',
+                    '来月のイベントの詳細は公式サイトで順次お知らせします。',
+                    '東京から大阪までは新幹線でおよそ二時間半かかります。',
+                    '新しいスマートフォンはバッテリーの持ちが良くなったと評判です。',
+                    '庭の桜が満開になり、近所の人たちが写真を撮りに来ていました。',
+                    '会議の資料は前日までに共有フォルダへ保存してください。',
+                    'この地域では秋になると紅葉を見に多くの観光客が訪れます。',
+                    '週末は天気が崩れる予報なので、洗濯は今日のうちに済ませておきます。',
+                    ]
+NAME_TEMPLATES = ['{name}さんが新しいプロジェクトの担当になりました。',
+                  '先日のセミナーでは{name}氏が講演を行いました。',
+                  '{name}さんから旅行のお土産をいただきました。',
+                  ]
+NG_TEMPLATES = ['{ng}について、専門家が一般向けに解説しています。',
+                '{ng}に関するニュースが報道されました。',
+                ]
+PPI_TEMPLATES = ['{name}さんは{ng}で通院していることを打ち明けた。',     # 人名とNGワードを同じ文書に含む (rule-based filterに該当)
+                 '{name}さんが{ng}であると近所で噂になっている。',
+                 ]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# 合成corpus
+
+def load_names(name_dic_file=NAME_DIC_FILE) -> tuple:
+    """人名辞書から姓, 名のリストを返す (MeCab user辞書の作成元と同じ辞書)
+    Returns:
+        (list(str), list(str)): 姓, 名
+    """
+    last_names, first_names = [], []
+    with open(name_dic_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            m = re.match(r'\S+\t"(.*?)":(\S+)', line)
+            if m is None:
+                continue
+            (last_names if m.group(2) == '姓' else first_names).append(m.group(1))
+    return last_names, first_names
+
+def load_ng_words(ng_dic_files=NG_DIC_FILES) -> list:
+    ng_words = []
+    for ng_dic_file in ng_dic_files:
+        with open(ng_dic_file, 'r', encoding='utf-8') as f:
+            ng_words.extend(line.strip() for line in f if line.strip())
+    return ng_words
+
+
+class SyntheticCorpusGenerator(object):
+    def __init__(self, reject_rate=0.05, doc_chars=500, name_rate=0.3, ng_rate=0.2, seed=0) -> None:
+        """
+        Args:
+            reject_rate: 人名とNGワードを同じ文に含む文書(PPI文書)の割合. stand-in分類器はPPI文書をrejectするよう訓練する
+            doc_chars: 文書長(文字数)の平均. 文書ごとに 0.5倍-1.5倍 の一様分布
+            name_rate: PPI文書以外で人名を含む文書の割合
+            ng_rate: PPI文書以外でNGワードを含む文書の割合.
+                人名を含む文書とNGワードを含む文書は重複させない (rule-based filterに該当するのはPPI文書のみ)
+        """
+        if name_rate + ng_rate > 1:
+            raise ValueError(f"name_rate + ng_rate must be <= 1: {name_rate=}, {ng_rate=}")
+        self.reject_rate = reject_rate
+        self.doc_chars = doc_chars
+        self.name_rate = name_rate
+        self.ng_rate = ng_rate
+        self.rand = random.Random(seed)
+        self.last_names, self.first_names = load_names()
+        self.ng_words = load_ng_words()
+
+    def get_params(self) -> dict:
+        return {"reject_rate": self.reject_rate, "doc_chars": self.doc_chars, "name_rate": self.name_rate, "ng_rate": self.ng_rate}
+
+    def _fullname(self) -> str:
+        return self.rand.choice(self.last_names) + self.rand.choice(self.first_names)
+
+    def generate(self) -> tuple:
+        """1文書を作成する
+        Returns:
+            (str, int): text, label (1: PPI文書)
+        """
+        n_chars = int(self.doc_chars * self.rand.uniform(0.5, 1.5))
+        sentences = []
+        total_chars = 0
+        while total_chars < n_chars:
+            sentence = self.rand.choice(FILLER_SENTENCES)
+            sentences.append(sentence)
+            total_chars += len(sentence)
+
+        r = self.rand.random()
+        label = 0
+        if r < self.reject_rate:
+            template, label = self.rand.choice(PPI_TEMPLATES), 1
+        elif r < self.reject_rate + (1 - self.reject_rate) * self.name_rate:
+            template = self.rand.choice(NAME_TEMPLATES)
+        elif r < self.reject_rate + (1 - self.reject_rate) * (self.name_rate + self.ng_rate):
+            template = self.rand.choice(NG_TEMPLATES)
+        else:
+            template = None
+        if template is not None:
+            sentence = template.format(name=self._fullname(), ng=self.rand.choice(self.ng_words))
+            sentences.insert(self.rand.randrange(len(sentences) + 1), sentence)
+        return ''.join(sentences), label
+
+    def write_jsonl(self, output_file: str, n_docs: int, doc_id_offset=0) -> int:
+        """n_docs文書をjsonlに書き出す
+        Returns:
+            `int`: 書き出したbyte数
+        """
+        with open(output_file, 'w', encoding='utf-8') as f:
+            for i in range(n_docs):
+                text, _ = self.generate()
+                f.write(json.dumps({"text": text, "id": doc_id_offset + i}, ensure_ascii=False) + "\n")
+        return os.path.getsize(output_file)
+
+
+def make_corpus(input_dir: str, n_docs: int, n_files: int, generator: SyntheticCorpusGenerator) -> dict:
+    """n_docs文書をn_filesに分けて書き出す
+    Returns:
+        `dict`: {"n_docs", "n_files", "bytes"}
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    total_bytes = 0
+    for file_idx in range(n_files):
+        file_n_docs = n_docs // n_files + (1 if file_idx < n_docs % n_files else 0)
+        total_bytes += generator.write_jsonl(os.path.join(input_dir, f"bench_{file_idx:03d}.jsonl"), file_n_docs,
+                                             doc_id_offset=file_idx * (n_docs // n_files + 1))
+    return {"n_docs": n_docs, "n_files": n_files, "bytes": total_bytes}
+
+
+def build_standin_pipeline(save_pipeline_path: str, n_docs=2000, seed=0, **generator_params):
+    """訓練済みpipelineのpickleが無い環境(offline, CI)のためのstand-in分類器.
+    本番と同じ構成のpipeline(get_NB_classifier_pipeline)を合成corpusで訓練して保存する. 特徴量抽出の処理量は本番と同程度になる
+    """
+    from src.PPI_classifier.ppi_NB_classifier_inference import get_NB_classifier_pipeline
+    generator = SyntheticCorpusGenerator(seed=seed, **dict(generator_params, reject_rate=0.5))
+    texts, labels = zip(*[generator.generate() for _ in range(n_docs)])
+    pipeline = get_NB_classifier_pipeline()
+    pipeline.fit(list(texts), list(labels))
+    with open(save_pipeline_path, 'wb') as f:
+        pickle.dump(pipeline, f)
+    print(f'saved stand-in pipeline -> {save_pipeline_path}')
+    return save_pipeline_path
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# 計測
+
+def get_process_tree_rss(root_pid: int) -> tuple:
+    """root_pidと子孫processのRSS(byte)の合計と最大 (Linuxの/procを参照)
+    Returns:
+        (int, int): 合計, 最大. /procが無い場合は (None, None)
+    """
+    if not os.path.isdir('/proc'):
+        return None, None
+    children = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])   # "pid (comm) state ppid ..." commは空白を含みうる
+        children.setdefault(ppid, []).append(int(pid))
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total_rss, max_rss = 0, 0
+    pids = [root_pid]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/statm', 'r') as f:
+                rss = int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+        total_rss += rss
+        max_rss = max(max_rss, rss)
+    return total_rss, max_rss
+
+
+class PeakRSSMonitor(object):
+    def __init__(self, pid: int, interval=RSS_SAMPLING_INTERVAL) -> None:
+        """別threadでpidのprocess tree(worker processを含む)のRSSを定期的に取得し，最大値を記録する"""
+        self.pid = pid
+        self.interval = interval
+        self.peak_total_rss = None
+        self.peak_process_rss = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            total_rss, max_rss = get_process_tree_rss(self.pid)
+            if total_rss is None:
+                return
+            self.peak_total_rss = max(self.peak_total_rss or 0, total_rss)
+            self.peak_process_rss = max(self.peak_process_rss or 0, max_rss)
+            self._stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop_event.set()
+        self._thread.join()
+
+
+def read_reject_rate(output_dir: str) -> float:
+    """stat_ファイルの処理件数から実際のreject率を求める"""
+    processed_num, discard_num = 0, 0
+    for fname in os.listdir(output_dir):
+        if fname.startswith('stat_'):
+            with open(os.path.join(output_dir, fname), 'r', encoding='utf-8') as f:
+                total_info = json.load(f)['total_info']
+            processed_num += total_info['processed_num']
+            discard_num += total_info['discard_num']
+    return discard_num / processed_num if processed_num > 0 else 0.0
+
+
+def run_filter(input_dir: str, output_dir: str, n_workers: int, model_path: str, filter_args=(), log_file=None) -> dict:
+    """respect_PI_filter.pyを別processで実行し，処理時間(process起動, 分類器の読み込みを含む)とpeak RSSを計測する
+    Returns:
+        `dict`: {"elapsed_sec", "peak_rss_mb": worker processを含む合計, "peak_process_rss_mb": 1 processの最大}
+    """
+    cmd = [sys.executable, FILTER_SCRIPT, '--input_dir', input_dir, '--output_dir', output_dir,
+           '--n_workers', str(n_workers), '--model_path', model_path] + list(filter_args)
+    with open(log_file or os.devnull, 'a') as log:
+        s_time = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=SRC_PATH + '/filtering')
+        with PeakRSSMonitor(proc.pid) as monitor:
+            returncode = proc.wait()
+        elapsed_time = time.perf_counter() - s_time
+    if returncode != 0:
+        raise RuntimeError(f"respect_PI_filter.py failed (exit={returncode}). see {log_file}: {' '.join(cmd)}")
+    to_mb = lambda rss: rss / 10**6 if rss is not None else None
+    return {"elapsed_sec": elapsed_time, "peak_rss_mb": to_mb(monitor.peak_total_rss), "peak_process_rss_mb": to_mb(monitor.peak_process_rss)}
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJ_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_filter(args) -> dict:
+    """合成corpusを作成し，n_workersごとにn_repeat回filterを実行する. 各n_workersの結果は実行時間の中央値の実行から求める"""
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='ppi_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    log_file = os.path.join(work_dir, 'filter.log')
+    generator_params = {"doc_chars": args.doc_chars, "name_rate": args.name_rate, "ng_rate": args.ng_rate}
+
+    # 分類器
+    model_path = args.model_path
+    is_standin = not os.path.exists(model_path)
+    if is_standin:
+        print(f'{model_path} not found. training a stand-in pipeline on a synthetic corpus')
+        model_path = build_standin_pipeline(os.path.join(work_dir, 'standin_NB_pipeline.pkl'), seed=args.seed + 1, **generator_params)
+
+    # corpus
+    input_dir = os.path.join(work_dir, 'input')
+    generator = SyntheticCorpusGenerator(reject_rate=args.reject_rate, seed=args.seed, **generator_params)
+    corpus = dict(make_corpus(input_dir, args.n_docs, args.n_files, generator), seed=args.seed, **generator.get_params())
+    print(f'{corpus=}')
+
+    filter_args = shlex.split(args.filter_args)
+    results = []
+    for n_workers in args.n_workers:
+        runs = []
+        for repeat_idx in range(args.n_repeat):
+            output_dir = os.path.join(work_dir, f'output_w{n_workers}_{repeat_idx}')
+            run = run_filter(input_dir, output_dir, n_workers, model_path, filter_args, log_file)
+            run["reject_rate"] = read_reject_rate(output_dir)
+            runs.append(run)
+            print(f'{n_workers=}, {repeat_idx=}: {run}')
+        elapsed_time = statistics.median(run["elapsed_sec"] for run in runs)
+        peak_rss = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+        results.append({
+            "n_workers": n_workers,
+            "elapsed_sec": elapsed_time,
+            "docs_per_sec": corpus["n_docs"] / elapsed_time,
+            "mb_per_sec": corpus["bytes"] / 10**6 / elapsed_time,
+            "peak_rss_mb": max(peak_rss) if len(peak_rss) > 0 else None,
+            "reject_rate": runs[0]["reject_rate"],
+            "runs": runs,
+        })
+
+    return {
+        "benchmark_version": BENCHMARK_VERSION,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model": {"path": model_path, "standin": is_standin},
+        "corpus": corpus,
+        "filter_args": filter_args,
+        "n_repeat": args.n_repeat,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark of respect_PI_filter.py on synthetic corpora.')
+    parser.add_argument('--output_json', type=str,
+                        help='Write the results (docs/sec, MB/sec, peak RSS per n_workers) to this json file', required=True)
+    parser.add_argument('--n_workers', type=int, nargs='+',
+                        help='n_workers values to benchmark', required=False, default=[1, 2, 4])
+    parser.add_argument('--n_repeat', type=int,
+                        help='Runs per n_workers value. The median elapsed time is reported', required=False, default=3)
+    parser.add_argument('--n_docs', type=int,
+                        help='Number of documents in the synthetic corpus', required=False, default=20000)
+    parser.add_argument('--n_files', type=int,
+                        help='Number of jsonl files the corpus is split into', required=False, default=4)
+    parser.add_argument('--doc_chars', type=int,
+                        help='Mean document length in characters (uniform in 0.5x-1.5x)', required=False, default=500)
+    parser.add_argument('--reject_rate', type=float,
+                        help='Fraction of documents containing a full name and an NG word in the same sentence', required=False, default=0.05)
+    parser.add_argument('--name_rate', type=float,
+                        help='Fraction of the other documents containing a full name only', required=False, default=0.3)
+    parser.add_argument('--ng_rate', type=float,
+                        help='Fraction of the other documents containing an NG word only', required=False, default=0.2)
+    parser.add_argument('--seed', type=int,
+                        help='Random seed for the corpus and the stand-in classifier', required=False, default=0)
+    parser.add_argument('--model_path', type=str,
+                        help='Trained classifier pipeline. If missing, a stand-in pipeline is trained on a synthetic corpus', required=False, default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--filter_args', type=str,
+                        help='Extra arguments for respect_PI_filter.py (e.g. "--ng_prefilter --batch_size 512")', required=False, default='')
+    parser.add_argument('--work_dir', type=str,
+                        help='Directory for the corpus, outputs and the filter log. Default: a new temporary directory', required=False, default=None)
+    args = parser.parse_args()
+
+    result = benchmark_filter(args)
+    with open(args.output_json, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    for r in result["results"]:
+        print(f'n_workers={r["n_workers"]}: {r["docs_per_sec"]:.1f} docs/sec, {r["mb_per_sec"]:.2f} MB/sec, peak_rss={r["peak_rss_mb"]} MB, reject_rate={r["reject_rate"]:.3f}')
+    print(f'saved -> {args.output_json}')
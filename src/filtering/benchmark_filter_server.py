@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# ppi_filter_server.py の負荷試験 (load test)
+# 合成した日本語文書(benchmark_filter.py のSyntheticCorpusGenerator)をrequestごとにdocs_per_request件ずつ送り，
+# 同時接続数(concurrency)ごとに latency の p50/p90/p99, requests/sec, docs/sec をjsonで出力する.
+# --socket_path を指定しない場合はserverを起動し(pre-warmの完了を待ってから計測)，計測後に停止する.
+
+# python benchmark_filter_server.py --output_json /app/src/filtering/tmp_output/tmp/bench_server.json --n_workers 4 --concurrency 1 4 16
+# python benchmark_filter_server.py --output_json bench_server.json --socket_path /tmp/ppi_filter.sock --concurrency 8 --docs_per_request 64
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+### SRC
+SRC_PATH = str(Path(__file__).resolve().parents[1])
+sys.path.append(SRC_PATH)
+
+from filtering.benchmark_filter import SyntheticCorpusGenerator, build_standin_pipeline, get_git_commit, DEFAULT_MODEL_PATH
+from filtering.ppi_filter_client import PPIFilterClient
+
+BENCHMARK_VERSION = 1
+SERVER_SCRIPT = SRC_PATH + '/filtering/ppi_filter_server.py'
+SERVER_START_TIMEOUT = 600  # sec. worker全体の読み込み(pre-warm)を待つ時間
+
+
+def get_percentile(sorted_values: list, q: float) -> float:
+    """nearest-rank法のq percentile (0 < q <= 100)"""
+    if len(sorted_values) == 0:
+        return None
+    rank = max(int(-(-q * len(sorted_values) // 100)), 1)    # ceil(q * n / 100)
+    return sorted_values[rank - 1]
+
+
+def start_server(socket_path: str, n_workers: int, model_path: str, server_args=(), log_file=None) -> subprocess.Popen:
+    """serverを起動し，requestを受け付けるまで待つ"""
+    cmd = [sys.executable, SERVER_SCRIPT, '--socket_path', socket_path, '--n_workers', str(n_workers), '--model_path', model_path] + list(server_args)
+    log = open(log_file, 'a') if log_file is not None else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    s_time = time.time()
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with {proc.returncode}: {shlex.join(cmd)} (see {log_file})')
+        if time.time() - s_time > SERVER_START_TIMEOUT:
+            proc.kill()
+            raise TimeoutError(f'server did not start within {SERVER_START_TIMEOUT} sec')
+        try:
+            with PPIFilterClient(socket_path, timeout=5) as client:
+                client.ping()
+            break
+        except OSError:
+            time.sleep(0.5)
+    print(f'server started in {time.time() - s_time:.1f} sec (pid={proc.pid})')
+    return proc
+
+def stop_server(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_load(socket_path: str, requests: list, concurrency: int) -> dict:
+    """concurrency個のthread(それぞれ1接続)で requests を先頭から順に取り出して送る
+    Args:
+        requests: [list(str), ...] 1 requestのtexts
+    Returns:
+        `dict`: {"n_requests", "n_docs" (errorのrequestを除く), "errors", "elapsed_sec", "requests_per_sec", "docs_per_sec", "latency_ms": {"mean", "p50", "p90", "p99", "max"}, "reject_rate"}
+    """
+    lock = threading.Lock()
+    next_idx = [0]
+    latencies_ns = []
+    counts = {"docs": 0, "rejected": 0}
+    errors = []
+
+    def _client_loop():
+        local_latencies_ns = []
+        local_docs, local_rejected = 0, 0
+        with PPIFilterClient(socket_path) as client:
+            while True:
+                with lock:
+                    idx = next_idx[0]
+                    next_idx[0] += 1
+                if idx >= len(requests):
+                    break
+                s_time_ns = time.perf_counter_ns()
+                try:
+                    verdicts = client.filter_batch(requests[idx])
+                except (OSError, RuntimeError) as e:
+                    with lock:
+                        errors.append(repr(e))
+                    continue
+                local_latencies_ns.append(time.perf_counter_ns() - s_time_ns)
+                local_docs += len(verdicts)
+                local_rejected += sum(verdicts)
+        with lock:
+            latencies_ns.extend(local_latencies_ns)
+            counts["docs"] += local_docs
+            counts["rejected"] += local_rejected
+
+    threads = [threading.Thread(target=_client_loop) for _ in range(concurrency)]
+    s_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_time = time.perf_counter() - s_time
+
+    latencies_ms = sorted(latency_ns / 10**6 for latency_ns in latencies_ns)
+    return {
+        "n_requests": len(latencies_ms),
+        "n_docs": counts["docs"],
+        "errors": len(errors),
+        "error_examples": errors[:3],
+        "elapsed_sec": elapsed_time,
+        "requests_per_sec": len(latencies_ms) / elapsed_time,
+        "docs_per_sec": counts["docs"] / elapsed_time,
+        "latency_ms": {
+            "mean": sum(latencies_ms) / len(latencies_ms) if len(latencies_ms) > 0 else None,
+            "p50": get_percentile(latencies_ms, 50),
+            "p90": get_percentile(latencies_ms, 90),
+            "p99": get_percentile(latencies_ms, 99),
+            "max": latencies_ms[-1] if len(latencies_ms) > 0 else None,
+        },
+        "reject_rate": counts["rejected"] / counts["docs"] if counts["docs"] > 0 else None,
+    }
+
+
+def benchmark_filter_server(args) -> dict:
+    """合成文書のrequestを作成し，concurrencyごとにn_requests件のrequestを送る. 各concurrencyの前にwarmup_requests件を送る(計測しない)"""
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='ppi_bench_server_')
+    os.makedirs(work_dir, exist_ok=True)
+    generator_params = {"doc_chars": args.doc_chars, "name_rate": args.name_rate, "ng_rate": args.ng_rate}
+
+    # requests
+    generator = SyntheticCorpusGenerator(reject_rate=args.reject_rate, seed=args.seed, **generator_params)
+    n_unique_requests = args.n_requests + args.warmup_requests
+    requests = [[generator.generate()[0] for _ in range(args.docs_per_request)] for _ in range(n_unique_requests)]
+    corpus = dict(n_docs=n_unique_requests * args.docs_per_request, seed=args.seed, **generator.get_params())
+
+    # server
+    server_proc = None
+    model = None
+    socket_path = args.socket_path
+    if socket_path is None:
+        model_path = args.model_path
+        is_standin = not os.path.exists(model_path)
+        if is_standin:
+            print(f'{model_path} not found. training a stand-in pipeline on a synthetic corpus')
+            model_path = build_standin_pipeline(os.path.join(work_dir, 'standin_NB_pipeline.pkl'), seed=args.seed + 1, **generator_params)
+        model = {"path": model_path, "standin": is_standin}
+        socket_path = os.path.join(work_dir, 'ppi_filter.sock')
+        server_proc = start_server(socket_path, args.n_workers, model_path, shlex.split(args.server_args), os.path.join(work_dir, 'server.log'))
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            if args.warmup_requests > 0:
+                run_load(socket_path, requests[:args.warmup_requests], concurrency)
+            result = dict(concurrency=concurrency, **run_load(socket_path, requests[args.warmup_requests:], concurrency))
+            results.append(result)
+            print(f'{concurrency=}: {result}')
+    finally:
+        if server_proc is not None:
+            stop_server(server_proc)
+
+    return {
+        "benchmark_version": BENCHMARK_VERSION,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "server": {"socket_path": args.socket_path, "n_workers": args.n_workers if server_proc is not None else None,
+                   "server_args": shlex.split(args.server_args), "model": model},
+        "corpus": corpus,
+        "docs_per_request": args.docs_per_request,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of ppi_filter_server.py: latency percentiles and throughput per client concurrency.')
+    parser.add_argument('--output_json', type=str,
+                        help='Write the results (p50/p90/p99 latency, requests/sec, docs/sec per concurrency) to this json file', required=True)
+    parser.add_argument('--socket_path', type=str,
+                        help='Socket of a running server. Default: start a server for the test and stop it afterwards', required=False, default=None)
+    parser.add_argument('--n_workers', type=int,
+                        help='(without --socket_path) Worker processes of the started server', required=False, default=1)
+    parser.add_argument('--server_args', type=str,
+                        help='(without --socket_path) Extra arguments for ppi_filter_server.py (e.g. "--verdict_cache_size 100000")', required=False, default='')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        help='Numbers of concurrent client connections to test', required=False, default=[1, 4, 16])
+    parser.add_argument('--n_requests', type=int,
+                        help='Measured requests per concurrency value', required=False, default=1000)
+    parser.add_argument('--warmup_requests', type=int,
+                        help='Requests sent before each measurement (not measured)', required=False, default=50)
+    parser.add_argument('--docs_per_request', type=int,
+                        help='Documents per request', required=False, default=16)
+    parser.add_argument('--doc_chars', type=int,
+                        help='Mean document length in characters (uniform in 0.5x-1.5x)', required=False, default=500)
+    parser.add_argument('--reject_rate', type=float,
+                        help='Fraction of documents containing a full name and an NG word in the same sentence', required=False, default=0.05)
+    parser.add_argument('--name_rate', type=float,
+                        help='Fraction of the other documents containing a full name only', required=False, default=0.3)
+    parser.add_argument('--ng_rate', type=float,
+                        help='Fraction of the other documents containing an NG word only', required=False, default=0.2)
+    parser.add_argument('--seed', type=int,
+                        help='Random seed for the documents and the stand-in classifier', required=False, default=0)
+    parser.add_argument('--model_path', type=str,
+                        help='(without --socket_path) Trained classifier pipeline. If missing, a stand-in pipeline is trained on a synthetic corpus', required=False, default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--work_dir', type=str,
+                        help='Directory for the socket, the stand-in model and the server log. Default: a new temporary directory', required=False, default=None)
+    args = parser.parse_args()
+
+    result = benchmark_filter_server(args)
+    with open(args.output_json, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    for r in result["results"]:
+        # 全requestがerrorの場合はlatencyがNone
+        p50, p99 = [f'{r["latency_ms"][q]:.2f} ms' if r["latency_ms"][q] is not None else 'n/a' for q in ('p50', 'p99')]
+        print(f'concurrency={r["concurrency"]}: {r["requests_per_sec"]:.1f} requests/sec, {r["docs_per_sec"]:.1f} docs/sec, '
+              f'latency p50={p50}, p99={p99}, errors={r["errors"]}')
+    print(f'saved -> {args.output_json}')
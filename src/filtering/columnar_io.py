@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Parquet / Arrow IPC shard の読み書き
+# 入力はrecord batch単位で読み込み，filter_keyの列のみをPythonのstrにする (行ごとのdict, json変換は行わない)
+# 出力はpassed_/rejected_ともにParquet. 入力のすべての列を保持し，判定結果の列(verdict_column)を追加できる
+# Parquetはrow group, Arrow IPC file形式はrecord batchを単位として分割(chunk)できる. Arrow IPC stream形式(datasetsのcacheなど)は分割しない
+
+import contextlib
+import os
+
+from filtering.overlapped_io import BatchWriter
+
+COLUMNAR_SUFFIXES = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+OUTPUT_SUFFIX = '.parquet'
+
+
+def _import_pyarrow():
+    """pyarrowはoptional dependency (pip install pyarrow). Parquet/Arrow入力の処理時のみimportする"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+        import pyarrow.compute
+    except ImportError as e:
+        raise ImportError("Parquet/Arrow input requires the `pyarrow` package: pip install pyarrow") from e
+    return pyarrow
+
+def get_columnar_format(filename: str):
+    """拡張子から入力形式を判定する
+    Returns:
+        `str`: 'parquet' or 'arrow'. Parquet/Arrowでない場合はNone
+    """
+    return COLUMNAR_SUFFIXES.get(os.path.splitext(filename)[1].lower())
+
+def is_columnar_file(filename: str) -> bool:
+    return get_columnar_format(filename) is not None
+
+def get_columnar_output_filename(filename: str, is_stat=False) -> str:
+    """出力ファイル名の拡張子. passed_/rejected_ は .parquet, stat_ は .json. e.g. a.arrow -> a.parquet"""
+    return os.path.splitext(filename)[0] + ('.json' if is_stat else OUTPUT_SUFFIX)
+
+
+@contextlib.contextmanager
+def _open_arrow(input_file: str):
+    """Arrow IPC fileを開く. file形式 -> RecordBatchFileReader, stream形式 -> RecordBatchStreamReader
+    withを抜けるとreaderとmemory mapを閉じる. 読み込んだrecord batchはmemory mapの領域を参照し続けるため，閉じた後も有効
+    """
+    pa = _import_pyarrow()
+    with pa.memory_map(input_file, 'r') as source:
+        try:
+            reader = pa.ipc.open_file(source)
+        except pa.ArrowInvalid:
+            source.seek(0)
+            reader = pa.ipc.open_stream(source)
+        try:
+            yield reader
+        finally:
+            if hasattr(reader, 'close'):    # RecordBatchFileReaderはclose()を持たない (sourceを閉じれば解放される)
+                reader.close()
+
+def read_columnar_schema(input_file: str):
+    """入力fileのschema (pyarrow.Schema)"""
+    pa = _import_pyarrow()
+    if get_columnar_format(input_file) == 'parquet':
+        with pa.parquet.ParquetFile(input_file) as parquet_file:
+            return parquet_file.schema_arrow
+    with _open_arrow(input_file) as reader:
+        return reader.schema
+
+def _get_part_sizes(input_file: str) -> list:
+    """分割の単位(Parquet: row group, Arrow IPC file: record batch)ごとのbyte数. 分割できない場合はNone"""
+    pa = _import_pyarrow()
+    if get_columnar_format(input_file) == 'parquet':
+        with pa.parquet.ParquetFile(input_file) as parquet_file:
+            metadata = parquet_file.metadata
+        return [metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups)]
+    with _open_arrow(input_file) as reader:
+        if not isinstance(reader, pa.ipc.RecordBatchFileReader):
+            return None
+        return [reader.get_batch(i).nbytes for i in range(reader.num_record_batches)]
+
+def split_columnar_ranges(input_file: str, chunk_size: int):
+    """fileを約chunk_size byteごとの範囲に分割する. 範囲はrow group(Parquet)またはrecord batch(Arrow IPC file)の番号[start, end)
+    Returns:
+        `list`: [(start, end), ...] ファイル先頭から順に並ぶ. 分割できない場合はNone
+    """
+    part_sizes = _get_part_sizes(input_file)
+    if part_sizes is None or len(part_sizes) == 0:
+        return None
+    ranges = []
+    start, size = 0, 0
+    for idx, part_size in enumerate(part_sizes):
+        size += part_size
+        if size >= chunk_size:
+            ranges.append((start, idx + 1))
+            start, size = idx + 1, 0
+    if start < len(part_sizes):
+        ranges.append((start, len(part_sizes)))
+    return ranges
+
+def get_columnar_range_size(input_file: str, part_range) -> int:
+    """part_range(split_columnar_ranges)のbyte数 (work unitの処理量の見積もり)"""
+    start, end = part_range
+    return sum(_get_part_sizes(input_file)[start:end])
+
+def iter_record_batches(input_file: str, batch_size: int, part_range=None):
+    """record batchを最大batch_size行ずつ返す generator. 全列を読み込む
+    Args:
+        part_range: (start, end) 指定した場合はrow group/record batchの番号[start, end)の範囲のみを返す
+    Returns:
+        `generator`: pyarrow.RecordBatch. 入力fileは最後まで読み込んだ時点, またはgeneratorのclose()で閉じる
+    """
+    pa = _import_pyarrow()
+    if get_columnar_format(input_file) == 'parquet':
+        row_groups = None if part_range is None else list(range(*part_range))
+        if row_groups is not None and len(row_groups) == 0:
+            return
+        with pa.parquet.ParquetFile(input_file, memory_map=True) as parquet_file:
+            yield from parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups)
+        return
+
+    with _open_arrow(input_file) as reader:
+        if isinstance(reader, pa.ipc.RecordBatchFileReader):
+            indices = range(reader.num_record_batches) if part_range is None else range(*part_range)
+            batches = (reader.get_batch(i) for i in indices)
+        else:
+            if part_range is not None:
+                raise ValueError(f"part_range is not supported for Arrow IPC stream: {input_file}")
+            batches = _iter_stream_batches(reader)
+        for batch in batches:
+            for offset in range(0, batch.num_rows, batch_size):
+                yield batch.slice(offset, batch_size)     # zero-copy
+
+def _iter_stream_batches(reader):
+    while True:
+        try:
+            yield reader.read_next_batch()
+        except StopIteration:
+            return
+
+def get_text_column(record_batch, filter_key: str) -> list:
+    """filter_keyの列をlist(str)として返す. nullは空文字とする (判定対象の文字がないためpassedとなる)"""
+    pa = _import_pyarrow()
+    if filter_key not in record_batch.schema.names:
+        raise KeyError(f"filter_key `{filter_key}` is not in the columns: {record_batch.schema.names}")
+    column = record_batch.column(filter_key)
+    if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        raise TypeError(f"filter_key `{filter_key}` must be a string column, got {column.type}")
+    return ["" if text is None else text for text in column.to_pylist()]
+
+def get_output_schema(input_schema, verdict_column=None):
+    """出力のschema. verdict_columnを指定した場合は判定結果(bool, True: rejected)の列を末尾に追加する"""
+    pa = _import_pyarrow()
+    if verdict_column is None:
+        return input_schema
+    if verdict_column in input_schema.names:
+        raise ValueError(f"verdict_column `{verdict_column}` already exists in the input columns")
+    return input_schema.append(pa.field(verdict_column, pa.bool_()))
+
+def open_parquet_writer(output_file: str, schema):
+    pa = _import_pyarrow()
+    return pa.parquet.ParquetWriter(output_file, schema)
+
+def concat_parquet_files(input_files: list, output_file: str, schema, remove_inputs=True):
+    """分割して処理したchunkごとのParquet出力を順に連結する (record batch単位でcopyし，全体をメモリに載せない)"""
+    pa = _import_pyarrow()
+    with pa.parquet.ParquetWriter(output_file, schema) as writer:
+        for path in input_files:
+            with pa.parquet.ParquetFile(path) as parquet_file:
+                for batch in parquet_file.iter_batches():
+                    writer.write_batch(batch)
+    if remove_inputs:
+        for path in input_files:
+            os.remove(path)
+
+
+class ParquetBatchWriter(BatchWriter):
+    """filter処理済みのrecord batchをwriter threadでpassed_/rejected_のParquetに書き込む (BatchWriterのParquet版)
+    行の選択(filter), 判定結果の列の追加はArrowの列単位の処理で行い，行ごとのPython objectは作成しない
+    """
+    def __init__(self, writers: dict, skip_rejected: bool, profiler, queue_stats, verdict_column=None, **kwargs) -> None:
+        """
+        Args:
+            writers: {"passed": ParquetWriter, "rejected": ParquetWriter} (open_parquet_writer). skip_rejected=Trueの場合は "passed" のみ
+            verdict_column: 判定結果(bool, True: rejected)の列名. None -> 追加しない
+        """
+        self._verdict_column = verdict_column
+        super().__init__(writers, skip_rejected, profiler, queue_stats, **kwargs)
+
+    def _write_payload(self, payload):
+        """writer threadで呼び出す. payload: (record_batch, [is_rejected, ...])"""
+        pa = _import_pyarrow()
+        record_batch, is_rejected = payload
+        rejected_mask = pa.array(is_rejected, pa.bool_())
+        if self._verdict_column is not None:
+            record_batch = record_batch.append_column(self._verdict_column, rejected_mask)
+        self._writers["passed"].write_batch(record_batch.filter(pa.compute.invert(rejected_mask)))
+        if self._skip_rejected is False:
+            self._writers["rejected"].write_batch(record_batch.filter(rejected_mask))
+
+    def write_record_batch(self, record_batch, results: list):
+        """
+        Args:
+            record_batch: 入力のpyarrow.RecordBatch
+            results: list(Document) record_batchの各行のfilter_keyの列に対するfilter処理結果 (行順)
+        """
+        is_rejected = [result.is_rejected is True for result in results]
+        self._profiler.add_batch("write_wait", self._put((len(is_rejected), (record_batch, is_rejected))), len(is_rejected))
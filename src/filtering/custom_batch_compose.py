@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# 複数文書をまとめて処理するための hojichar Compose 拡張
+# apply_batch() を持つfilter(分類器など)はbatch単位で1回だけ呼び出し，それ以外のfilterは1文書ずつ適用する
+
+import queue
+import threading
+import time
+
+from hojichar import Compose, Document
+from hojichar.core.composition import BeforeProcessFilter
+from hojichar.core.inspection import Inspector
+
+from filtering.overlapped_io import _put_until_stopped
+
+
+class BatchCompose(Compose):
+    def __init__(self, *args, profiler=None, **kwargs) -> None:
+        """hojichar Compose と同じfilter構成, 同じ統計情報(statistics)で，apply_batch()による一括処理を可能にする
+        Args:
+            profiler: StageProfiler. 与えた場合，filterごとの1文書あたりの処理時間を記録する (stage名は統計情報のfilter名 "<idx>-<filter名>").
+                      apply_batch()で一括処理するfilterはbatch全体の処理時間を文書数で割った値(batch平均)となる
+        """
+        super().__init__(*args, **kwargs)
+        self._before_process_filter = BeforeProcessFilter()
+        self._profiler = profiler
+
+    def _apply_filter_batch(self, filt, documents: list) -> tuple:
+        """
+        Returns:
+            documents: list(Document) 入力順
+            time_ns_list: list(int) 各文書の処理時間. apply_batch()で一括処理した場合はbatch全体の処理時間を文書数で割った値
+            is_batch: bool apply_batch()で一括処理したか
+        """
+        if hasattr(filt, 'apply_batch') and filt.p == 1:
+            s_time_ns = time.perf_counter_ns()
+            targets = [doc for doc in documents if not (doc.is_rejected and filt.skip_rejected)]
+            if len(targets) > 0:
+                filt.apply_batch(targets)
+            per_doc_time_ns = (time.perf_counter_ns() - s_time_ns) // len(documents)
+            return documents, [per_doc_time_ns] * len(documents), True
+        results, time_ns_list = [], []
+        for doc in documents:
+            s_time_ns = time.perf_counter_ns()
+            results.append(self._apply_filter(filt=filt, document=doc))
+            time_ns_list.append(time.perf_counter_ns() - s_time_ns)
+        return results, time_ns_list, False
+
+    def apply_batch(self, documents: list) -> list:
+        """Compose.apply() を文書リストに適用する. 出力は入力順
+        filterごとの処理時間は1文書ずつ適用するfilterは文書ごとに，apply_batch()のfilterはbatch全体の処理時間を各文書に均等に割り当てて集計する
+        """
+        if len(documents) == 0:
+            return documents
+
+        before_inspectors = []
+        for doc in documents:
+            inspector = Inspector(target_filter=self._before_process_filter, filter_idx=-1)
+            inspector.apply(doc)
+            before_inspectors.append(inspector)
+
+        doc_inspectors = [[] for _ in documents]
+        previous_inspectors = before_inspectors
+        for i, filt in enumerate(self.filters):
+            documents, time_ns_list, is_batch = self._apply_filter_batch(filt, documents)
+            if self._profiler is not None:
+                if is_batch:
+                    self._profiler.add_batch(f"{i}-{filt.name}", sum(time_ns_list), len(documents))
+                else:
+                    for time_ns in time_ns_list:
+                        self._profiler.add(f"{i}-{filt.name}", time_ns)
+
+            current_inspectors = []
+            for j, doc in enumerate(documents):
+                inspector = Inspector(target_filter=filt, filter_idx=i)
+                inspector.apply(doc)
+                inspector.time_ns = previous_inspectors[j].time_ns + time_ns_list[j]
+                if (not previous_inspectors[j].is_rejected) and inspector.is_rejected:
+                    doc.reject_reason = filt.get_jsonalbe_vars(exclude_keys={"skip_rejected"})
+                current_inspectors.append(inspector)
+                doc_inspectors[j].append(inspector)
+            previous_inspectors = current_inspectors
+
+        for doc, before_inspector, inspectors in zip(documents, before_inspectors, doc_inspectors):
+            self._statistics.update_changes(doc, before_inspector, inspectors)
+        return documents
+
+    def apply(self, document: Document) -> Document:
+        return self.apply_batch([document])[0]
+
+
+def iter_micro_batches(iterable, batch_size: int, flush_timeout=None):
+    """iterableの要素をbatch_size件ずつのlistにまとめて返す generator
+    Args:
+        flush_timeout: batchの先頭要素を受け取ってからflush_timeout秒経過した場合，batch_size件に満たなくてもbatchを返す (入力が遅いstreamで文書が滞留しないようにする).
+                       次の要素が届かなくてもflushするため，iterableは別thread(producer)で読み込み，queue.get(timeout=残り時間)で待つ.
+                       None: threadを使わず，batch_size件そろうか入力が終わるまで待つ
+    """
+    if flush_timeout is None:
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+        return
+
+    items = queue.Queue(maxsize=batch_size)
+    stop = threading.Event()
+    end = object()
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put_until_stopped(items, (item,), stop):
+                    return
+            _put_until_stopped(items, end, stop)
+        except BaseException as e:
+            _put_until_stopped(items, e, stop)
+        finally:
+            # 読み込み中のgeneratorは他のthreadから閉じられないため，producer自身が閉じる
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    producer = threading.Thread(target=_produce, daemon=True)
+    producer.start()
+    try:
+        batch = []
+        batch_s_time = None
+        while True:
+            if len(batch) == 0:
+                entry = items.get()
+            else:
+                try:
+                    entry = items.get(timeout=max(batch_s_time + flush_timeout - time.monotonic(), 0))
+                except queue.Empty:
+                    yield batch
+                    batch = []
+                    continue
+            if entry is end:
+                break
+            if isinstance(entry, BaseException):
+                raise entry
+            if len(batch) == 0:
+                batch_s_time = time.monotonic()
+            batch.append(entry[0])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+    finally:
+        # 途中で閉じられた場合もproducerを止める. 入力待ち(stdinなど)のproducerは次の要素を受け取った時点で終了する (daemon thread)
+        stop.set()
@@ -7,7 +7,9 @@ import sys
 import os
 from pathlib import Path
 import re
+import time
 import pickle
+from collections import Counter
 
 import hojichar
 from hojichar import document_filters, Document
@@ -18,15 +20,33 @@ sys.path.append(PROJ_PATH)
 
 from src.mecab.MeCabClass import MeCabClass
 from src.PPI_classifier.ppi_NB_classifier_inference import PPI_NaiveBaysianClassifier
+from src.PPI_classifier.extract_features_controller import TokenizedText
+from src.PPI_classifier.keyword_automaton import KeywordAutomaton
+from src.PPI_classifier.linear_scorer import transform_features
+from src.filtering.stage_profiler import StageProfiler
+from src.filtering.verdict_cache import VerdictCache, get_text_hash, get_version_stamp
+
+DEFAULT_MODEL_PATH = PROJ_PATH + '/src/PPI_classifier/models/NB_pipeline_202503.pkl'    # 訓練済みpipeline
 
 class ProtectPersonalInformationRulebaseAndClassifier(hojichar.core.filter_interface.Filter):
-    def __init__(self, add_ppi_info:bool, *args, **kwargs) -> None:
+    def __init__(self, add_ppi_info:bool, ng_prefilter:bool=False, model_path:str=None,
+                 verdict_cache_size:int=0, verdict_cache_db:str=None, *args, **kwargs) -> None:
         """
         Args:
             add_ppi_info: bool debug用にPPI判定情報をmetadataに追加するかどうか DocumentをDetailDocuemnt classを利用して読み込むこと
+            ng_prefilter: bool True -> NG wordを文字列として含まない文書はMeCab解析を行わずに通過させる (判定結果は同一)
+                          add_ppi_info=Trueの場合はmetadata(detect_fullnames)のためにMeCab解析が必要なため無効
+            model_path: 訓練済みpipeline(pickle, またはcompact modelのdirectory)のpath. None -> DEFAULT_MODEL_PATH
+            verdict_cache_size: 同じtextの判定結果をmemory(LRU)に保持する最大数. 0かつverdict_cache_db=None -> verdict cacheを利用しない
+                                add_ppi_info=Trueの場合はmetadataを作成するため無効
+            verdict_cache_db: verdict cacheのdisk cache(sqlite3)のpath. 複数のworker, 複数回の実行で共有する. None -> memoryのみ
         """
         super().__init__(*args, **kwargs)
         self.add_ppi_info = add_ppi_info
+        # NOTE: filterのpublicな属性は統計情報のparams, dump_reasonのfilter_reasonに出力されるため，内部状態は _ 付きの属性とする
+        self._ng_prefilter = ng_prefilter and not add_ppi_info
+        self._counters = Counter()  # 統計情報に追加する処理件数 (get_counters)
+        self._profiler = StageProfiler()    # 処理段階ごとの1文書あたりの処理時間 (get_stage_profiler)
 
         # ----- Rule-based filter ------------------------------------------------------------------------
         self.mecab = MeCabClass()   # Rule-based filterのためのmecabインスタンス
@@ -53,14 +73,23 @@ class ProtectPersonalInformationRulebaseAndClassifier(hojichar.core.filter_inter
         self.ng_words_db = self.create_NgWords_db(ng_key_dic_file_paths)
         # print(f"NgWords DB: {len(self.ng_words_db.keys())}"); exit()
 
+        ### NG words 文字列一致の事前判定 (ng_prefilter)
+        # user辞書, wordDBのどちらで検出する場合もNG wordの表層形はtextの部分文字列である. 空文字の表層形はnode走査で除外されるため対象外
+        self._ng_word_automaton = KeywordAutomaton([w for w in self.ng_words_db.keys() if len(w) > 0]) if self._ng_prefilter else None
+
         # ----- Classifier filter ------------------------------------------------------------------------
         self.PPI_NB_classifier = PPI_NaiveBaysianClassifier()
         # Load trained pipeline
-        trained_pipeline_path = PROJ_PATH + '/src/PPI_classifier/models/NB_pipeline_202503.pkl'
-        with open(trained_pipeline_path, 'rb') as f:
-            trained_pipeline = pickle.load(f)
-            print(f'loaded trained_pipeline: {trained_pipeline_path=}, type={type(trained_pipeline)}')
-        self.PPI_NB_classifier.set_pipeline(trained_pipeline)
+        trained_pipeline_path = model_path if model_path is not None else DEFAULT_MODEL_PATH
+        trained_pipeline = self.PPI_NB_classifier.load_pipeline(trained_pipeline_path)
+        print(f'loaded trained_pipeline: {trained_pipeline_path=}, type={type(trained_pipeline)}')
+
+        # ----- Verdict cache ----------------------------------------------------------------------------
+        # 判定に用いるmodel, NG words, MeCab user辞書の内容をversion stampとし，いずれかが変わった場合は以前の判定結果を参照しない
+        self._verdict_cache = None
+        if (verdict_cache_size > 0 or verdict_cache_db is not None) and not add_ppi_info:
+            version_stamp = get_version_stamp([trained_pipeline_path] + ng_key_dic_file_paths + self.mecab.user_dic_paths)
+            self._verdict_cache = VerdictCache(version_stamp, max_entries=verdict_cache_size, db_path=verdict_cache_db)
 
 
     # [Rule-based] Detect NgWords
@@ -85,6 +114,40 @@ class ProtectPersonalInformationRulebaseAndClassifier(hojichar.core.filter_inter
 
         return ng_words_db
 
+    def contains_NgWords_substring(self, text: str) -> bool:
+        """NG wordのいずれかを文字列として含むか. Falseの場合，is_PPI3はMeCab解析結果によらずFalseとなる"""
+        return self._ng_word_automaton.contains_any(text)
+
+    def get_counters(self) -> dict:
+        """reset_counters()以降の処理件数
+        Returns:
+            `dict`: {'ng_prefilter_skipped_num': NG wordを含まずMeCab解析を省略した文書数}
+                    verdict cacheを利用する場合は以下を追加
+                    {'verdict_cache_lookup_num': cacheを参照した文書数,
+                     'verdict_cache_hit_num': cache(または同じbatch内の同じtext)の判定結果を利用した文書数,
+                     'verdict_cache_disk_hit_num': うちdisk cacheの判定結果を利用した文書数}
+        """
+        counters = {'ng_prefilter_skipped_num': self._counters['ng_prefilter_skipped_num']}
+        if self._verdict_cache is not None:
+            for key in ['verdict_cache_lookup_num', 'verdict_cache_hit_num', 'verdict_cache_disk_hit_num']:
+                counters[key] = self._counters[key]
+        return counters
+
+    def get_stage_profiler(self) -> StageProfiler:
+        """reset_counters()以降の処理段階ごとの処理時間, 到達した文書数
+        - ppi:verdict_cache: verdict cacheの参照, 登録 (verdict_cache_size>0の場合. batch単位の処理時間を文書数で割った値)
+        - ppi:ng_prefilter: NG word文字列一致の事前判定 (ng_prefilter=Trueの場合)
+        - ppi:mecab_parse: MeCab解析
+        - ppi:rule_scan: fullname, NG wordsの判定 (MeCab node走査)
+        - ppi:classifier_featurize, ppi:classifier_predict: 分類器の特徴量抽出, 推論 (rule-based filterに該当した文書のみ. batch単位の処理時間を文書数で割った値)
+        """
+        return self._profiler
+
+    def reset_counters(self):
+        """処理件数, 処理時間の記録を初期化する"""
+        self._counters.clear()
+        self._profiler = StageProfiler()
+
 
     # [Rule-based] Detect PPI
     # -------------------------------------------------------------------------------------
@@ -111,23 +174,31 @@ class ProtectPersonalInformationRulebaseAndClassifier(hojichar.core.filter_inter
         return False, fullnames, None
 
 
-    def is_PPI3(self, doc: Document) -> tuple:
+    def is_PPI3(self, doc: Document, surfaces=None) -> tuple:
         """ 
-        - [Algorithm] 以下の判定をそれぞれ実行
+        - [Algorithm] 以下の判定をMeCabのnode走査1回でまとめて実行
         - fullname判定: MeCab user辞書
         - NG words判定: MeCab user辞書を利用        
         - NG words判定: MeCab default辞書とNG wordsリストとのMatching
+        - add_ppi_info=Falseの場合，fullnameとNG wordsの両方を検出した時点で判定を終了する (判定結果は同一. metadata用のfullnames, ng_matchは途中までの検出結果)
+        Args:
+            surfaces: listを与えた場合，MeCabの分かち書き結果を追加する (分類器のn-gram特徴量で再利用)
         """
-        ### fullname ->  NgWords(regex)
-        # [MeCab] parse結果を取得し，filter判定に用いる. parse結果は再利用想定
-        parsedNode = self.mecab.get_parsedNode(doc.text)
-        fullnames = self.mecab.detect_fullname(parsedNode)
+        return self._is_PPI3_text(doc.text, surfaces)
 
-        # [NgWords]
-        # use user_dic
-        is_detect_NgWords_userdic, ng_type = self.mecab.detect_NgWords_by_userdic(parsedNode, self.mecabUserDicTag2NgTag)
-        # use wordDB
-        is_detect_NgWords_defaultdic, ng_word, ng_db_filename = self.mecab.detect_NgWords_by_wordDB(parsedNode, self.ng_words_db)
+    def _is_PPI3_text(self, text: str, surfaces=None) -> tuple:
+        """is_PPI3のtext版 (Documentを作成せずに判定する. get_verdicts)"""
+        ### fullname ->  NgWords(regex)
+        # [MeCab] parse結果を取得し，filter判定に用いる. 分かち書き結果(surfaces)は分類器で再利用
+        s_time_ns = time.perf_counter_ns()
+        parsedNode = self.mecab.get_parsedNode(text)
+        parsed_time_ns = time.perf_counter_ns()
+        fullnames, ng_type, ng_word, ng_db_filename = self.mecab.scan_fullname_and_NgWords(parsedNode, self.mecabUserDicTag2NgTag, self.ng_words_db,
+                                                                                          stop_early=not self.add_ppi_info, surfaces=surfaces)
+        self._profiler.add("ppi:mecab_parse", parsed_time_ns - s_time_ns)
+        self._profiler.add("ppi:rule_scan", time.perf_counter_ns() - parsed_time_ns)
+        is_detect_NgWords_userdic = ng_type is not None     # use user_dic
+        is_detect_NgWords_defaultdic = ng_word is not None  # use wordDB
 
 
         # 判定
@@ -154,6 +225,118 @@ class ProtectPersonalInformationRulebaseAndClassifier(hojichar.core.filter_inter
             return True
         else:
             return False
+
+    def predict_PPI_by_classifier_batch(self, texts: list) -> list:
+        """複数文書をまとめて1回のpredictで判定する (FeatureUnion, CountVectorizer, MultinomialNBの呼び出しコストをbatchで共有)
+        Args:
+            texts: list(str). TokenizedTextを与えた場合，n-gram特徴量はMeCabで再解析せずに分かち書き結果を利用する
+        Returns:
+            `list`: [bool, ...] 入力順
+        """
+        if len(texts) == 0:
+            return []
+        # pipeline.predict(texts) と同じ処理を，特徴量抽出と推論に分けて処理時間を記録する
+        # 特徴量はNBLinearScorerで1回のtext走査から直接求め，推論は X @ W + b で計算する (pipelineと同一の結果. 対応していないpipelineはpipelineの各stepを利用)
+        pipeline = self.PPI_NB_classifier.pipeline
+        scorer = self.PPI_NB_classifier.get_scorer()
+        with self._profiler.measure("ppi:classifier_featurize", len(texts)):
+            X = scorer.transform(texts) if scorer is not None else transform_features(pipeline, texts)
+        with self._profiler.measure("ppi:classifier_predict", len(texts)):
+            y_pred = scorer.predict_from_features(X) if scorer is not None else pipeline[-1].predict(X)
+        return [int(y) == 1 for y in y_pred]
+
+    def _set_result(self, doc: Document, fullnames, ng_match, is_PPI_by_classifier: bool) -> Document:
+        if is_PPI_by_classifier is True:
+            doc.is_rejected = True
+
+        # Add metadata
+        if self.add_ppi_info is True:
+            doc.metadata['detect_fullnames'] = fullnames
+            doc.metadata['ng_match'] = ng_match
+            doc.metadata['is_PPI_by_classifier'] = 1 if is_PPI_by_classifier is True else 0
+
+        return doc
+
+    def apply_batch(self, docs: list) -> list:
+        """apply()のbatch版. Rule-based filterで該当した文書のみを集め，分類器は1回のpredictでまとめて判定する
+        判定結果はapply()を1文書ずつ適用した場合と同一
+        Returns:
+            docs: list(Document) 入力順
+        """
+        texts = [doc.text for doc in docs]
+        if self._verdict_cache is not None:
+            # verdict cacheはadd_ppi_info=Falseの場合のみ利用するため，metadata(fullnames, ng_match)は設定しない
+            for doc, is_PPI in zip(docs, self._get_verdicts_with_verdict_cache(texts)):
+                self._set_result(doc, [], None, is_PPI)
+        else:
+            is_PPI_by_classifier, rule_results = self._get_verdicts(texts)
+            for doc, (_, fullnames, ng_match), is_PPI in zip(docs, rule_results, is_PPI_by_classifier):
+                self._set_result(doc, fullnames, ng_match, is_PPI)
+        return docs
+
+    def get_verdicts(self, texts: list) -> list:
+        """apply_batch()のtext版. Documentを作成せず，判定結果のみを返す (verdict cache, ng_prefilterを利用する)
+        Args:
+            texts: list(str)
+        Returns:
+            `list`: [is_PPI_by_classifier: bool, ...] 入力順. True: 要配慮個人情報を含む (apply()の doc.is_rejected)
+        """
+        if self._verdict_cache is not None:
+            return self._get_verdicts_with_verdict_cache(texts)
+        return self._get_verdicts(texts)[0]
+
+    def _get_verdicts_with_verdict_cache(self, texts: list) -> list:
+        """cacheに判定結果があるtext, 同じbatch内で同じtextが先にあるtextは，判定を省略して同じ判定結果とする
+        Returns:
+            `list`: [is_PPI_by_classifier: bool, ...] 入力順
+        """
+        s_time_ns = time.perf_counter_ns()
+        text_hashes = [get_text_hash(text) for text in texts]
+        cached_verdicts, disk_hashes = self._verdict_cache.get_many(text_hashes)
+        first_idx = {}  # {text_hash: cacheになく判定が必要なtextのidx}
+        for idx, text_hash in enumerate(text_hashes):
+            if text_hash not in cached_verdicts and text_hash not in first_idx:
+                first_idx[text_hash] = idx
+        lookup_ns = time.perf_counter_ns() - s_time_ns
+
+        miss_results, _ = self._get_verdicts([texts[idx] for idx in first_idx.values()])
+        verdicts = dict(zip(first_idx.keys(), miss_results))
+        s_time_ns = time.perf_counter_ns()
+        self._verdict_cache.put_many(verdicts)
+        self._profiler.add_batch("ppi:verdict_cache", lookup_ns + time.perf_counter_ns() - s_time_ns, len(texts))
+
+        self._counters['verdict_cache_lookup_num'] += len(texts)
+        self._counters['verdict_cache_hit_num'] += len(texts) - len(first_idx)
+        self._counters['verdict_cache_disk_hit_num'] += sum(1 for text_hash in text_hashes if text_hash in disk_hashes)
+
+        verdicts.update(cached_verdicts)
+        return [verdicts[text_hash] for text_hash in text_hashes]
+
+    def _get_verdicts(self, texts: list) -> tuple:
+        """Rule-based filter -> 分類器の判定
+        Returns:
+            `tuple`: ([is_PPI_by_classifier: bool, ...], [(rule-based filterの判定, fullnames, ng_match), ...]) 入力順
+        """
+        surfaces_list = [[] for _ in texts]
+        rule_results = []
+        for text, surfaces in zip(texts, surfaces_list):
+            if self._ng_prefilter:
+                with self._profiler.measure("ppi:ng_prefilter"):
+                    contains_NgWords = self.contains_NgWords_substring(text)
+                if not contains_NgWords:
+                    # NG wordを含まない -> rule-based filterに該当しないためMeCab解析を省略
+                    self._counters['ng_prefilter_skipped_num'] += 1
+                    rule_results.append((False, [], None))
+                    continue
+            rule_results.append(self._is_PPI3_text(text, surfaces))    # MeCab userdic & default dicを用いたNgWords判定
+
+        # PPI classifier (rule-based filterで該当した文書のみ). rule-based filterでのMeCab分かち書き結果をn-gram特徴量に再利用する
+        rule_positive_idx = [idx for idx, (reject_flag, _, _) in enumerate(rule_results) if reject_flag is True]
+        classifier_results = self.predict_PPI_by_classifier_batch([TokenizedText(texts[idx], surfaces_list[idx]) for idx in rule_positive_idx])
+        is_PPI_by_classifier = [False] * len(texts)
+        for idx, is_PPI in zip(rule_positive_idx, classifier_results):
+            is_PPI_by_classifier[idx] = is_PPI
+        return is_PPI_by_classifier, rule_results
         
     def apply(self, doc: Document) -> Document:
         """要配慮個人情報であるかの判定を以下の2点を満たすかで判定する．
@@ -167,23 +350,66 @@ class ProtectPersonalInformationRulebaseAndClassifier(hojichar.core.filter_inter
                 doc.metadata['ng_match']: list(str)
                 doc.metadata['is_PPI_by_classifier']: int
         """
-        # Rule-based filter
-        reject_flag, fullnames, ng_match = self.is_PPI3(doc)    # MeCab userdic & default dicを用いたNgWords判定
-        
-        is_PPI_by_classifier = False
-        if reject_flag is True:
-            # PPI classifier
-            is_PPI_by_classifier = self.predict_PPI_by_classifier(doc)
-            if is_PPI_by_classifier is True:
-                doc.is_rejected = True
-        
-        # Add metadata
-        if self.add_ppi_info is True:
-            doc.metadata['detect_fullnames'] = fullnames
-            doc.metadata['ng_match'] = ng_match
-            doc.metadata['is_PPI_by_classifier'] = 1 if is_PPI_by_classifier is True else 0
-
-        return doc
+        # Rule-based filter -> (該当した場合) PPI classifier
+        return self.apply_batch([doc])[0]
     
     
     
+
+
+### test
+# ng_prefilterの判定が変わりうる境界の例
+NG_PREFILTER_EDGE_CASES = [
+    # NG wordを部分文字列として含むが，MeCabの形態素境界と一致しない (事前判定は通過, MeCab解析で判定)
+    '山田太郎さんは毎日がんばっている。',
+    '山田太郎さんは窃盗罪で逮捕された。',
+    '山田太郎さんは肝炎ウイルスの研究者です。',
+    '山田太郎さんは糖原病Ⅱ型と診断された。',
+    '山田太郎さんはテイ＝サックス病と診断された。',
+    # user辞書の登録語としてのみ1形態素になるNG word (default辞書では分割される)
+    '山田太郎さんはC型肝炎と診断された。',
+    '山田太郎さんはCOVID-19に感染した。',
+    '山田太郎さんは糖原病II型と診断された。',
+    '山田太郎さんはADHDと診断された。',
+    # 全角/半角の表記ゆれ (NG wordと表記が異なるため事前判定で省略され，MeCab解析でも検出されない)
+    '山田太郎さんはＡＤＨＤと診断された。',
+    '山田太郎さんはＣＯＶＩＤ－１９に感染した。',
+    '山田太郎さんはＣ型肝炎と診断された。',
+    '山田太郎さんはテイ=サックス病と診断された。',
+    # 人名とNG wordが別の文, 別の行にある
+    '山田太郎さんは東京に住んでいる。昨日は糖尿病の特集を見た。',
+    '山田太郎さんは東京に住んでいる。\n窃盗事件のニュースが報道された。',
+    '山田　太郎さんは糖尿病です。',
+    # NG word, 人名を含まない
+    '今日は朝から雨が降っていたので、家で本を読んで過ごしました。',
+    '',
+]
+
+def test_ng_prefilter_parity(texts: list):
+    """ng_prefilterの有無で判定結果が変わらないこと, 省略した文書ではMeCab解析でもNG wordが検出されないことを確認する"""
+    ppi_filter = ProtectPersonalInformationRulebaseAndClassifier(add_ppi_info=False, ng_prefilter=True)
+    prefilter_docs = ppi_filter.apply_batch([Document(text) for text in texts])
+    print(f"{ppi_filter.get_counters()=}")
+
+    ppi_filter._ng_prefilter = False
+    docs = ppi_filter.apply_batch([Document(text) for text in texts])
+    for text, prefilter_doc, doc in zip(texts, prefilter_docs, docs):
+        assert prefilter_doc.is_rejected == doc.is_rejected, text
+        if not ppi_filter.contains_NgWords_substring(text):
+            _, ng_type, ng_word, _ = ppi_filter.mecab.scan_fullname_and_NgWords(ppi_filter.mecab.get_parsedNode(text), ppi_filter.mecabUserDicTag2NgTag, ppi_filter.ng_words_db)
+            assert ng_type is None and ng_word is None, text
+    print(f"OK: {len(texts)} texts")
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(description='Check that --ng_prefilter does not change the verdicts (built-in edge cases and an optional jsonl file).')
+    parser.add_argument('--input_file', type=str, help='jsonl file. Default: only the built-in edge cases', required=False, default=None)
+    parser.add_argument('--filter_key', type=str, required=False, default="text")
+    args = parser.parse_args()
+    texts = list(NG_PREFILTER_EDGE_CASES)
+    if args.input_file is not None:
+        with open(args.input_file, 'r', encoding='utf-8') as f:
+            texts += [json.loads(line)[args.filter_key] for line in f]
+    test_ng_prefilter_parity(texts)
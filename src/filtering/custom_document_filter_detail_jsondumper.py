@@ -2,6 +2,7 @@
 
 from datetime import datetime
 import json
+import logging
 from hojichar import document_filters, Document
 import argparse
 import sys
@@ -9,21 +10,93 @@ import os
 import time
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
 
+JSON_BACKENDS = ['json', 'orjson']
+
+
+def get_json_backend(json_backend: str) -> tuple:
+    """jsonのloads, dumps関数を返す. orjsonはoptional dependency (pip install orjson). 利用時のみimportする
+    NOTE: orjsonのdumpsは区切り文字の空白を出力しないため，json.dumpsとは出力のbyte列が異なる (jsonとしては同一)
+    NOTE: orjsonが扱えない行(64bitを超える整数の出力, NaN/Infinityの入力など)は，その行のみjsonのloads, dumpsで処理する.
+          ただし orjson.loads は64bitを超える整数をfloatとして, orjson.dumps はNaN/Infinityをnullとして扱う (errorとならない)
+    Returns:
+        loads: str -> object
+        dumps: object -> str (json.dumps(obj, ensure_ascii=False) 相当)
+    """
+    if json_backend == 'json':
+        return json.loads, lambda obj: json.dumps(obj, ensure_ascii=False)
+    if json_backend == 'orjson':
+        try:
+            import orjson
+        except ImportError as e:
+            raise ImportError("json_backend='orjson' requires the `orjson` package: pip install orjson") from e
+
+        def _loads(text):
+            try:
+                return orjson.loads(text)
+            except orjson.JSONDecodeError:
+                return json.loads(text)
+
+        def _dumps(obj) -> str:
+            try:
+                return orjson.dumps(obj).decode('utf-8')
+            except orjson.JSONEncodeError:
+                return json.dumps(obj, ensure_ascii=False)
+        return _loads, _dumps
+    raise ValueError(f"unknown json_backend: {json_backend}")
+
+
+class JSONLoaderWithBackend(document_filters.JSONLoader):
+    def __init__(self, json_backend='json', *args, **kwargs):
+        """公式JSONLoaderと同じ処理を，json_backend('json' or 'orjson')のloadsで行う"""
+        super().__init__(*args, **kwargs)
+        # NOTE: filterのpublicな属性は統計情報のparamsに出力されるため，_ 付きの属性とする
+        self._loads, _ = get_json_backend(json_backend)
+
+    def apply(self, document: Document) -> Document:
+        """
+        ref: https://hojichar.github.io/HojiChar/hojichar/filters/document_filters.html#JSONLoader
+        """
+        try:
+            data = self._loads(document.text)
+            document.text = str(data[self.key])
+            if self.extra_keys is not None:
+                document.extras = {key: data[key] for key in self.extra_keys if key in data}
+        except Exception as e:
+            logger.error(f"Failed to parsing in JSONLoader. Input document: \n{document.text}")
+            if self.ignore:
+                document.is_rejected = True
+                return document
+            else:
+                raise e
+
+        return document
 
 
 class JSONDumperWithKeepExtras(document_filters.JSONDumper):
-    def __init__(self, main_filter_key:str, dump_reason=False, *args, **kwargs):
+    def __init__(self, main_filter_key:str, dump_reason=False, pass_through=False, json_backend='json', *args, **kwargs):
         """公式JSONDumperは指定したfilterのためのkey以外のkey-valは削除されるため,
         JSONLoaderで指定したextra_keysのkey-valを保持しjson出力するようにする．
+        Args:
+            pass_through: True -> dump_reason=Falseの場合，入力行(Document.original)をそのまま出力する.
+                          json.dumpsを行わず，入力の2行目以降に初めて現れるkeyも保持される
+            json_backend: 'json' or 'orjson' json出力に用いるdumps
         """
         super().__init__(dump_reason=dump_reason, *args, **kwargs)
         self.main_fileter_key = main_filter_key
+        # NOTE: filterのpublicな属性は統計情報のparamsに出力されるため，_ 付きの属性とする
+        self._pass_through = pass_through
+        _, self._dumps = get_json_backend(json_backend)
 
     def apply(self, document: Document) -> Document:
         """
         ref: https://hojichar.github.io/HojiChar/hojichar/filters/document_filters.html#JSONDumper
         """
+        if self._pass_through and not self.dump_reason:
+            document.text = document.original.rstrip("\r\n")     # 入力行(改行を除く)
+            return document
+
         text = document.text
         return_data = {self.main_fileter_key: text}
         return_data.update(document.extras)
@@ -35,7 +108,7 @@ class JSONDumperWithKeepExtras(document_filters.JSONDumper):
                 "filter_reason": document.reject_reason,
             })
 
-        document.text = json.dumps(return_data, ensure_ascii=False)
+        document.text = self._dumps(return_data)
         
         return document
 
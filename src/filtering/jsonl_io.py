@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+# jsonl ファイルの streaming 読み書き
+# 入力ファイル全体をメモリに載せず1行ずつ処理することで，workerあたりのメモリ使用量をファイルサイズに依存させない
+# gzip(.gz), zstd(.zst) 圧縮されたjsonlは展開しながら読み込む. 展開, 圧縮はhelper threadで行い，filter処理(MeCabなど)と並行させる
+
+import os
+import io
+import json
+import gzip
+import queue
+import shutil
+import threading
+
+WRITE_BUFFER_SIZE = 1024 * 1024     # passed_/rejected_ writer のbufferサイズ (1MB)
+READ_BUFFER_SIZE = 1024 * 1024      # 入力fileの読み込みbufferサイズ (1MB). network filesystemなどで1回の読み込み要求の待ち時間の影響を減らす
+CODEC_QUEUE_SIZE = 8                # helper threadとの受け渡しqueueに保持するblock数 (展開済み/圧縮前のデータを最大 約8MB 保持)
+
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+GZIP_COMPRESS_LEVEL = 6             # gzip commandのdefaultと同じ
+ZSTD_COMPRESS_LEVEL = 3             # zstd commandのdefaultと同じ
+
+
+def _import_zstandard():
+    """zstdはoptional dependency (pip install zstandard). 利用時のみimportする"""
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compressed jsonl requires the `zstandard` package: pip install zstandard") from e
+    return zstandard
+
+def detect_compression(input_file: str):
+    """fileの先頭byte(magic number)から圧縮形式を判定する
+    Returns:
+        `str`: 'gzip' or 'zstd'. 圧縮されていない場合はNone
+    """
+    with open(input_file, 'rb') as fp:
+        head = fp.read(4)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+def strip_compression_suffix(filename: str) -> str:
+    """a.jsonl.gz -> a.jsonl (出力ファイル名の作成用)"""
+    for suffix in list(COMPRESSION_SUFFIXES.values()) + ['.zstd']:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def _open_decompressed(input_file: str, compression: str):
+    """展開済みのbyte列を返すbinary file object"""
+    if compression == 'gzip':
+        return gzip.open(input_file, 'rb')
+    if compression == 'zstd':
+        zstandard = _import_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(open(input_file, 'rb'), read_across_frames=True, closefd=True)
+    raise ValueError(f"unknown compression: {compression}")
+
+def _iter_decompressed_lines(input_file: str, compression: str):
+    """圧縮fileを1行ずつ返す generator. 展開と行分割はhelper threadで行い，bounded queueで受け渡す
+    行分割は io.TextIOWrapper (非圧縮fileを open(..., 'r') で読み込む場合と同一)
+    """
+    block_queue = queue.Queue(maxsize=CODEC_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                block_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False    # 読み込み側が終了した
+
+    def _decode():
+        try:
+            with io.TextIOWrapper(_open_decompressed(input_file, compression), encoding='utf-8') as fp:
+                while True:
+                    lines = fp.readlines(WRITE_BUFFER_SIZE)
+                    if not _put(lines) or len(lines) == 0:
+                        return
+        except BaseException as e:
+            _put(e)
+
+    thread = threading.Thread(target=_decode, daemon=True)
+    thread.start()
+    try:
+        while True:
+            lines = block_queue.get()
+            if isinstance(lines, BaseException):
+                raise lines
+            if len(lines) == 0:
+                break
+            yield from lines
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_lines(input_file: str, byte_range=None):
+    """jsonl を1行ずつ返す generator (改行文字は保持)
+    Args:
+        byte_range: (start, end) 指定した場合はbyte範囲[start, end)に含まれる行のみを返す. startは行頭であること. 非圧縮fileのみ
+    Returns:
+        `generator`: str
+    """
+    compression = detect_compression(input_file)
+    if compression is not None:
+        if byte_range is not None:
+            raise ValueError(f"byte_range is not supported for {compression} compressed file: {input_file}")
+        yield from _iter_decompressed_lines(input_file, compression)
+        return
+
+    if byte_range is None:
+        with open(input_file, 'r', encoding='utf-8', buffering=READ_BUFFER_SIZE) as fp:
+            for line in fp:
+                yield line
+        return
+
+    start, end = byte_range
+    with open(input_file, 'rb', buffering=READ_BUFFER_SIZE) as fp:
+        fp.seek(start)
+        pos = start
+        while pos < end:
+            line = fp.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+def split_line_aligned_ranges(input_file: str, chunk_size: int) -> list:
+    """fileを約chunk_size byteごとのbyte範囲に分割する. 各範囲の開始位置は行頭に揃える
+    Returns:
+        `list`: [(start, end), ...] ファイル先頭から順に並ぶ
+    """
+    file_size = os.path.getsize(input_file)
+    offsets = [0]
+    with open(input_file, 'rb') as fp:
+        while offsets[-1] + chunk_size < file_size:
+            fp.seek(offsets[-1] + chunk_size)
+            fp.readline()   # 行の途中から次の行頭まで進める
+            pos = fp.tell()
+            if pos >= file_size:
+                break
+            offsets.append(pos)
+    offsets.append(file_size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def concat_files(input_files: list, output_file: str, remove_inputs=True):
+    """分割して処理したchunkごとの出力ファイルを順に連結する
+    NOTE: gzip member, zstd frameを連結したfileもそれぞれ1つの圧縮fileとして展開できるため，圧縮出力もbyte列のまま連結する
+    """
+    with open(output_file, 'wb') as writer:
+        for path in input_files:
+            with open(path, 'rb') as fp:
+                shutil.copyfileobj(fp, writer, WRITE_BUFFER_SIZE)
+            if remove_inputs:
+                os.remove(path)
+
+def read_head_line(input_file: str):
+    """先頭行のみを読み込む. 空ファイルの場合はNone"""
+    compression = detect_compression(input_file)
+    if compression is None:
+        fp = open(input_file, 'r', encoding='utf-8')
+    else:
+        fp = io.TextIOWrapper(_open_decompressed(input_file, compression), encoding='utf-8')
+    with fp:
+        line = fp.readline()
+    return line if len(line) > 0 else None
+
+def open_writer(output_file: str, compression=None, append=False):
+    """buffer付きのwriterを返す. 1行ごとのwriteでsyscallが発生しないようにする
+    Args:
+        compression: None, 'gzip', 'zstd'. 圧縮する場合，圧縮とfileへの書き込みはhelper threadで行う (CompressedWriter)
+        append: True -> 既存fileの末尾に追記する (中断した処理の再開用)
+    """
+    if compression is None:
+        return open(output_file, 'a' if append else 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+    return CompressedWriter(output_file, compression, append=append)
+
+def sync_writer(writer) -> int:
+    """writerに書き込んだ内容をすべてfileに反映(fsync)し，file sizeを返す
+    圧縮出力の場合はgzip member, zstd frameを終端するため，返したsizeで切り詰めたfileも完全な圧縮fileとして展開できる
+    """
+    if isinstance(writer, CompressedWriter):
+        return writer.sync()
+    writer.flush()
+    os.fsync(writer.fileno())
+    return os.path.getsize(writer.name)
+
+def truncate_file(output_file: str, size: int) -> bool:
+    """fileをsize byteに切り詰める (sync_writerで記録したsize以降の書き込みを破棄する)
+    Returns:
+        bool: False -> fileが存在しない, またはsizeより小さい (記録した時点の内容が失われている)
+    """
+    if not os.path.exists(output_file) or os.path.getsize(output_file) < size:
+        return False
+    os.truncate(output_file, size)
+    return True
+
+
+class CompressedWriter(object):
+    def __init__(self, output_file: str, compression: str, append=False) -> None:
+        """write()されたstrをWRITE_BUFFER_SIZEごとにhelper threadへ渡し，helper threadでutf-8 encode, 圧縮, 書き込みを行う
+        Args:
+            compression: 'gzip' or 'zstd'
+            append: True -> 既存fileの末尾に新しいgzip member, zstd frameとして追記する
+        """
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"unknown compression: {compression}")
+        if compression == 'zstd':
+            _import_zstandard()     # 未installの場合はthread作成前にerrorとする
+        self._buffer = []
+        self._buffer_size = 0
+        self._queue = queue.Queue(maxsize=CODEC_QUEUE_SIZE)
+        self._error = None
+        self._closed = False
+        self.name = output_file
+        self._thread = threading.Thread(target=self._compress, args=(output_file, compression, append), daemon=True)
+        self._thread.start()
+
+    def _open_compressor(self, fp, compression: str):
+        if compression == 'gzip':
+            return gzip.GzipFile(filename='', mode='wb', fileobj=fp, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0)   # 出力を再現可能にするためheaderにfile名, 時刻を含めない
+        zstandard = _import_zstandard()
+        return zstandard.ZstdCompressor(level=ZSTD_COMPRESS_LEVEL).stream_writer(fp, closefd=False)
+
+    def _compress(self, output_file: str, compression: str, append: bool):
+        try:
+            with open(output_file, 'ab' if append else 'wb') as fp:
+                writer = self._open_compressor(fp, compression)
+                while True:
+                    block = self._queue.get()
+                    if block is None:
+                        writer.close()
+                        return
+                    if isinstance(block, threading.Event):
+                        # sync: 現在のmember/frameを終端してfsyncし，以降は新しいmember/frameに書き込む
+                        writer.close()
+                        fp.flush()
+                        os.fsync(fp.fileno())
+                        writer = self._open_compressor(fp, compression)
+                        block.set()
+                        continue
+                    writer.write(block.encode('utf-8'))
+        except BaseException as e:
+            self._error = e
+            while True:     # close()まで受け取りを続け，書き込み側がqueueで停止しないようにする
+                block = self._queue.get()
+                if block is None:
+                    break
+                if isinstance(block, threading.Event):
+                    block.set()
+
+    def _flush_buffer(self):
+        if len(self._buffer) > 0:
+            self._queue.put(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+
+    def write(self, text: str) -> int:
+        self._buffer.append(text)
+        self._buffer_size += len(text)
+        if self._buffer_size >= WRITE_BUFFER_SIZE:
+            self._flush_buffer()
+        return len(text)
+
+    def sync(self) -> int:
+        """bufferの内容をすべて圧縮してfileに反映(fsync)し，file sizeを返す (sync_writer)"""
+        self._flush_buffer()
+        synced = threading.Event()
+        self._queue.put(synced)
+        synced.wait()
+        if self._error is not None:
+            raise self._error
+        return os.path.getsize(self.name)
+
+    def close(self):
+        """残りのbufferを書き込み，helper threadの終了を待つ. helper threadで発生したerrorはここで送出する"""
+        if self._closed:
+            return
+        self._closed = True
+        self._flush_buffer()
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+### test
+def test_streaming_rss(tmp_dir='/tmp/jsonl_io_test', size_gb=2.0, rss_limit_mb=256, n_unique_docs=10000):
+    """数GBの合成jsonlを process_protect_PI_ja_keep_kv (MeCab, 分類器を含むfilter処理) で処理し，RSSの増加量が一定以下に収まることを確認する
+    分類器は benchmark_filter.build_standin_pipeline で作成したstand-in pipelineを用いる.
+    RSSは処理中に別threadで現在値(/proc/self/statm)を取得し，処理前(分類器, MeCabの読み込み後)からの増加量の最大値を判定する
+    Args:
+        n_unique_docs: 合成する文書数. 入力fileはsize_gbに達するまでこれらの文書を繰り返し書き出す
+    """
+    import sys
+    import argparse
+    from pathlib import Path
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    from filtering.benchmark_filter import SyntheticCorpusGenerator, PeakRSSMonitor, build_standin_pipeline, get_process_tree_rss
+    from filtering import respect_PI_filter
+    from filtering.overlapped_io import IO_QUEUE_SIZE
+
+    input_dir = os.path.join(tmp_dir, 'input')
+    output_dir = os.path.join(tmp_dir, 'output')
+    os.makedirs(input_dir, exist_ok=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    generator = SyntheticCorpusGenerator(seed=0)
+    lines = [json.dumps({'text': generator.generate()[0], 'id': i}, ensure_ascii=False) + '\n' for i in range(n_unique_docs)]
+    input_file = os.path.join(input_dir, 'synthetic.jsonl')
+    n_lines = 0
+    with open_writer(input_file) as writer:
+        while n_lines == 0 or os.path.getsize(input_file) < size_gb * 1024**3:
+            for line in lines:
+                writer.write(line)
+            n_lines += len(lines)
+            writer.flush()
+    del lines
+
+    model_path = build_standin_pipeline(os.path.join(tmp_dir, 'standin_NB_pipeline.pkl'), seed=1)
+    respect_PI_filter.init_worker(model_path=model_path)
+    args = argparse.Namespace(input_dir=input_dir, output_dir=output_dir, filter_key='text', skip_rejected=False, dump_reason=False,
+                              pass_through=False, json_backend='json', output_compression=None, model_path=model_path, verdict_column=None,
+                              batch_size=256, batch_timeout=1.0, io_queue_size=IO_QUEUE_SIZE, checkpoint_interval=60, resume=False)
+
+    base_rss, _ = get_process_tree_rss(os.getpid())
+    with PeakRSSMonitor(os.getpid()) as monitor:
+        stats, _, _, _ = respect_PI_filter.process_protect_PI_ja_keep_kv(('synthetic.jsonl', None, args))
+    rss_increase_mb = (monitor.peak_process_rss - base_rss) / 1024**2
+    print(f'{n_lines=}, input={os.path.getsize(input_file) / 1024**3:.2f} GB, base_rss={base_rss / 1024**2:.1f} MB, '
+          f'peak_rss={monitor.peak_process_rss / 1024**2:.1f} MB, {rss_increase_mb=:.1f} MB')
+    assert stats.total_info.processed_num == n_lines
+    assert rss_increase_mb < rss_limit_mb, f'RSS increased by {rss_increase_mb:.1f} MB'
+
+    os.remove(input_file)
+    shutil.rmtree(output_dir)
+
+
+def test_compressed_roundtrip(tmp_dir='/tmp/jsonl_io_test', n_lines=100000):
+    """圧縮形式ごとに，open_writerで書き込んだfileをiter_linesで読み込み，非圧縮と同じ行が得られることを確認する"""
+    os.makedirs(tmp_dir, exist_ok=True)
+    lines = [json.dumps({'text': f'山田太郎は東京都に住んでいます。{i}', 'id': i}, ensure_ascii=False) + '\n' for i in range(n_lines)]
+    compressions = ['gzip']
+    try:
+        _import_zstandard()
+        compressions.append('zstd')
+    except ImportError:
+        print('skip zstd: zstandard is not installed')
+
+    for compression in compressions:
+        output_file = os.path.join(tmp_dir, 'roundtrip.jsonl' + COMPRESSION_SUFFIXES[compression])
+        # 2つのwriterの出力を連結したfile (chunkごとの出力を連結する場合と同様)
+        part_files = [output_file + f'.part{i}' for i in range(2)]
+        for part_file, part_lines in zip(part_files, [lines[:n_lines // 2], lines[n_lines // 2:]]):
+            with open_writer(part_file, compression) as writer:
+                for line in part_lines:
+                    writer.write(line)
+        concat_files(part_files, output_file)
+
+        assert detect_compression(output_file) == compression
+        # sync時点のsizeで切り詰めたfileは，sync時点までの行を持つ圧縮fileとして展開できる
+        with open_writer(output_file, compression, append=True) as writer:
+            synced_size = sync_writer(writer)
+            writer.write('途中で破棄される行\n')
+        truncate_file(output_file, synced_size)
+        assert read_head_line(output_file) == lines[0]
+        assert list(iter_lines(output_file)) == lines
+        for _ in iter_lines(output_file):   # 途中で読み込みを終了してもhelper threadが停止すること
+            break
+        os.remove(output_file)
+        print(f'OK: {compression}')
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Check that filtering a multi-GB synthetic jsonl keeps the RSS increase bounded.')
+    parser.add_argument('--tmp_dir', type=str, required=False, default='/tmp/jsonl_io_test')
+    parser.add_argument('--size_gb', type=float, help='Size of the synthetic input file', required=False, default=2.0)
+    parser.add_argument('--rss_limit_mb', type=float, help='Allowed RSS increase over the baseline after loading the filter', required=False, default=256)
+    args = parser.parse_args()
+    test_streaming_rss(args.tmp_dir, args.size_gb, args.rss_limit_mb)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# 読み込み, filter処理(compute), 書き込みを別threadで並行させる
+# - reader thread: 入力行の読み込み, micro-batchへの分割 (PrefetchReader). Parquet/Arrowの場合はrecord batchの読み込み
+# - compute: 呼び出し元のthread. MeCab解析, 分類器などfilter処理
+# - writer thread: passed_/rejected_ への書き込み, checkpointでのfsync (BatchWriter, ParquetBatchWriter(columnar_io))
+# stage間はbatch単位のbounded queueで受け渡す. 遅いstageがあると前のstageはqueueが空くまで待つ(backpressure)ため，メモリ使用量はqueueの長さで抑えられる
+# ディスク, network filesystemの読み書きで待つ間もfilter処理を続けられる (file I/OはGILを解放する)
+
+import queue
+import threading
+import time
+
+from filtering.stage_profiler import StageProfiler
+
+IO_QUEUE_SIZE = 8   # stage間のqueueに保持するbatch数
+
+
+class QueueDepthStats(object):
+    def __init__(self) -> None:
+        """compute threadがqueueからbatchを受け取る, queueにbatchを渡す時点のqueueの長さの記録
+        queues: {queue名: {"samples": 記録回数, "depth_sum": 長さの合計, "empty_num": 空だった回数, "full_num": 満杯だった回数, "capacity": queueの最大長}}
+        - read_queue が空であることが多い -> 読み込みが律速
+        - write_queue が満杯であることが多い -> 書き込みが律速
+        - read_queue が満杯, write_queue が空であることが多い -> filter処理(compute)が律速
+        """
+        self.queues = {}
+
+    def record(self, queue_name: str, depth: int, capacity: int):
+        queue_info = self.queues.setdefault(queue_name, {"samples": 0, "depth_sum": 0, "empty_num": 0, "full_num": 0, "capacity": capacity})
+        queue_info["samples"] += 1
+        queue_info["depth_sum"] += depth
+        queue_info["empty_num"] += int(depth == 0)
+        queue_info["full_num"] += int(depth >= capacity)
+
+    def merge(self, other):
+        """otherの記録を合算する"""
+        for queue_name, other_info in other.queues.items():
+            queue_info = self.queues.setdefault(queue_name, {"samples": 0, "depth_sum": 0, "empty_num": 0, "full_num": 0, "capacity": other_info["capacity"]})
+            for key in ["samples", "depth_sum", "empty_num", "full_num"]:
+                queue_info[key] += other_info[key]
+            queue_info["capacity"] = max(queue_info["capacity"], other_info["capacity"])
+        return self
+
+    def get_human_readable_values(self) -> dict:
+        """stat_ファイルへの出力用
+        Returns:
+            `dict`: {queue名: {"capacity", "mean_depth", "empty_ratio", "full_ratio"}}
+        """
+        values = {}
+        for queue_name, queue_info in self.queues.items():
+            samples = max(queue_info["samples"], 1)
+            values[queue_name] = {
+                "capacity": queue_info["capacity"],
+                "mean_depth": queue_info["depth_sum"] / samples,
+                "empty_ratio": queue_info["empty_num"] / samples,
+                "full_ratio": queue_info["full_num"] / samples,
+            }
+        return values
+
+    def to_dict(self) -> dict:
+        """json保存可能なdict (from_dictで復元)"""
+        return {queue_name: dict(queue_info) for queue_name, queue_info in self.queues.items()}
+
+    @classmethod
+    def from_dict(cls, queues_dict: dict):
+        queue_stats = cls()
+        queue_stats.queues = {queue_name: dict(queue_info) for queue_name, queue_info in queues_dict.items()}
+        return queue_stats
+
+
+def _put_until_stopped(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """queueが空くまで待ってitemを渡す. 受け取り側が終了した(stop)場合はFalse"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class PrefetchReader(object):
+    def __init__(self, batches, profiler: StageProfiler, queue_stats: QueueDepthStats, queue_size=IO_QUEUE_SIZE) -> None:
+        """batchesをreader threadで読み込み，最大queue_size個のbatchを先読みする. iterで得られるbatchはbatchesと同一
+        Args:
+            batches: batch(len()で文書数が得られるもの)のiterator. e.g. iter_micro_batches(iter_lines(...), batch_size, batch_timeout)
+            profiler: compute threadのStageProfiler. batchごとに以下を記録する
+                      read: reader threadでbatchの読み込みにかかった時間, read_wait: compute threadがbatchを待った時間
+            queue_stats: batchを受け取る時点のqueueの長さを "read_queue" として記録する
+        """
+        self._batches = batches
+        self._profiler = profiler
+        self._queue_stats = queue_stats
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while True:
+                s_time_ns = time.perf_counter_ns()
+                batch = next(self._batches, None)
+                if batch is None:
+                    _put_until_stopped(self._queue, None, self._stop)
+                    return
+                if not _put_until_stopped(self._queue, (batch, time.perf_counter_ns() - s_time_ns), self._stop):
+                    return
+        except BaseException as e:
+            _put_until_stopped(self._queue, e, self._stop)
+        finally:
+            if hasattr(self._batches, 'close'):
+                self._batches.close()   # generatorを終了し，入力file, 圧縮fileのhelper threadなどを閉じる
+
+    def __iter__(self):
+        while True:
+            self._queue_stats.record("read_queue", self._queue.qsize(), self._queue.maxsize)
+            s_time_ns = time.perf_counter_ns()
+            item = self._queue.get()
+            wait_ns = time.perf_counter_ns() - s_time_ns
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            batch, read_ns = item
+            self._profiler.add_batch("read", read_ns, len(batch))
+            self._profiler.add_batch("read_wait", wait_ns, len(batch))
+            yield batch
+
+    def close(self):
+        """reader threadを終了する (読み込みの途中で終了する場合も含む)"""
+        self._stop.set()
+        self._thread.join()
+
+
+class BatchWriter(object):
+    def __init__(self, writers: dict, skip_rejected: bool, profiler: StageProfiler, queue_stats: QueueDepthStats,
+                 queue_size=IO_QUEUE_SIZE) -> None:
+        """filter処理済みのbatchをwriter threadでpassed_/rejected_に書き込む. writersはwriter threadのみが操作する
+        Args:
+            writers: {"passed": writer, "rejected": writer} (open_writer). skip_rejected=Trueの場合は "passed" のみ
+            profiler: compute threadのStageProfiler. batchを渡すまでに待った時間を write_wait として記録する
+            queue_stats: batchを渡す時点のqueueの長さを "write_queue" として記録する
+        """
+        self._writers = writers
+        self._skip_rejected = skip_rejected
+        self._profiler = profiler
+        self._queue_stats = queue_stats
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+        self.write_profiler = StageProfiler()   # writer threadで記録する書き込み時間 (write). close()後, checkpointのcallback内で参照する
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    self._close_writers()
+                    return
+                if callable(item):
+                    item()
+                    continue
+                doc_num, payload = item
+                with self.write_profiler.measure("write", doc_num):
+                    self._write_payload(payload)
+        except BaseException as e:
+            self._error = e
+            try:
+                self._close_writers()   # 圧縮fileのhelper thread, file descriptorを残さない. errorは最初のもの(self._error)を送出する
+            except BaseException:
+                pass
+            while self._queue.get() is not None:    # close()まで受け取りを続け，compute threadがqueueで停止しないようにする
+                continue
+
+    def _close_writers(self):
+        """writer threadで呼び出す. 全writerを閉じる (途中のwriterの失敗で残りのwriterを閉じないままにしない). 最初のerrorを送出する"""
+        error = None
+        for writer in self._writers.values():
+            try:
+                writer.close()
+            except BaseException as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def _write_payload(self, payload):
+        """writer threadで呼び出す. payload: [(is_rejected, text), ...]"""
+        for is_rejected, text in payload:
+            if is_rejected is True:
+                if self._skip_rejected is False:
+                    self._writers["rejected"].write(text + "\n")
+            else:
+                self._writers["passed"].write(text + "\n")
+
+    def _put(self, item):
+        if self._error is not None:
+            raise self._error
+        self._queue_stats.record("write_queue", self._queue.qsize(), self._queue.maxsize)
+        s_time_ns = time.perf_counter_ns()
+        self._queue.put(item)
+        return time.perf_counter_ns() - s_time_ns
+
+    def write_batch(self, results: list):
+        """
+        Args:
+            results: list(Document) filter処理済みの文書 (入力順)
+        """
+        payload = [(result.is_rejected, result.text) for result in results]
+        self._profiler.add_batch("write_wait", self._put((len(payload), payload)), len(payload))
+
+    def checkpoint(self, callback):
+        """それまでに渡したbatchの書き込み後，writer threadでcallback(writers)を呼び出す (出力のfsync, 進捗の記録)"""
+        self._put(lambda: callback(self._writers))
+
+    def close(self):
+        """残りのbatchを書き込んでwriterを閉じ，writer threadの終了を待つ. writer threadで発生したerrorはここで送出する"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# 要配慮個人情報フィルタのlibrary API
+# respect_PI_filter.py(CLI)を介さずに，Pythonのprogramからtext(str)のlistに対する判定結果を得る
+# hojichar Compose, Document, jsonの読み書きを用いず，ProtectPersonalInformationRulebaseAndClassifierのbatch処理(get_verdicts)を直接呼び出す
+#
+# usage:
+#   sys.path.append("<project>/src")
+#   from filtering.ppi_filter import PPIFilter
+#   ppi_filter = PPIFilter.load()
+#   verdicts = ppi_filter.filter_batch(["本文1", "本文2"])     # [False, True] True: 要配慮個人情報を含む
+#   for text, is_rejected in ppi_filter.filter_iter(texts):   # 任意のiterable (generator, file)を一定件数ずつ判定する
+#       ...
+
+import sys
+from pathlib import Path
+
+### SRC
+SRC_PATH = str(Path(__file__).resolve().parents[1])
+sys.path.append(SRC_PATH)
+
+from filtering.custom_document_filter_PPI_rule_and_classifier import ProtectPersonalInformationRulebaseAndClassifier
+from filtering.custom_batch_compose import iter_micro_batches
+
+DEFAULT_BATCH_SIZE = 256    # filter_iterで1回に判定するtext数 (respect_PI_filter.py --batch_size と同じ)
+
+
+class PPIFilter(object):
+    def __init__(self, ppi_filter: ProtectPersonalInformationRulebaseAndClassifier, batch_size=DEFAULT_BATCH_SIZE) -> None:
+        """PPIFilter.load() で作成する
+        Args:
+            ppi_filter: add_ppi_info=Falseで作成したfilter
+            batch_size: filter_iterで1回に判定するtext数
+        """
+        if ppi_filter.add_ppi_info:
+            raise ValueError("PPIFilter requires a filter created with add_ppi_info=False")
+        self._ppi_filter = ppi_filter
+        self.batch_size = batch_size
+
+    @classmethod
+    def load(cls, model_path=None, ng_prefilter=True, verdict_cache_size=0, verdict_cache_db=None, batch_size=DEFAULT_BATCH_SIZE):
+        """分類器, MeCab, NGワードDBを読み込む (1回のみ行い，以降の判定で使い回す)
+        Args:
+            model_path: 訓練済みpipeline(pickle, またはcompact modelのdirectory)のpath. None -> src/PPI_classifier/models/NB_pipeline_202503.pkl
+            ng_prefilter: NG wordを文字列として含まないtextはMeCab解析を省略する (判定結果は同一)
+            verdict_cache_size, verdict_cache_db: 同じtextの判定結果のcache (respect_PI_filter.py の --verdict_cache_size, --verdict_cache_db)
+            batch_size: filter_iterで1回に判定するtext数
+        Returns:
+            `PPIFilter`
+        """
+        ppi_filter = ProtectPersonalInformationRulebaseAndClassifier(add_ppi_info=False, ng_prefilter=ng_prefilter, model_path=model_path,
+                                                                     verdict_cache_size=verdict_cache_size, verdict_cache_db=verdict_cache_db)
+        return cls(ppi_filter, batch_size=batch_size)
+
+    def filter_batch(self, texts: list) -> list:
+        """
+        Args:
+            texts: list(str)
+        Returns:
+            `list`: [bool, ...] 入力順. True: 要配慮個人情報を含む (respect_PI_filter.py で rejected_ に出力される), False: 含まない (passed_)
+        """
+        return self._ppi_filter.get_verdicts(list(texts))
+
+    def filter_iter(self, texts, batch_size=None, flush_timeout=None):
+        """textsをbatch_size件ずつ判定し，判定結果を入力順に返す generator. 全体をメモリに載せずに処理する
+        Args:
+            texts: iterable(str)
+            batch_size: None -> PPIFilter.load() で指定したbatch_size
+            flush_timeout: batchの先頭のtextを受け取ってからこの秒数が経過した場合，次のtextが届いていなくても(batch_size件に満たなくても)判定して返す (入力が遅いstream用).
+                           textsは別threadで読み込む (iter_micro_batches). None: batch_size件そろうかtextsが終わるまで判定しない
+        Returns:
+            `generator`: (text, is_rejected: bool)
+        """
+        for batch in iter_micro_batches(texts, batch_size or self.batch_size, flush_timeout):
+            yield from zip(batch, self._ppi_filter.get_verdicts(batch))
+
+    def get_counters(self) -> dict:
+        """reset_counters()以降の処理件数 (ng_prefilterで省略した文書数, verdict cacheのhit数など)"""
+        return self._ppi_filter.get_counters()
+
+    def get_stage_profiler(self):
+        """reset_counters()以降の処理段階ごとの処理時間 (StageProfiler)"""
+        return self._ppi_filter.get_stage_profiler()
+
+    def reset_counters(self):
+        self._ppi_filter.reset_counters()
+
+
+### test
+def test_parity(texts: list, batch_size=64):
+    """filter_batch, filter_iterの判定結果が ProtectPersonalInformationRulebaseAndClassifier.apply() (Document) と同一であること"""
+    import threading
+    from hojichar import Document
+    ppi_filter = PPIFilter.load(batch_size=batch_size)
+    reference = ProtectPersonalInformationRulebaseAndClassifier(add_ppi_info=False)
+    expected = [reference.apply(Document(text)).is_rejected for text in texts]
+    assert ppi_filter.filter_batch(texts) == expected
+    assert [is_rejected for _, is_rejected in ppi_filter.filter_iter(iter(texts))] == expected
+    assert [text for text, _ in ppi_filter.filter_iter(iter(texts))] == texts
+    assert ppi_filter.filter_batch([]) == []
+
+    # flush_timeout: 次のtextが届かない間も，受け取り済みのtextの判定結果を返すこと
+    if len(texts) >= 2:
+        received = threading.Event()
+        def _slow_stream():
+            yield from texts[:2]
+            assert received.wait(timeout=10), "filter_iter did not flush before the next text arrived"
+            yield from texts[2:]
+        verdicts = []
+        for _, is_rejected in ppi_filter.filter_iter(_slow_stream(), flush_timeout=0.1):
+            verdicts.append(is_rejected)
+            if len(verdicts) == 2:
+                received.set()
+        assert verdicts == expected
+    print(f"OK: {len(texts)} texts, {sum(expected)} rejected. {ppi_filter.get_counters()=}")
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(description='Check PPIFilter verdicts against the hojichar filter.')
+    parser.add_argument('--input_file', type=str, help='jsonl file', required=True)
+    parser.add_argument('--filter_key', type=str, required=False, default="text")
+    args = parser.parse_args()
+    with open(args.input_file, 'r', encoding='utf-8') as f:
+        test_parity([json.loads(line)[args.filter_key] for line in f])
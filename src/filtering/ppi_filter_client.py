@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# 要配慮個人情報フィルタserver(ppi_filter_server.py)のclient
+# 判定器, MeCabを読み込まないため，filterを実行しないprocessからも軽量に利用できる
+#
+# protocol: Unix domain socket上で1行1つのjson (utf-8, 改行区切り). 1つの接続で複数のrequestを順に送ることができる
+#   request: {"texts": [str, ...]}  -> response: {"verdicts": [bool, ...]} 入力順. True: 要配慮個人情報を含む (rejected)
+#   request: {"op": "ping"}         -> response: {"ok": true, "n_workers": int}
+#   request: {"op": "stats"}        -> response: {"requests": int, "docs": int, "errors": int, "uptime_sec": float}
+#   errorの場合                     -> response: {"error": str}
+#
+# usage:
+#   with PPIFilterClient("/tmp/ppi_filter.sock") as client:
+#       verdicts = client.filter_batch(["本文1", "本文2"])
+
+import json
+import socket
+import itertools
+
+DEFAULT_SOCKET_PATH = "/tmp/ppi_filter.sock"
+DEFAULT_BATCH_SIZE = 256    # filter_iterで1回のrequestに含めるtext数
+MAX_LINE_BYTES = 64 * 1024**2   # 1行(request, response)の最大byte数
+
+
+def encode_message(message: dict) -> bytes:
+    """1行のjson. textに含まれるsurrogateもそのまま送受信できるようにsurrogatepassとする"""
+    return json.dumps(message, ensure_ascii=False).encode('utf-8', 'surrogatepass') + b"\n"
+
+def decode_message(line: bytes) -> dict:
+    return json.loads(line.decode('utf-8', 'surrogatepass'))
+
+
+class PPIFilterClient(object):
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=None) -> None:
+        """serverへの接続は最初のrequestで作成し，以降のrequestで使い回す. 1つのclientを複数threadで共有しないこと
+        Args:
+            socket_path: serverのUnix domain socketのpath
+            timeout: 接続, responseを待つ秒数. None -> 待ち続ける
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+            self._file = sock.makefile('rwb')
+
+    def _request(self, request: dict) -> dict:
+        self._connect()
+        try:
+            self._file.write(encode_message(request))
+            self._file.flush()
+            line = self._file.readline(MAX_LINE_BYTES + 1)
+        except OSError:
+            self.close()
+            raise
+        if not line.endswith(b"\n"):
+            self.close()
+            raise ConnectionError(f"connection closed by the server: {self.socket_path}")
+        response = decode_message(line)
+        if "error" in response:
+            raise RuntimeError(f"ppi filter server error: {response['error']}")
+        return response
+
+    def filter_batch(self, texts: list) -> list:
+        """
+        Args:
+            texts: list(str)
+        Returns:
+            `list`: [bool, ...] 入力順. True: 要配慮個人情報を含む (PPIFilter.filter_batch と同じ)
+        """
+        return self._request({"texts": list(texts)})["verdicts"]
+
+    def filter_iter(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        """textsをbatch_size件ずつのrequestで判定する generator
+        Returns:
+            `generator`: (text, is_rejected: bool)
+        """
+        texts = iter(texts)
+        while True:
+            batch = list(itertools.islice(texts, batch_size))
+            if len(batch) == 0:
+                return
+            yield from zip(batch, self.filter_batch(batch))
+
+    def ping(self) -> dict:
+        return self._request({"op": "ping"})
+
+    def stats(self) -> dict:
+        return self._request({"op": "stats"})
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+            finally:
+                self._sock.close()
+                self._sock, self._file = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description='Send texts (one per line on stdin) to the ppi filter server and print the verdicts.')
+    parser.add_argument('--socket_path', type=str, help='Unix domain socket of ppi_filter_server.py', required=False, default=DEFAULT_SOCKET_PATH)
+    parser.add_argument('--batch_size', type=int, help='Texts per request', required=False, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+    with PPIFilterClient(args.socket_path) as client:
+        for text, is_rejected in client.filter_iter((line.rstrip("\n") for line in sys.stdin), batch_size=args.batch_size):
+            print(json.dumps({"text": text, "is_rejected": is_rejected}, ensure_ascii=False))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# 要配慮個人情報フィルタのserver (daemon)
+# 判定器の読み込み, MeCab taggerの作成を起動時に1回だけ行い，Unix domain socketで判定requestを受け付ける
+# - worker process: 起動時に全workerでPPIFilterを読み込み(pre-warm)，読み込みが完了してから接続を受け付ける
+# - 接続ごとにthreadでrequestを受け取り，textsをbatch_size件ずつに分けてworkerで並列に判定する
+# - protocolは ppi_filter_client.py を参照
+#
+# python ppi_filter_server.py --socket_path /tmp/ppi_filter.sock --n_workers 4
+# echo "本文" | python ppi_filter_client.py --socket_path /tmp/ppi_filter.sock
+
+import argparse
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+### SRC
+SRC_PATH = str(Path(__file__).resolve().parents[1])
+sys.path.append(SRC_PATH)
+
+from filtering.ppi_filter_client import encode_message, decode_message, DEFAULT_SOCKET_PATH, MAX_LINE_BYTES
+from filtering.ppi_filter import DEFAULT_BATCH_SIZE
+
+WARMUP_TIMEOUT = 600    # 秒. 全workerの判定器の読み込みを待つ時間
+
+
+# worker process単位で保持するPPIFilter
+_PPI_FILTER = None
+
+def init_worker(ready_queue, model_path=None, ng_prefilter=True, verdict_cache_size=0, verdict_cache_db=None):
+    """ProcessPoolExecutorのinitializer. 判定器, MeCab, NGワードDBを読み込み，完了をready_queueに通知する"""
+    global _PPI_FILTER
+    from filtering.ppi_filter import PPIFilter
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl-C(process group全体へのSIGINT)ではserverのみが停止処理を行い，workerは処理中のrequestを終える
+    _PPI_FILTER = PPIFilter.load(model_path=model_path, ng_prefilter=ng_prefilter, verdict_cache_size=verdict_cache_size, verdict_cache_db=verdict_cache_db)
+    ready_queue.put(os.getpid())
+
+def filter_texts(texts: list) -> list:
+    """worker processで実行する"""
+    return _PPI_FILTER.filter_batch(texts)
+
+def _noop():
+    return os.getpid()
+
+
+class PPIFilterWorkerPool(object):
+    def __init__(self, n_workers: int, batch_size=DEFAULT_BATCH_SIZE, model_path=None, ng_prefilter=True, verdict_cache_size=0, verdict_cache_db=None) -> None:
+        """判定を行うworker processのpool. 全workerの読み込みが完了するまで待つ
+        Args:
+            batch_size: 1回にworkerへ渡すtext数. これより多いtextsは分割して複数のworkerで並列に判定する
+            model_path, ng_prefilter, verdict_cache_size, verdict_cache_db: PPIFilter.load() の引数
+        """
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        ready_queue = multiprocessing.get_context().Queue()
+        self._executor = ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                                             initargs=(ready_queue, model_path, ng_prefilter, verdict_cache_size, verdict_cache_db))
+        self._warmup(ready_queue)
+
+    def _warmup(self, ready_queue):
+        """n_workers個のtaskを投入してworker processを起動し，全workerのinitializerの完了を待つ"""
+        futures = [self._executor.submit(_noop) for _ in range(self.n_workers)]
+        ready_pids = set()
+        deadline = time.monotonic() + WARMUP_TIMEOUT
+        while len(ready_pids) < self.n_workers:
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()    # initializerの失敗 (BrokenProcessPool)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"workers are not ready after {WARMUP_TIMEOUT} sec: {len(ready_pids)}/{self.n_workers}")
+            try:
+                ready_pids.add(ready_queue.get(timeout=1.0))
+            except queue.Empty:
+                continue
+        for future in futures:
+            future.result()
+        print(f"warmed up {len(ready_pids)} workers: pids={sorted(ready_pids)}")
+
+    def filter_batch(self, texts: list) -> list:
+        """textsをbatch_size件ずつworkerで判定する. 複数threadから同時に呼び出してよい
+        Returns:
+            `list`: [bool, ...] 入力順
+        """
+        futures = [self._executor.submit(filter_texts, texts[start:start + self.batch_size]) for start in range(0, len(texts), self.batch_size)]
+        verdicts = []
+        for future in futures:
+            verdicts.extend(future.result())
+        return verdicts
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class PPIFilterRequestHandler(socketserver.StreamRequestHandler):
+    """1つの接続のrequestを順に処理する (接続ごとのthread)"""
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_LINE_BYTES + 1)
+            if len(line) == 0:
+                return  # clientが接続を閉じた
+            if not line.endswith(b"\n"):
+                self._send({"error": f"request line exceeds {MAX_LINE_BYTES} bytes"})
+                return
+            self._send(self.server.handle_request_message(line))
+
+    def _send(self, response: dict):
+        self.wfile.write(encode_message(response))
+        self.wfile.flush()
+
+
+class PPIFilterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, worker_pool: PPIFilterWorkerPool) -> None:
+        self.worker_pool = worker_pool
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "docs": 0, "errors": 0}
+        self._s_time = time.time()
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, PPIFilterRequestHandler)
+
+    def handle_request_message(self, line: bytes) -> dict:
+        """request(1行のjson) -> response"""
+        try:
+            request = decode_message(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a json object")
+            op = request.get("op", "filter")
+            if op == "ping":
+                return {"ok": True, "n_workers": self.worker_pool.n_workers}
+            if op == "stats":
+                with self._stats_lock:
+                    return dict(self._stats, uptime_sec=time.time() - self._s_time)
+            if op != "filter":
+                raise ValueError(f"unknown op: {op}")
+            texts = request.get("texts")
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                raise ValueError("`texts` must be a list of strings")
+            verdicts = self.worker_pool.filter_batch(texts)
+        except Exception as e:
+            with self._stats_lock:
+                self._stats["errors"] += 1
+            return {"error": f"{type(e).__name__}: {e}"}
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["docs"] += len(texts)
+        return {"verdicts": verdicts}
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def remove_stale_socket(socket_path: str):
+    """以前のserverが残したsocket fileを削除する. 接続できる(serverが実行中)場合はRuntimeError"""
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(socket_path)
+        return
+    finally:
+        sock.close()
+    raise RuntimeError(f"another server is listening on {socket_path}")
+
+
+def main_server(args):
+    """ workerの読み込み(pre-warm)後，SIGTERM/SIGINTを受け取るまでrequestを受け付ける
+    Args:
+        args.socket_path: Unix domain socketのpath
+        args.n_workers: 判定を行うworker process数
+        args.batch_size: 1回にworkerへ渡すtext数. 大きなrequestは分割して複数のworkerで判定する
+        args.model_path, args.verdict_cache_size, args.verdict_cache_db: respect_PI_filter.py と同じ
+        args.no_ng_prefilter: NG wordを含まない文書のMeCab解析の省略(判定結果は同一)を行わない
+    """
+    print(f"{args=}")
+    worker_pool = PPIFilterWorkerPool(args.n_workers, batch_size=args.batch_size, model_path=args.model_path, ng_prefilter=not args.no_ng_prefilter,
+                                      verdict_cache_size=args.verdict_cache_size, verdict_cache_db=args.verdict_cache_db)
+    server = PPIFilterServer(args.socket_path, worker_pool)
+
+    def _shutdown(signum, frame):
+        print(f"received signal {signum}. shutting down ...")
+        threading.Thread(target=server.shutdown, daemon=True).start()   # serve_foreverのthread(main thread)から呼び出すと停止しない
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    print(f"listening on {args.socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        worker_pool.shutdown()
+    print("stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve PPI verdicts over a Unix domain socket with pre-warmed worker processes.')
+    parser.add_argument('--socket_path', type=str,
+                        help='Unix domain socket to listen on', required=False, default=DEFAULT_SOCKET_PATH)
+    parser.add_argument('--n_workers', type=int,
+                        help='Number of pre-warmed worker processes', required=False, default=1)
+    parser.add_argument('--batch_size', type=int,
+                        help='Texts per worker call. Larger requests are split and judged by several workers in parallel', required=False, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--model_path', type=str,
+                        help='Trained classifier pipeline: a pickle or a compact model directory. Default: src/PPI_classifier/models/NB_pipeline_202503.pkl', required=False, default=None)
+    parser.add_argument('--verdict_cache_size', type=int,
+                        help='Verdicts kept per worker in an in-memory LRU keyed by the text hash. 0 disables (unless --verdict_cache_db is given)', required=False, default=0)
+    parser.add_argument('--verdict_cache_db', type=str,
+                        help='SQLite file storing verdicts shared by all workers and restarts (requires xxhash)', required=False, default=None)
+
+    # Flag options
+    parser.add_argument('--no_ng_prefilter',
+                        help='If this flag is used, parse every document with MeCab even if it contains no NG word (the verdicts do not change)', action="store_true")
+    args = parser.parse_args()
+    if args.n_workers < 1:
+        parser.error("--n_workers must be >= 1")
+    if args.batch_size < 1:
+        parser.error("--batch_size must be >= 1")
+
+    main_server(args)
@@ -16,8 +16,13 @@ import argparse
 import sys
 import os
 import time
+import functools
+import operator
+import itertools
+import collections
+import fnmatch
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 ### SRC
 SRC_PATH = str(Path(__file__).resolve().parents[1])
@@ -27,15 +32,109 @@ sys.path.append(SRC_PATH)
 # from filtering.custom_document_filter_PPI import ProtectPersonalInformationJa_v1    # mecab rule-based filter
 # from filtering.custom_document_filter_PPI_classifier import PrivacyClassifier    # NB classifier filter
 from filtering.custom_document_filter_PPI_rule_and_classifier import ProtectPersonalInformationRulebaseAndClassifier    # mecab rule-based filter + NB classifier filter
-from filtering.custom_document_filter_detail_jsondumper import DetailDocument, CustomMetaInfoJSONLoader, CustomMetaInfoJSONDumper, JSONDumperWithKeepExtras
-
-
-def __readlines(input_file: str):
-    with open(input_file) as fp:
-        return fp.readlines()
-
-def get_files(inpud_dir: str):
-    return [f for f in os.listdir(inpud_dir) if os.path.isfile(os.path.join(inpud_dir, f))]
+from filtering.custom_document_filter_detail_jsondumper import DetailDocument, CustomMetaInfoJSONLoader, CustomMetaInfoJSONDumper, JSONDumperWithKeepExtras, JSONLoaderWithBackend, JSON_BACKENDS
+from filtering.jsonl_io import iter_lines, read_head_line, open_writer, sync_writer, truncate_file, split_line_aligned_ranges, concat_files, detect_compression, strip_compression_suffix, COMPRESSION_SUFFIXES
+from filtering.run_manifest import RunManifest, get_input_signature, stats_to_dict, dict_to_stats
+from filtering.stage_profiler import StageProfiler
+from filtering.custom_batch_compose import BatchCompose, iter_micro_batches
+from filtering.overlapped_io import PrefetchReader, BatchWriter, QueueDepthStats, IO_QUEUE_SIZE
+from filtering.shared_work_queue import SharedWorkQueue, LEASE_TIMEOUT, POLL_INTERVAL, MIN_POLL_INTERVAL
+from filtering.columnar_io import (is_columnar_file, get_columnar_output_filename, read_columnar_schema, split_columnar_ranges, get_columnar_range_size,
+                                   iter_record_batches, get_text_column, get_output_schema, open_parquet_writer, concat_parquet_files, ParquetBatchWriter)
+
+
+# worker process単位で保持するPPI filter
+# 判定器pickleの読み込み, MeCab taggerの作成, NGワードDBの読み込みはworker起動時の1回のみ行い，worker内で処理するすべてのfileで使い回す
+_PPI_FILTER = None
+
+def init_worker(ng_prefilter=False, model_path=None, verdict_cache_size=0, verdict_cache_db=None):
+    """ProcessPoolExecutorのinitializer. worker process内でPPI filterを作成する
+    NOTE: filterはworker内で作成されるため，MeCab taggerなどpickle不可能なobjectをprocess間で受け渡す必要がない
+    Args:
+        model_path: 訓練済みpipeline(pickle)のpath. None -> filterのdefault
+        verdict_cache_size, verdict_cache_db: verdict cache (workerごとのmemory LRUの最大数, 全workerで共有するsqlite3のpath)
+    """
+    global _PPI_FILTER
+    _PPI_FILTER = ProtectPersonalInformationRulebaseAndClassifier(add_ppi_info=False, ng_prefilter=ng_prefilter, model_path=model_path,
+                                                                 verdict_cache_size=verdict_cache_size, verdict_cache_db=verdict_cache_db)  # mecab rule-based filter + NB classifier filter
+
+def get_ppi_filter():
+    """worker processで保持しているPPI filterを返す (未作成の場合は作成)"""
+    if _PPI_FILTER is None:
+        init_worker()
+    return _PPI_FILTER
+
+def get_files(input_dir: str, recursive=False, include_patterns=None, exclude_patterns=None, exclude_dirs=()):
+    """input_dir内の入力fileを input_dir からの相対pathで返す (path順)
+    Args:
+        recursive: True -> sub directoryも探索する. 出力はinput_dirと同じdirectory構成でoutput_dirに書き出す
+        include_patterns: list(str) glob pattern. いずれかにmatchするfileのみを対象とする. None -> 全file
+        exclude_patterns: list(str) glob pattern. いずれかにmatchするfileを除外する
+            patternは相対path(e.g. "CC-MAIN-2024/a.jsonl.gz")に対してfnmatchで判定する. `*` は `/` にもmatchする
+        exclude_dirs: 探索しないdirectory (input_dir内にoutput_dirがある場合に出力を入力として扱わないため)
+    Raises:
+        ValueError: 出力ファイル名が同じになる入力fileがある場合 (e.g. a.jsonl と a.jsonl.gz, a.parquet と a.arrow)
+    """
+    exclude_dirs = {os.path.realpath(d) for d in exclude_dirs}
+    filenames = []
+    for dirpath, dirnames, files in os.walk(input_dir):
+        dirnames[:] = sorted(d for d in dirnames if recursive and os.path.realpath(os.path.join(dirpath, d)) not in exclude_dirs)
+        for f in files:
+            filename = os.path.relpath(os.path.join(dirpath, f), input_dir)
+            if include_patterns and not any(fnmatch.fnmatch(filename, pattern) for pattern in include_patterns):
+                continue
+            if exclude_patterns and any(fnmatch.fnmatch(filename, pattern) for pattern in exclude_patterns):
+                continue
+            filenames.append(filename)
+    filenames = sorted(filenames)
+    check_output_filename_collisions(filenames)
+    return filenames
+
+def check_output_filename_collisions(jsonl_filenames: list):
+    """出力ファイル名(passed_/rejected_, stat_)が同じになる入力fileがあればValueError. 出力, 統計情報が上書きされるため処理前に止める
+    入力の圧縮形式の拡張子は出力ファイル名に含まれず, Parquet/Arrow入力の出力はすべて .parquet (stat_は .json) となる
+    """
+    output2input = {}
+    for jsonl_filename in jsonl_filenames:
+        for prefix in ["passed", "stat"]:
+            output_filename = get_output_filename(prefix, jsonl_filename)
+            if output_filename in output2input and output2input[output_filename] != jsonl_filename:
+                raise ValueError(f"input files {output2input[output_filename]} and {jsonl_filename} have the same output file name: {output_filename}. "
+                                 f"rename one of them or exclude it with --exclude")
+            output2input[output_filename] = jsonl_filename
+
+def get_output_filename(prefix: str, jsonl_filename: str, chunk=None, compression=None):
+    """出力ファイル名. chunk単位で処理する場合はpart番号付きのファイル名にし，全chunkの処理後に連結する
+    入力fileの圧縮形式の拡張子(.gz, .zst)は除き，出力の圧縮形式(compression)の拡張子を付ける. e.g. a.jsonl.gz -> passed_a.jsonl.zst
+    sub directory内のfileは同じsub directoryに出力する. e.g. sub/a.jsonl -> sub/passed_a.jsonl
+    Parquet/Arrow入力の出力はParquet(stat_はjson)とし，compressionは用いない. e.g. a.arrow -> passed_a.parquet, stat_a.json
+    """
+    dirname, basename = os.path.split(jsonl_filename)
+    if is_columnar_file(basename):
+        basename, compression = get_columnar_output_filename(basename, is_stat=prefix == "stat"), None
+    output_filename = os.path.join(dirname, f"{prefix}_{strip_compression_suffix(basename)}" + (COMPRESSION_SUFFIXES[compression] if compression is not None else ""))
+    if chunk is None:
+        return output_filename
+    return f"{output_filename}.part{chunk[0]:05d}"
+
+def write_stat(output_dir: str, jsonl_filename: str, statistics: dict, filter_counters: dict, stage_latency=None, queue_depth=None):
+    """統計情報(hojichar)にPPI filterの処理件数(ppi_filter_counters), 処理段階ごとの処理時間(stage_latency),
+    読み込み/書き込みqueueの長さ(queue_depth)を追加してstat_ファイルに書き出す
+    stage_latencyの各処理段階の batch_averaged=True は，batch単位でのみ計測できる処理段階(read, write, ppi:classifier_*, ppi:verdict_cacheなど)で，
+    p50/p95/p99は文書ごとの処理時間ではなくbatch平均の分布であることを示す
+    """
+    if filter_counters.get("verdict_cache_lookup_num", 0) > 0:
+        filter_counters = dict(filter_counters, verdict_cache_hit_rate=filter_counters["verdict_cache_hit_num"] / filter_counters["verdict_cache_lookup_num"])
+    statistics = dict(statistics, ppi_filter_counters=filter_counters)
+    if stage_latency is not None:
+        statistics["stage_latency"] = stage_latency
+    if queue_depth is not None:
+        statistics["queue_depth"] = queue_depth
+    stat_file = os.path.join(output_dir, get_output_filename("stat", jsonl_filename))
+    os.makedirs(os.path.dirname(stat_file), exist_ok=True)
+    with open(stat_file + ".tmp", "w") as writer:
+        writer.write(json.dumps(statistics, ensure_ascii=False) + "\n")
+    os.replace(stat_file + ".tmp", stat_file)
 
 def process_protect_PI_ja(inputs: tuple):
     """
@@ -44,7 +143,7 @@ def process_protect_PI_ja(inputs: tuple):
     """
     print(f"{inputs=}")
     jsonl_filename, input_dir, output_dir, filter_key, skip_rejected, dump_reason = inputs
-    lines = __readlines(os.path.join(input_dir, jsonl_filename))
+    lines = iter_lines(os.path.join(input_dir, jsonl_filename))
     print(f"processing ... {str(os.path.join(input_dir, jsonl_filename))}")
 
     # Create output directory if not exists
@@ -61,7 +160,7 @@ def process_protect_PI_ja(inputs: tuple):
         # ProtectPersonalInformationJa_v1(),  # mecab rule-based filter
         # PrivacyClassifier(),  # NB classifier filter
 
-        ProtectPersonalInformationRulebaseAndClassifier(add_ppi_info=False),  # mecab rule-based filter + NB classifier filter
+        get_ppi_filter(),  # mecab rule-based filter + NB classifier filter (worker内で共有)
 
         # Output
         document_filters.JSONDumper(skip_rejected=skip_rejected, dump_reason=dump_reason),    # original
@@ -69,9 +168,10 @@ def process_protect_PI_ja(inputs: tuple):
     ])
 
     # Apply filter & write to file
-    passed_writer = open(os.path.join(output_dir, f"passed_{jsonl_filename}"), "w")  # 
+    # 入力は1行ずつ読み込み(streaming)，出力はbuffer付きwriterで書き込む -> メモリ使用量は入力ファイルサイズに依存しない
+    passed_writer = open_writer(os.path.join(output_dir, get_output_filename("passed", jsonl_filename)))
     if skip_rejected is False:
-        rejected_writer = open(os.path.join(output_dir, f"rejected_{jsonl_filename}"), "w")
+        rejected_writer = open_writer(os.path.join(output_dir, get_output_filename("rejected", jsonl_filename)))
     
     for line in lines:
         result = cleaner.apply(Document(line))
@@ -87,7 +187,7 @@ def process_protect_PI_ja(inputs: tuple):
         rejected_writer.close()
 
     # write statistics info    
-    with open(os.path.join(output_dir, f"stat_{jsonl_filename}"), "w") as writer:
+    with open(os.path.join(output_dir, get_output_filename("stat", jsonl_filename)), "w") as writer:
         writer.write(json.dumps(cleaner.statistics, ensure_ascii=False) + "\n")
 
 def process_protect_PI_ja_test(inputs: tuple):
@@ -95,7 +195,7 @@ def process_protect_PI_ja_test(inputs: tuple):
     meta情報を保持し，処理のdebug用途に使用
     """
     jsonl_filename, input_dir, output_dir, filter_key, skip_rejected, dump_reason = inputs
-    lines = __readlines(os.path.join(input_dir, jsonl_filename))
+    lines = iter_lines(os.path.join(input_dir, jsonl_filename))
     print(f"processing ... {str(os.path.join(input_dir, jsonl_filename))}")
     
     # Create output directory if not exists
@@ -117,110 +217,585 @@ def process_protect_PI_ja_test(inputs: tuple):
 
     # Apply filter & write to file
     # 1つのjsonlファイルに結果をすべて書き込む
-    with open(os.path.join(output_dir, f"applied_filter_{jsonl_filename}"), "w") as writer:
+    with open_writer(os.path.join(output_dir, get_output_filename("applied_filter", jsonl_filename))) as writer:
         for line in lines:
             # result = cleaner.apply(Document(line))
             result = cleaner.apply(DetailDocument(line))    # NOTE: 処理中にもinput jsonlのmeta情報を保持するためのDocument class
             writer.write(result.text + "\n")
                 # remained_lines.append(result.text)
 
-    with open(os.path.join(output_dir, f"stat_{jsonl_filename}"), "w") as writer:
+    with open(os.path.join(output_dir, get_output_filename("stat", jsonl_filename)), "w") as writer:
         writer.write(json.dumps(cleaner.statistics, ensure_ascii=False) + "\n")
 
-def process_protect_PI_ja_keep_kv(inputs: tuple):
+def get_run_config(args) -> dict:
+    """出力内容に影響する引数. --resume時に前回の実行と一致することを確認する"""
+    return {"filter_key": args.filter_key, "skip_rejected": args.skip_rejected, "dump_reason": args.dump_reason,
+            "output_compression": args.output_compression, "pass_through": args.pass_through, "json_backend": args.json_backend,
+            "model_path": args.model_path, "verdict_column": args.verdict_column}
+
+def get_unit_key(chunk) -> str:
+    """manifestでwork unitを識別するkey"""
+    return "all" if chunk is None else f"{chunk[0]:05d}"
+
+def get_tmp_output_filename(prefix: str, jsonl_filename: str, chunk, compression, attempt=None) -> str:
+    """work unitの出力先. fileの全work unitが完了した時点で連結(chunk), renameして出力ファイルとする (finalize_file_outputs)
+    Args:
+        attempt: (shared_work_dir) work unitのleaseの世代. 同じwork unitを複数のnodeが処理した場合も出力先が重ならないようにする
+    """
+    return get_output_filename(prefix, jsonl_filename, chunk, compression) + ("" if attempt is None else f".attempt{attempt}") + ".tmp"
+
+def add_counters(counters: dict, other: dict) -> dict:
+    """PPI filterの処理件数(get_counters)を合算する"""
+    merged = dict(counters)
+    for key, value in other.items():
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
+def process_protect_PI_ja_keep_kv(inputs: tuple, attempt=None):
     """
+    Args:
+        inputs: (jsonl_filename, chunk, args)
+            chunk: None -> file全体を処理. (chunk_idx, start, end) -> fileのbyte範囲[start, end)のみを処理
+            args: main_filterに与えた引数
+        attempt: (shared_work_dir) work unitのleaseの世代. 指定した場合はmanifestを用いず(checkpoint, resumeなし)，一時ファイル名に付ける
     Returns:
+        (`hojichar.core.inspection.StatsContainer`, `dict`, `StageProfiler`, `QueueDepthStats`): 統計情報, PPI filterの処理件数, 処理段階ごとの処理時間,
+            読み込み/書き込みqueueの長さ. 出力は一時ファイル(get_tmp_output_filename)に書き込み，親processでfileごとにmergeしてstat_ファイルを書き出す
+
+    読み込み(reader thread), filter処理(このthread), 書き込み(writer thread)はbounded queueで接続して並行させる (overlapped_io).
 
+    checkpoint_interval秒ごとに，出力をfileに反映した上で処理済み行数をmanifestに記録する.
+    args.resume=Trueの場合は記録した行数から処理を再開する (記録以降の出力は破棄する)
     """
     print(f"{inputs=}")
-    jsonl_filename, input_dir, output_dir, filter_key, skip_rejected, dump_reason = inputs
-    lines = __readlines(os.path.join(input_dir, jsonl_filename))
-    print(f"processing ... {str(os.path.join(input_dir, jsonl_filename))}")
-
-    # Create output directory if not exists
-    os.makedirs(output_dir, exist_ok=True)
+    jsonl_filename, chunk, args = inputs
+    if is_columnar_file(jsonl_filename):
+        return process_protect_PI_columnar(inputs, attempt)
+    input_dir, output_dir, filter_key, skip_rejected, dump_reason = args.input_dir, args.output_dir, args.filter_key, args.skip_rejected, args.dump_reason
+    input_file = os.path.join(input_dir, jsonl_filename)
+    unit_key = get_unit_key(chunk)
+    manifest = RunManifest(output_dir)
+    prefixes = ["passed"] if skip_rejected else ["passed", "rejected"]
+    output_files = {prefix: os.path.join(output_dir, get_tmp_output_filename(prefix, jsonl_filename, chunk, args.output_compression, attempt)) for prefix in prefixes}
+
+    # Resume: 前回の実行で記録した処理済み行数, 出力size, 統計情報
+    progress = manifest.load_unit(jsonl_filename, unit_key) if args.resume and attempt is None else None
+    if progress is not None and progress["done"]:
+        print(f"skip (already done) ... {str(input_file)} ({unit_key=})")
+        return (dict_to_stats(progress["stats"]), progress["counters"], StageProfiler.from_dict(progress.get("stage_profile", {})),
+                QueueDepthStats.from_dict(progress.get("queue_depth", {})))
+    if progress is not None and not all(truncate_file(output_files[prefix], progress["outputs"][prefix]) for prefix in prefixes):
+        print(f"outputs of the previous run are lost. restart ... {str(input_file)} ({unit_key=})")
+        progress = None
+    prev_stats = dict_to_stats(progress["stats"]) if progress is not None else None
+    prev_counters = progress["counters"] if progress is not None else {}
+    prev_profiler = StageProfiler.from_dict(progress.get("stage_profile", {})) if progress is not None else StageProfiler()
+    prev_queue_stats = QueueDepthStats.from_dict(progress.get("queue_depth", {})) if progress is not None else QueueDepthStats()
+    n_done_lines = progress["lines"] if progress is not None else 0
+
+    lines = iter_lines(input_file, byte_range=None if chunk is None else chunk[1:])
+    if n_done_lines > 0:
+        lines = itertools.islice(lines, n_done_lines, None)     # 処理済みの行を読み飛ばす
+    print(f"processing ... {str(input_file)}" + ("" if chunk is None else f" (chunk {chunk[0]}: bytes {chunk[1]}-{chunk[2]})")
+          + ("" if n_done_lines == 0 else f" (resume from line {n_done_lines})"))
+
+    # Create output directory if not exists (入力のsub directoryと同じ構成)
+    os.makedirs(os.path.dirname(os.path.join(output_dir, jsonl_filename)), exist_ok=True)
 
     # Determine the key-value to keep except `filter_key` from the first json
-    head_data = json.loads(lines[0])
-    extra_keys = list(set(head_data.keys()) - set([filter_key]))
+    # pass_through (dump_reasonなし) の場合は入力行をそのまま出力するため不要
+    if args.pass_through and not dump_reason:
+        extra_keys = None
+    else:
+        head_line = read_head_line(input_file)
+        head_data = json.loads(head_line) if head_line is not None else {}
+        extra_keys = list(set(head_data.keys()) - set([filter_key]))
 
     # Filter pipeline
-    cleaner = Compose([
+    # 分類器はbatch単位でまとめて推論する (BatchCompose.apply_batch)
+    ppi_filter = get_ppi_filter()   # worker内で共有. 処理件数はfile(chunk)ごとに集計する
+    ppi_filter.reset_counters()
+    profiler = StageProfiler()  # 読み込み, filterごと(BatchCompose), queueの待ち時間. PPI filter内部の処理時間はppi_filter, 書き込みはwriter threadで記録
+    queue_stats = QueueDepthStats()
+    cleaner = BatchCompose([
         # Input
-        document_filters.JSONLoader(key=filter_key, extra_keys=extra_keys),      # original
+        # document_filters.JSONLoader(key=filter_key, extra_keys=extra_keys),      # original
+        JSONLoaderWithBackend(key=filter_key, extra_keys=extra_keys, json_backend=args.json_backend),     # originalと同じ処理. json_backend='orjson'で高速化
         
         # Document Filter 
         # 各filterについて，(default)skip_rejected=Trueである -> doc.is_reject = True になった場合，後続のフィルタは無意味なので後続の処理はskipされる
-        ProtectPersonalInformationRulebaseAndClassifier(add_ppi_info=False),  # mecab rule-based filter + NB classifier filter
+        ppi_filter,  # mecab rule-based filter + NB classifier filter (worker内で共有)
 
         # Output
         # document_filters.JSONDumper(skip_rejected=skip_rejected, dump_reason=dump_reason),    # original: 入力時のfilter_keyの値を`text`の値として出力. extra_keysは出力されない
-        JSONDumperWithKeepExtras(main_filter_key=filter_key, skip_rejected=skip_rejected, dump_reason=dump_reason),    # 入力時のkey-val を保持して出力
-    ])
+        JSONDumperWithKeepExtras(main_filter_key=filter_key, skip_rejected=skip_rejected, dump_reason=dump_reason,
+                                 pass_through=args.pass_through, json_backend=args.json_backend),    # 入力時のkey-val を保持して出力 (pass_through: 入力行をそのまま出力)
+    ], profiler=profiler)
+
+    def get_unit_stats(write_profiler: StageProfiler):
+        stats = cleaner.statistics_obj
+        unit_profiler = StageProfiler().merge(prev_profiler).merge(profiler).merge(ppi_filter.get_stage_profiler()).merge(write_profiler)
+        return ((prev_stats + stats if prev_stats is not None else stats), add_counters(prev_counters, ppi_filter.get_counters()), unit_profiler,
+                QueueDepthStats().merge(prev_queue_stats).merge(queue_stats))
+
+    def get_progress(done: bool, write_profiler: StageProfiler) -> dict:
+        """現時点(n_done_lines)の進捗. 出力のsize("outputs")は書き込み後に追加する"""
+        stats, counters, unit_profiler, unit_queue_stats = get_unit_stats(write_profiler)
+        return {"lines": n_done_lines, "done": done, "stats": stats_to_dict(stats), "counters": counters,
+                "stage_profile": unit_profiler.to_dict(), "queue_depth": unit_queue_stats.to_dict()}
+
+    def save_checkpoint(unit_progress: dict, writers: dict):
+        """writer threadで呼び出す. unit_progressの行までの出力をfileに反映してから処理済み行数を記録する"""
+        output_sizes = {prefix: sync_writer(writer) for prefix, writer in writers.items()}
+        unit_profiler = StageProfiler.from_dict(unit_progress["stage_profile"]).merge(batch_writer.write_profiler)
+        manifest.update_unit(jsonl_filename, unit_key, dict(unit_progress, outputs=output_sizes, stage_profile=unit_profiler.to_dict()))
 
     # Apply filter & write to file
-    passed_writer = open(os.path.join(output_dir, f"passed_{jsonl_filename}"), "w")  # 
-    if skip_rejected is False:
-        rejected_writer = open(os.path.join(output_dir, f"rejected_{jsonl_filename}"), "w")
-    
-    for line in lines:
-        result = cleaner.apply(Document(line))
-        # result = cleaner.apply(DetailDocument(line))    # NOTE: 処理中のmeta情報を保持する場合のDocument class
-        if result.is_rejected is True:
-            if skip_rejected is False:
-                rejected_writer.write(result.text + "\n")
+    # 入力は1行ずつ読み込み(streaming)，出力はbuffer付きwriterで書き込む -> メモリ使用量は入力ファイルサイズに依存しない
+    # 読み込みと書き込みは別threadで行い，queueに保持するbatch数(io_queue_size)を上限として先読み, 書き込み待ちをする
+    # 圧縮出力(output_compression)の場合，圧縮はwriterのhelper threadで行う
+    writers = {prefix: open_writer(output_files[prefix], args.output_compression, append=progress is not None) for prefix in prefixes}
+    batch_writer = BatchWriter(writers, skip_rejected, profiler, queue_stats, queue_size=args.io_queue_size)
+    reader = PrefetchReader(iter_micro_batches(lines, args.batch_size, args.batch_timeout), profiler, queue_stats, queue_size=args.io_queue_size)
+    try:
+        last_checkpoint_time = time.time()
+        for batch_lines in reader:
+            results = cleaner.apply_batch([Document(line) for line in batch_lines])   # 出力は入力順
+            batch_writer.write_batch(results)
+            n_done_lines += len(batch_lines)
+
+            # checkpoint: batch単位で，この時点の進捗をwriter threadに渡し，出力をfileに反映してから記録する
+            # (writer threadが書き込む時点ではfilter処理が先に進んでいるため，統計情報はここで確定させる)
+            if attempt is None and time.time() - last_checkpoint_time >= args.checkpoint_interval:
+                batch_writer.checkpoint(functools.partial(save_checkpoint, get_progress(False, StageProfiler())))
+                last_checkpoint_time = time.time()
+    finally:
+        reader.close()
+        batch_writer.close()
+    if attempt is None:
+        manifest.update_unit(jsonl_filename, unit_key, dict(get_progress(True, batch_writer.write_profiler),
+                                                            outputs={prefix: os.path.getsize(path) for prefix, path in output_files.items()}))
+
+    # 統計情報は親processでfileごとにmergeして書き出す
+    return get_unit_stats(batch_writer.write_profiler)
+
+def process_protect_PI_columnar(inputs: tuple, attempt=None):
+    """Parquet/Arrow IPC shard版の process_protect_PI_ja_keep_kv
+    record batchごとにfilter_keyの列のみを取り出して判定し，passed_/rejected_ に入力の全列(+ verdict_column)をParquetで書き出す.
+    json変換を行わないため JSONLoader/JSONDumper は含めず，dump_reason, pass_through, json_backend, output_compression は用いない
+    Args:
+        inputs: (filename, chunk, args)
+            chunk: None -> file全体を処理. (chunk_idx, start, end) -> row group(Parquet)/record batch(Arrow IPC file)の番号[start, end)のみを処理
+    Returns:
+        process_protect_PI_ja_keep_kv と同じ
+
+    Parquetはfileを閉じるまで完全なfileとならないため，work unitの途中のcheckpointは記録しない.
+    args.resume=Trueの場合，完了したwork unitはskipし，処理途中のwork unitは先頭から処理し直す
+    """
+    filename, chunk, args = inputs
+    input_file = os.path.join(args.input_dir, filename)
+    unit_key = get_unit_key(chunk)
+    manifest = RunManifest(args.output_dir)
+    prefixes = ["passed"] if args.skip_rejected else ["passed", "rejected"]
+    output_files = {prefix: os.path.join(args.output_dir, get_tmp_output_filename(prefix, filename, chunk, None, attempt)) for prefix in prefixes}
+
+    progress = manifest.load_unit(filename, unit_key) if args.resume and attempt is None else None
+    if progress is not None and progress["done"]:
+        print(f"skip (already done) ... {str(input_file)} ({unit_key=})")
+        return (dict_to_stats(progress["stats"]), progress["counters"], StageProfiler.from_dict(progress.get("stage_profile", {})),
+                QueueDepthStats.from_dict(progress.get("queue_depth", {})))
+    print(f"processing ... {str(input_file)}" + ("" if chunk is None else f" (chunk {chunk[0]}: parts {chunk[1]}-{chunk[2]})"))
+    os.makedirs(os.path.dirname(os.path.join(args.output_dir, filename)), exist_ok=True)
+
+    # Filter pipeline: PPI filterのみ (入力はfilter_keyの列の値)
+    ppi_filter = get_ppi_filter()
+    ppi_filter.reset_counters()
+    profiler = StageProfiler()
+    queue_stats = QueueDepthStats()
+    cleaner = BatchCompose([ppi_filter], profiler=profiler)
+
+    output_schema = get_output_schema(read_columnar_schema(input_file), args.verdict_column)
+    writers = {prefix: open_parquet_writer(output_files[prefix], output_schema) for prefix in prefixes}
+    batch_writer = ParquetBatchWriter(writers, args.skip_rejected, profiler, queue_stats, verdict_column=args.verdict_column, queue_size=args.io_queue_size)
+    reader = PrefetchReader(iter_record_batches(input_file, args.batch_size, part_range=None if chunk is None else chunk[1:]),
+                            profiler, queue_stats, queue_size=args.io_queue_size)
+    n_done_rows = 0
+    try:
+        for record_batch in reader:
+            texts = get_text_column(record_batch, args.filter_key)
+            results = cleaner.apply_batch([Document(text) for text in texts])   # 出力は入力順
+            batch_writer.write_record_batch(record_batch, results)
+            n_done_rows += len(texts)
+    finally:
+        reader.close()
+        batch_writer.close()
+
+    unit_profiler = StageProfiler().merge(profiler).merge(ppi_filter.get_stage_profiler()).merge(batch_writer.write_profiler)
+    unit_stats = (cleaner.statistics_obj, ppi_filter.get_counters(), unit_profiler, queue_stats)
+    if attempt is not None:
+        return unit_stats
+    manifest.update_unit(filename, unit_key, {"lines": n_done_rows, "outputs": {prefix: os.path.getsize(path) for prefix, path in output_files.items()},
+                                              "done": True, "stats": stats_to_dict(unit_stats[0]), "counters": unit_stats[1],
+                                              "stage_profile": unit_profiler.to_dict(), "queue_depth": queue_stats.to_dict()})
+    return unit_stats
+
+def get_file_chunks(args, jsonl_filename: str):
+    """n_workers > 1 の場合，chunk_size_mbを超えるfileは行頭で揃えたbyte範囲のchunkに分割し，全workerで分担して処理する
+    (巨大なfileが1つだけの場合でも全coreを利用するため). 圧縮fileは途中から展開できないため分割しない
+    Returns:
+        `list`: [[start, end], ...]. 分割しない場合はNone
+    """
+    chunk_size = int(args.chunk_size_mb * 1024**2)
+    input_file = os.path.join(args.input_dir, jsonl_filename)
+    if is_columnar_file(jsonl_filename):
+        # Parquet/Arrow: row group/record batchの番号の範囲で分割する
+        if args.n_workers > 1 and chunk_size > 0:
+            part_ranges = split_columnar_ranges(input_file, chunk_size)
+            if part_ranges is not None and len(part_ranges) > 1:
+                return [[start, end] for start, end in part_ranges]
+        return None
+    if args.n_workers > 1 and chunk_size > 0 and detect_compression(input_file) is None:
+        byte_ranges = split_line_aligned_ranges(input_file, chunk_size)
+        if len(byte_ranges) > 1:
+            return [[start, end] for start, end in byte_ranges]
+    return None
+
+def get_work_unit_size(args, work_unit: tuple) -> int:
+    """work unitの処理量の見積もり (入力のbyte数. 圧縮fileは圧縮後のbyte数)"""
+    jsonl_filename, chunk, _ = work_unit
+    if chunk is not None and is_columnar_file(jsonl_filename):
+        return get_columnar_range_size(os.path.join(args.input_dir, jsonl_filename), chunk[1:])
+    if chunk is not None:
+        return chunk[2] - chunk[1]
+    return os.path.getsize(os.path.join(args.input_dir, jsonl_filename))
+
+def get_work_units(args, jsonl_filenames: list, manifest: RunManifest) -> list:
+    """workerに渡す作業単位を作成し，manifestに処理するfileを記録する (全fileを1回の更新で記録する)
+    args.resume=Trueの場合，完了済みのfileは除外し，処理途中のfileは前回と同じchunk分割で再開する
+    作業単位は処理量(byte数)の大きい順に並べる (LPT: longest processing time first).
+    workerは空いた順に先頭から作業単位を受け取るため，大きなfileが最後に残って他のworkerが待機する時間を短くできる
+    Returns:
+        `list`: [(jsonl_filename, chunk, args), ...] byte数の降順
+    """
+    previous_files = manifest.load()["files"] if args.resume else {}
+    file_entries = {}
+    work_units = []
+    for jsonl_fname in jsonl_filenames:
+        input_signature = get_input_signature(os.path.join(args.input_dir, jsonl_fname))
+        entry = previous_files.get(jsonl_fname)
+        if entry is not None and entry["input"] == input_signature:
+            if entry["done"]:
+                print(f"skip (already done): {jsonl_fname}")
+                continue
+            file_chunks = entry["chunks"]
         else:
-            passed_writer.write(result.text + "\n")
+            file_chunks = get_file_chunks(args, jsonl_fname)
+        file_entries[jsonl_fname] = (input_signature, file_chunks)
 
-    passed_writer.close()
-    if skip_rejected is False:
-        rejected_writer.close()
+        chunks = [None] if file_chunks is None else [(chunk_idx, start, end) for chunk_idx, (start, end) in enumerate(file_chunks)]
+        for chunk in chunks:
+            work_units.append((jsonl_fname, chunk, args))
+    manifest.start_files(file_entries)
 
-    # write statistics info    
-    with open(os.path.join(output_dir, f"stat_{jsonl_filename}"), "w") as writer:
-        writer.write(json.dumps(cleaner.statistics, ensure_ascii=False) + "\n")
+    work_units.sort(key=lambda work_unit: get_work_unit_size(args, work_unit), reverse=True)
+    return work_units
+
+def finalize_file_outputs(args, jsonl_filename: str, unit_results: list, manifest: RunManifest = None, unit_attempts: list = None):
+    """fileの全work unitの処理後，一時ファイルを元の順序で連結(chunk)またはrenameして出力ファイルとし，統計情報をmergeしてstat_ファイルに書き出す
+    出力ファイルは完成した時点でrenameするため，中断した場合も不完全な出力ファイルは残らない
+    Args:
+        unit_results: [(chunk, (StatsContainer, filter_counters, StageProfiler, QueueDepthStats)), ...] chunk順
+        manifest: 指定した場合はfileの完了を記録する
+        unit_attempts: (shared_work_dir) unit_resultsと同じ順の各work unitの完了を記録したleaseの世代.
+                       一時ファイルは削除せずに残す (連結の途中で中断した場合も他のnodeが同じ一時ファイルから出力を作り直せるようにするため)
+    """
+    prefixes = ["passed"] if args.skip_rejected else ["passed", "rejected"]
+    keep_tmp_files = unit_attempts is not None
+    attempts = unit_attempts if keep_tmp_files else [None] * len(unit_results)
+    for prefix in prefixes:
+        output_file = os.path.join(args.output_dir, get_output_filename(prefix, jsonl_filename, compression=args.output_compression))
+        tmp_files = [os.path.join(args.output_dir, get_tmp_output_filename(prefix, jsonl_filename, chunk, args.output_compression, attempt))
+                     for (chunk, _), attempt in zip(unit_results, attempts)]
+        if len(tmp_files) == 1 and not keep_tmp_files:
+            os.replace(tmp_files[0], output_file)
+            continue
+        if os.path.exists(output_file + ".tmp"):
+            os.remove(output_file + ".tmp")     # 中断した以前の連結
+        if len(tmp_files) == 1:
+            os.link(tmp_files[0], output_file + ".tmp")
+        elif is_columnar_file(jsonl_filename):
+            concat_parquet_files(tmp_files, output_file + ".tmp", get_output_schema(read_columnar_schema(os.path.join(args.input_dir, jsonl_filename)), args.verdict_column),
+                                 remove_inputs=not keep_tmp_files)
+        else:
+            concat_files(tmp_files, output_file + ".tmp", remove_inputs=not keep_tmp_files)
+        os.replace(output_file + ".tmp", output_file)
+
+    merged_stats = functools.reduce(operator.add, [stats for _, (stats, _, _, _) in unit_results])
+    merged_counters = functools.reduce(add_counters, [counters for _, (_, counters, _, _) in unit_results])
+    merged_profiler = StageProfiler()
+    merged_queue_stats = QueueDepthStats()
+    for _, (_, _, unit_profiler, unit_queue_stats) in unit_results:
+        merged_profiler.merge(unit_profiler)
+        merged_queue_stats.merge(unit_queue_stats)
+    write_stat(args.output_dir, jsonl_filename, merged_stats.get_human_readable_values(), merged_counters, merged_profiler.get_human_readable_values(),
+               merged_queue_stats.get_human_readable_values())
+    if manifest is not None:
+        manifest.mark_file_done(jsonl_filename)
 
 def main_filter(args):
     """ 指定されたinput_dirに含まれるすべてのfileに対してfilterを行う
     Args:
         args.input_dir: input directory containing jsonl files
+        args.recursive: also process files in sub directories of input_dir. outputs mirror the input directory tree. default=False
+        args.include: glob patterns (relative path) of files to process. default=None (all files)
+        args.exclude: glob patterns (relative path) of files to skip. default=None
         args.output_dir: output directory to save files (passed, rejected, stat)
         args.n_workers: number of workers for multi-processing. default=1 (single processing)
         args.filter_key: Define the key in the JSONL file used for filtering records. default="text"
         args.skip_rejected: If is_reject flag is True in hojichar, skip further filter processing and do not include it in output. default=False
         args.dump_reason: hojichar dumps the output information with `is_rejected` and `reason` entries. default=False
+        args.chunk_size_mb: (n_workers > 1) files larger than this are split into line-aligned chunks processed by all workers. default=256
+        args.batch_size: number of documents per micro-batch. rule-positive documents in a batch are classified by one predict call. default=256
+        args.batch_timeout: flush a micro-batch after this many seconds even if it is not full, also while the next line has not arrived yet (slow streams). default=1.0
+        args.io_queue_size: micro-batches buffered between the reader thread, the filter and the writer thread. default=8
+        args.ng_prefilter: skip MeCab for documents that contain no NG word as a substring (same verdicts). default=False
+        args.output_compression: compress passed_/rejected_ files with 'gzip' or 'zstd'. default=None (plain jsonl)
+        args.pass_through: without dump_reason, write the original input lines instead of re-serialized json (keeps keys missing from the first line). default=False
+        args.json_backend: 'json' or 'orjson' (faster, compact separators) for parsing and re-serializing lines. default='json'
+        args.checkpoint_interval: seconds between progress records (processed lines) in the manifest. default=60
+        args.resume: skip files completed by the previous run and continue partial files from the last recorded line. default=False
+        args.model_path: trained classifier pipeline (pickle or compact model directory). default=None (src/PPI_classifier/models/NB_pipeline_202503.pkl)
+        args.verdict_cache_size: verdicts kept per worker in an in-memory LRU keyed by the text hash; repeated texts skip MeCab and the classifier. default=0 (disabled)
+        args.verdict_column: (Parquet/Arrow input) add a bool column with this name (True: rejected) to passed_/rejected_ Parquet outputs. default=None
+        args.verdict_cache_db: sqlite3 file that stores verdicts shared by all workers and later runs (enables the cache). default=None
+
+    入力ファイル:
+        - jsonl, または gzip(.gz), zstd(.zst) で圧縮したjsonl. 圧縮形式はfile先頭のbyteから判定し，展開しながら読み込む (zstdは zstandard packageが必要)
+        - Parquet(.parquet), Arrow IPC(.arrow, .feather). record batch単位で読み込み，filter_keyの列を判定する (pyarrowが必要)
+          出力は passed_/rejected_{拡張子を除いたfilename}.parquet (入力の全列を保持. verdict_columnで判定結果の列を追加), stat_{拡張子を除いたfilename}.json
 
     出力ファイル:
-        - passed_{filename}: フィルタを通過したデータ
+        - passed_{filename}: フィルタを通過したデータ (output_compressionを指定した場合は .gz/.zst を付けた圧縮ファイル. filenameは入力の圧縮拡張子を除いたもの)
+            - 各行は入力行のfilter_keyと先頭行に含まれるkeyを json.dumps したもの. pass_through(dump_reasonなし)の場合は入力行そのもの
         - rejected_{filename}: フィルタを通過しなかったデータ
-        - stat_{filename}: フィルタの統計情報
+        - stat_{filename}: フィルタの統計情報. ppi_filter_counters: PPI filterの処理件数 (ng_prefilter_skipped_num: MeCab解析を省略した文書数)
+            verdict cacheを利用した場合は verdict_cache_lookup_num, verdict_cache_hit_num, verdict_cache_disk_hit_num, verdict_cache_hit_rate
+            stage_latency: 処理段階ごとの到達した文書数(doc_num), 処理時間の合計, 1文書あたりの処理時間の平均, p50/p95/p99
+                (read, filterごと(<idx>-<filter名>), PPI filter内部(ppi:*), write)
+                batch_averaged=True: batch単位でのみ計測できる処理段階. batchの処理時間を文書数で割った値の分布 (文書ごとの分布ではない)
+                read_wait, write_wait: filter処理のthreadが読み込み済みbatchを待った時間, 書き込みqueueが空くのを待った時間
+            queue_depth: read_queue, write_queue の長さの平均(mean_depth), 空だった割合(empty_ratio), 満杯だった割合(full_ratio).
+                read_queueが空であることが多い -> 読み込みが律速, write_queueが満杯であることが多い -> 書き込みが律速
+        - manifest.json, manifest_units/, manifest_done.jsonl: 実行の進捗 (処理するfile, work unitごとの処理済み行数, 完了したfile). --resume で再開する際に利用
+        - 出力ファイルは処理中は .tmp 付きのファイル名で書き込み，fileの処理が完了した時点でrenameする
 
     設計方針:
-    - 1fileに対して，filter処理インスタンスを作成し，処理を実行する方針の実装にした. 
-        - (フィルタpipelineを持つクラスから単一のインスタンスを作成し，クラスメソッドで処理するプログラムを記述してみたが，multi process利用時にpipelineで利用される判定機まわりの読み込みでエラーが発生した．)
+    - PPI filter(判定器, MeCab, NGワードDB)はworker processごとに1度だけ作成し，workerが処理するすべてのfileで使い回す.
+        - 以前はフィルタpipelineを持つ単一のインスタンスを親processで作成し，そのメソッドをworkerに渡していたため，
+          MeCab taggerなどpickle不可能なobjectの受け渡しでエラーが発生していた．
+        - 現在はProcessPoolExecutorのinitializer(init_worker)でworker内に作成するため，process間で受け渡すのはfile名などの引数のみ.
+    - hojichar Compose(統計情報を保持)はfileごとに作成する. Composeの作成はfilterを包むだけなので軽量.
+    - 並列化の単位はfileまたはfile内のchunk. 巨大なfileはchunkに分割して全workerで処理し，
+      chunkごとの出力と統計情報は処理後に元の順序で連結, mergeする.
+    - 作業単位はbyte数の大きい順にworkerへ渡す (LPT). 大小のfileが混在する場合も全workerがほぼ同時に処理を終える.
+    - worker内では読み込み(reader thread), filter処理, 書き込み(writer thread)をbounded queueで接続して並行させる.
+      ディスク, network filesystemのI/Oで待つ間もMeCab解析, 分類器の処理を続ける.
+    - 中断に備えて進捗をmanifestに記録する. fileの完了は親process, work unit内の処理済み行数は各workerが記録する.
     """
     print(f"{args=}")
-    jsonl_filenames = get_files(args.input_dir)
+    jsonl_filenames = get_files(args.input_dir, recursive=args.recursive, include_patterns=args.include, exclude_patterns=args.exclude,
+                                exclude_dirs=[args.output_dir])
     print(f"Filtering for total {len(jsonl_filenames)} jsonl files with n_workers={args.n_workers} ...")
+    manifest = RunManifest(args.output_dir)
+    manifest.check_or_reset_config(get_run_config(args), resume=args.resume)
+    work_units = get_work_units(args, jsonl_filenames, manifest)
+    print(f"total {len(work_units)} work units (file or chunk)")
 
     # straitforward implementation
     s_time = time.time()
-    with ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+    with ProcessPoolExecutor(max_workers=args.n_workers, initializer=init_worker, initargs=(args.ng_prefilter, args.model_path, args.verdict_cache_size, args.verdict_cache_db)) as executor:
         # results = executor.map(process_protect_PI_ja, [(jsonl_fname, args.input_dir, args.output_dir, args.filter_key, args.skip_rejected, args.dump_reason) for jsonl_fname in jsonl_filenames])
         
         # for debug
         # results = executor.map(process_protect_PI_ja_test, [(jsonl_fname, args.input_dir, args.output_dir, args.filter_key, args.skip_rejected, args.dump_reason) for jsonl_fname in jsonl_filenames])
 
         # keep other kv
-        results = executor.map(process_protect_PI_ja_keep_kv, [(jsonl_fname, args.input_dir, args.output_dir, args.filter_key, args.skip_rejected, args.dump_reason) for jsonl_fname in jsonl_filenames])
-
-    for result in results:
-        print(result)
+        # fileの全work unitが完了した時点で出力ファイルを完成させる (後続のfileの処理中に中断しても完了したfileは再処理しない)
+        file2n_units = collections.Counter(jsonl_fname for jsonl_fname, _, _ in work_units)
+        file2unit_results = {}  # {jsonl_filename: [(chunk, result), ...]}
+        futures = {executor.submit(process_protect_PI_ja_keep_kv, inputs): inputs for inputs in work_units}
+        for future in as_completed(futures):
+            jsonl_fname, chunk, _ = futures[future]
+            unit_results = file2unit_results.setdefault(jsonl_fname, [])
+            unit_results.append((chunk, future.result()))
+            if len(unit_results) == file2n_units[jsonl_fname]:
+                unit_results.sort(key=lambda unit_result: -1 if unit_result[0] is None else unit_result[0][0])
+                finalize_file_outputs(args, jsonl_fname, unit_results, manifest)
 
     elapsed_time = time.time() - s_time
     print(f"total filter proc time: {elapsed_time=:.3f} sec")
 
 
+def get_shared_plan(args, jsonl_filenames: list) -> dict:
+    """shared_work_dirの全nodeで共通の作業単位の一覧 (SharedWorkQueue.load_or_create_plan)
+    各nodeのn_workersによらず同じ分割とするため，chunkはn_workers > 1として求める
+    Returns:
+        `dict`: {"config": get_run_config, "files": [{"filename", "input": 入力fileのsignature, "chunks": [[start, end], ...] or None}, ...],
+                 "units": [[file_idx, chunk_idx or None], ...] byte数の降順 (LPT)}
+    """
+    plan_args = argparse.Namespace(**dict(vars(args), n_workers=max(args.n_workers, 2)))
+    files, work_units = [], []
+    for file_idx, jsonl_fname in enumerate(jsonl_filenames):
+        file_chunks = get_file_chunks(plan_args, jsonl_fname)
+        files.append({"filename": jsonl_fname, "input": get_input_signature(os.path.join(args.input_dir, jsonl_fname)), "chunks": file_chunks})
+        chunks = [None] if file_chunks is None else [(chunk_idx, start, end) for chunk_idx, (start, end) in enumerate(file_chunks)]
+        work_units.extend((file_idx, chunk) for chunk in chunks)
+    work_units.sort(key=lambda unit: get_work_unit_size(args, (jsonl_filenames[unit[0]], unit[1], args)), reverse=True)
+    return {"config": get_run_config(args), "files": files,
+            "units": [[file_idx, None if chunk is None else chunk[0]] for file_idx, chunk in work_units]}
+
+def unit_result_to_dict(unit_result: tuple) -> dict:
+    """process_protect_PI_ja_keep_kvの戻り値 -> json保存可能なdict (完了記録に保存し，fileの出力を完成させるnodeが読み込む)"""
+    stats, counters, unit_profiler, unit_queue_stats = unit_result
+    return {"stats": stats_to_dict(stats), "counters": counters, "stage_profile": unit_profiler.to_dict(), "queue_depth": unit_queue_stats.to_dict()}
+
+def dict_to_unit_result(result_dict: dict) -> tuple:
+    return (dict_to_stats(result_dict["stats"]), result_dict["counters"], StageProfiler.from_dict(result_dict["stage_profile"]),
+            QueueDepthStats.from_dict(result_dict["queue_depth"]))
+
+def remove_attempt_outputs(args, jsonl_filename: str, chunk, attempts):
+    """work unitの一時ファイル(attemptごと)を削除する"""
+    prefixes = ["passed"] if args.skip_rejected else ["passed", "rejected"]
+    for attempt in attempts:
+        for prefix in prefixes:
+            tmp_file = os.path.join(args.output_dir, get_tmp_output_filename(prefix, jsonl_filename, chunk, args.output_compression, attempt))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+def main_filter_shared(args):
+    """ main_filterの複数node版. 共有filesystem上のshared_work_dirを介して，coordinatorなしで複数のnode(同じ引数で起動したprocess)が作業単位を分担する
+    - 最初に起動したnodeが作業単位(file, chunk)の一覧(plan.json)を作成し，以降のnodeは同じ一覧を用いる
+    - 各nodeは作業単位のleaseを取得できたものだけを処理する (SharedWorkQueue). 停止したnodeのleaseは lease_timeout 秒後に期限切れとなり，他のnodeが処理し直す
+    - fileの全work unitが完了すると，いずれか1つのnodeがfileのleaseを取得して出力ファイルを完成させる
+    - 同じwork unitを複数のnodeが処理した場合も，完了記録(done/)は最初に記録した1つのみで，そのattemptの一時ファイルを用いる.
+      出力ファイルは1つのnodeで実行した場合(main_filter)と同一となる
+    - 途中で全nodeが停止した場合も，同じshared_work_dirで起動し直すと完了していない作業単位から再開する (--resume は不要)
+    - work unitの途中の進捗(checkpoint)は記録しない. 停止したnodeが処理していたwork unitは，他のnodeが先頭から処理し直す
+      (失われる処理量はwork unitの大きさまで. 大きなfileは --chunk_size_mb で分割される)
+    - 取得できる作業単位がない間は，MIN_POLL_INTERVAL秒から倍にしながら待つ (上限: lease_timeout/4, POLL_INTERVAL, 次にleaseが期限切れとなり得る時刻)
+    Args:
+        args.shared_work_dir: 全nodeで共有するdirectory (plan.json, leases/, done/)
+        args.lease_timeout: renewされないleaseを期限切れとみなすまでの秒数
+        args.node_id: leaseの保持者の識別子 (log用). None -> hostname-pid
+        その他はmain_filterと同じ. 出力内容に影響する引数(get_run_config)は全nodeで一致する必要がある
+    """
+    print(f"{args=}")
+    work_queue = SharedWorkQueue(args.shared_work_dir, node_id=args.node_id, lease_timeout=args.lease_timeout)
+
+    def _create_plan():
+        jsonl_filenames = get_files(args.input_dir, recursive=args.recursive, include_patterns=args.include, exclude_patterns=args.exclude,
+                                    exclude_dirs=[args.output_dir, args.shared_work_dir])
+        return get_shared_plan(args, jsonl_filenames)
+    plan = work_queue.load_or_create_plan(_create_plan)
+    if plan["config"] != get_run_config(args):
+        raise ValueError(f"--shared_work_dir: arguments differ from the plan: plan={plan['config']}, current={get_run_config(args)}")
+    for file_entry in plan["files"]:
+        if get_input_signature(os.path.join(args.input_dir, file_entry["filename"])) != file_entry["input"]:
+            raise ValueError(f"--shared_work_dir: input file changed after the plan was created: {file_entry['filename']}")
+
+    # task: unit{idx} (work unit), file{idx} (fileの出力ファイルの作成)
+    def _get_chunk(file_entry, chunk_idx):
+        return None if chunk_idx is None else (chunk_idx, *file_entry["chunks"][chunk_idx])
+    unit_inputs = [(plan["files"][file_idx]["filename"], _get_chunk(plan["files"][file_idx], chunk_idx), args) for file_idx, chunk_idx in plan["units"]]
+    file2unit_ids = collections.defaultdict(list)
+    for unit_idx, (file_idx, chunk_idx) in enumerate(plan["units"]):
+        file2unit_ids[file_idx].append((-1 if chunk_idx is None else chunk_idx, f"unit{unit_idx:06d}", unit_idx))
+    print(f"[{work_queue.node_id}] total {len(plan['files'])} files, {len(unit_inputs)} work units (file or chunk)")
+
+    poll_interval = min(POLL_INTERVAL, args.lease_timeout / 4)
+    min_poll_interval = min(MIN_POLL_INTERVAL, poll_interval)
+    idle_wait = min_poll_interval
+    prev_n_done = None
+    n_processed_units = 0
+    s_time = time.time()
+    work_queue.start_renewal()
+    try:
+        with ProcessPoolExecutor(max_workers=args.n_workers, initializer=init_worker, initargs=(args.ng_prefilter, args.model_path, args.verdict_cache_size, args.verdict_cache_db)) as executor:
+            running = {}    # {future: (unit_idx, lease)}
+            while True:
+                leases, done = work_queue.scan()
+
+                # 全work unitが完了したfileの出力ファイルを作成する
+                n_done_files = 0
+                for file_idx, file_entry in enumerate(plan["files"]):
+                    file_task_id = f"file{file_idx:06d}"
+                    unit_ids = sorted(file2unit_ids[file_idx])
+                    if file_task_id in done:
+                        n_done_files += 1
+                        continue
+                    if any(unit_task_id not in done for _, unit_task_id, _ in unit_ids):
+                        continue
+                    lease = work_queue.try_claim(file_task_id, leases.get(file_task_id))
+                    if lease is None:
+                        continue
+                    unit_done = [work_queue.load_done(unit_task_id) for _, unit_task_id, _ in unit_ids]
+                    finalize_file_outputs(args, file_entry["filename"], [(unit_inputs[unit_idx][1], dict_to_unit_result(unit_record["result"]))
+                                                                          for (_, _, unit_idx), unit_record in zip(unit_ids, unit_done)],
+                                          unit_attempts=[unit_record["gen"] for unit_record in unit_done])
+                    if work_queue.is_current(lease) and work_queue.mark_done(lease, {}):
+                        for _, unit_task_id, unit_idx in unit_ids:
+                            latest_gen = leases[unit_task_id].gen if unit_task_id in leases else 0
+                            remove_attempt_outputs(args, file_entry["filename"], unit_inputs[unit_idx][1], range(latest_gen + 1))
+                        print(f"[{work_queue.node_id}] done: {file_entry['filename']}")
+                    work_queue.release(lease)
+                    n_done_files += 1
+                if n_done_files == len(plan["files"]):
+                    # 処理中のwork unitは期限切れとみなされ，他のnodeが処理を終えたもの
+                    for future, (unit_idx, lease) in running.items():
+                        wait([future])
+                        remove_attempt_outputs(args, unit_inputs[unit_idx][0], unit_inputs[unit_idx][1], [lease.gen])
+                        work_queue.release(lease)
+                    break
+
+                # 空いているworkerの数だけwork unitのleaseを取得して処理する
+                for unit_idx in range(len(unit_inputs)):
+                    if len(running) >= args.n_workers:
+                        break
+                    unit_task_id = f"unit{unit_idx:06d}"
+                    if unit_task_id in done:
+                        continue
+                    lease = work_queue.try_claim(unit_task_id, leases.get(unit_task_id))
+                    if lease is not None:
+                        running[executor.submit(process_protect_PI_ja_keep_kv, unit_inputs[unit_idx], lease.gen)] = (unit_idx, lease)
+
+                if len(running) == 0:
+                    # 他のnodeが処理中のwork unitの完了 (またはleaseの期限切れ)を待つ. 完了が増えない間は待つ間隔を倍にする
+                    if len(done) != prev_n_done:
+                        idle_wait = min_poll_interval
+                    prev_n_done = len(done)
+                    expiry_wait = work_queue.get_expiry_wait([lease for task_id, lease in leases.items() if task_id not in done])
+                    time.sleep(max(min(idle_wait, expiry_wait if expiry_wait is not None else poll_interval), min_poll_interval))
+                    idle_wait = min(idle_wait * 2, poll_interval)
+                    continue
+                idle_wait = min_poll_interval
+                completed, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    unit_idx, lease = running.pop(future)
+                    unit_result = future.result()
+                    if work_queue.is_current(lease) and work_queue.mark_done(lease, unit_result_to_dict(unit_result)):
+                        n_processed_units += 1
+                    else:
+                        # 処理中にleaseが期限切れとみなされ，他のnodeが処理した(または処理中の) work unit
+                        print(f"[{work_queue.node_id}] discard stale result: {unit_inputs[unit_idx][:2]} (gen {lease.gen})")
+                        remove_attempt_outputs(args, unit_inputs[unit_idx][0], unit_inputs[unit_idx][1], [lease.gen])
+                    work_queue.release(lease)
+    finally:
+        work_queue.stop_renewal()
+
+    elapsed_time = time.time() - s_time
+    print(f"[{work_queue.node_id}] processed {n_processed_units} work units. total filter proc time: {elapsed_time=:.3f} sec")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process some documents.')
     parser.add_argument('--input_dir', type=str,
@@ -231,12 +806,62 @@ if __name__ == "__main__":
                         help='number of workers for multi-processing', required=False, default=1)
     parser.add_argument('--filter_key', type=str,
                         help='Define the key in the JSONL file used for filtering records.', required=False, default="text")
+    parser.add_argument('--include', type=str, action='append',
+                        help='Glob pattern of files to process, matched against the path relative to input_dir (repeatable). Default: all files', required=False, default=None)
+    parser.add_argument('--exclude', type=str, action='append',
+                        help='Glob pattern of files to skip, matched against the path relative to input_dir (repeatable)', required=False, default=None)
+    parser.add_argument('--chunk_size_mb', type=float,
+                        help='(n_workers > 1) Split files larger than this size into line-aligned chunks and process them with all workers. 0 disables splitting', required=False, default=256)
+    parser.add_argument('--batch_size', type=int,
+                        help='Number of documents per micro-batch. Rule-positive documents in a batch are classified by a single predict call', required=False, default=256)
+    parser.add_argument('--batch_timeout', type=float,
+                        help='Flush a micro-batch after this many seconds even if it is not full (also while waiting for the next line)', required=False, default=1.0)
+    parser.add_argument('--io_queue_size', type=int,
+                        help='Micro-batches buffered between the reader thread, the filter and the writer thread (backpressure bound)', required=False, default=IO_QUEUE_SIZE)
+    parser.add_argument('--json_backend', type=str, choices=JSON_BACKENDS,
+                        help='JSON library for parsing and re-serializing lines. orjson (pip install orjson) is faster and writes compact separators', required=False, default='json')
+    parser.add_argument('--checkpoint_interval', type=float,
+                        help='Seconds between progress records (processed lines) of each work unit in output_dir/manifest_units/', required=False, default=60)
+    parser.add_argument('--model_path', type=str,
+                        help='Trained classifier pipeline: a pickle or a compact model directory (PPI_classifier/compact_model.py). Default: src/PPI_classifier/models/NB_pipeline_202503.pkl', required=False, default=None)
+    parser.add_argument('--verdict_cache_size', type=int,
+                        help='Verdicts kept per worker in an in-memory LRU keyed by the text hash (about 150 bytes each). Repeated texts skip MeCab and the classifier. 0 disables (unless --verdict_cache_db is given)', required=False, default=0)
+    parser.add_argument('--verdict_cache_db', type=str,
+                        help='SQLite file storing verdicts shared by all workers and later runs (requires xxhash). Entries are keyed by a stamp of the model and dictionaries. Must be on a local filesystem (not allowed with --shared_work_dir)', required=False, default=None)
+    parser.add_argument('--verdict_column', type=str,
+                        help='(Parquet/Arrow input) Add a bool column with this name (True: rejected) to the passed_/rejected_ Parquet outputs', required=False, default=None)
+    parser.add_argument('--shared_work_dir', type=str,
+                        help='Directory on a shared filesystem used by several nodes started with the same arguments to split the work without a coordinator (lease files). Interrupted runs continue from unfinished work units', required=False, default=None)
+    parser.add_argument('--lease_timeout', type=float,
+                        help='(--shared_work_dir) Seconds after which a lease that is not renewed is treated as expired and its work unit is processed again by another node', required=False, default=LEASE_TIMEOUT)
+    parser.add_argument('--node_id', type=str,
+                        help='(--shared_work_dir) Identifier of this node in lease files and logs. Default: hostname-pid', required=False, default=None)
+    parser.add_argument('--output_compression', type=str, choices=list(COMPRESSION_SUFFIXES.keys()),
+                        help='Compress passed_/rejected_ files (zstd requires the zstandard package). Compressed input (.gz/.zst) is detected automatically', required=False, default=None)
     
     # Flag options
     parser.add_argument('--skip_rejected',
                         help='If this flag is used, skip further filter processing in hojichar and do not output rejected data to file', action="store_true")
     parser.add_argument('--dump_reason',
                         help='If this flag is used, hojichar dumps the output information with `filter_is_rejected` and `filter_reason` entries.', action="store_true")
+    parser.add_argument('--pass_through',
+                        help='If this flag is used (without --dump_reason), write the original input lines to passed_/rejected_ instead of re-serialized json. Keys that first appear after line 1 are kept', action="store_true")
+    parser.add_argument('--recursive',
+                        help='If this flag is used, also process files in sub directories of input_dir. Outputs mirror the input directory tree', action="store_true")
+    parser.add_argument('--resume',
+                        help='If this flag is used, skip files completed by the previous run in output_dir and continue partial files from the last recorded line', action="store_true")
+    parser.add_argument('--ng_prefilter',
+                        help='If this flag is used, documents that contain no NG word as a substring pass without MeCab parsing (the verdicts do not change)', action="store_true")
     args = parser.parse_args()
-
-    main_filter(args)
\ No newline at end of file
+    if args.io_queue_size < 1:
+        parser.error("--io_queue_size must be >= 1")
+    if args.lease_timeout <= 0:
+        parser.error("--lease_timeout must be > 0")
+    if args.shared_work_dir is not None and args.verdict_cache_db is not None:
+        # SQLiteのWAL(共有memoryのindex), file lockはnetwork filesystem上では複数nodeから安全に利用できない
+        parser.error("--verdict_cache_db cannot be used with --shared_work_dir: SQLite is not safe on a shared (network) filesystem. use --verdict_cache_size")
+
+    if args.shared_work_dir is not None:
+        main_filter_shared(args)
+    else:
+        main_filter(args)
\ No newline at end of file
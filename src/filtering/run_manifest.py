@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# filtering実行の進捗を output_dir に記録する (--resume で中断した実行を再開するため)
+# - manifest.json          : 出力内容に影響する引数, 各fileの入力signatureとchunk分割. 親processが計画時に1回だけ書き込む
+# - manifest_units/        : work unitごとの進捗 (処理済み行数, 出力byte数, 統計情報). 各workerが担当するwork unitのfileのみを書き換える
+# - manifest_done.jsonl    : 完了したfile (親processが1行ずつ追記する)
+# 記録の量はfile数, work unit数に比例し，checkpoint, fileの完了ごとに他のfileの進捗を読み書きしない
+# fileの書き換えは 一時fileに書き込み -> fsync -> rename の順に行い，中断した場合も以前の内容が残る
+
+import os
+import json
+import fcntl
+import shutil
+import dataclasses
+import urllib.parse
+
+from hojichar.core.inspection import StatsContainer, DocStatistics, FilterStatistics
+
+MANIFEST_FILENAME = "manifest.json"
+UNITS_DIRNAME = "manifest_units"
+DONE_LOG_FILENAME = "manifest_done.jsonl"
+MANIFEST_VERSION = 2    # 2: work unitの進捗, fileの完了をmanifest.jsonから分離
+
+
+def get_input_signature(input_file: str) -> dict:
+    """入力fileが前回の実行から変更されていないかの確認用"""
+    stat = os.stat(input_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def stats_to_dict(stats: StatsContainer) -> dict:
+    """StatsContainer -> json保存可能なdict (dict_to_statsで復元)"""
+    return dataclasses.asdict(stats)
+
+def dict_to_stats(stats_dict: dict) -> StatsContainer:
+    return StatsContainer(DocStatistics(**stats_dict["total_info"]),
+                          {name: FilterStatistics(**layer) for name, layer in stats_dict["layers_info"].items()})
+
+def _write_json_atomic(path: str, data: dict):
+    """一時fileに書き込み，fsyncしてからrenameする (書き込み途中で中断しても以前の内容が残る)"""
+    tmp_file = path + f".tmp{os.getpid()}"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class RunManifest(object):
+    def __init__(self, output_dir: str) -> None:
+        """
+        manifest.json:
+            {"version": 2,
+             "config": 出力内容に影響する引数,
+             "files": {jsonl_filename: {"input": {"size", "mtime_ns"},
+                                        "chunks": [[start, end], ...] or null (file全体を1つのwork unitとして処理)}}}
+        manifest_units/<jsonl_filename(quote)>/<unit_key>.json:
+            {"lines": 処理済み行数, "outputs": {prefix: 出力(一時file)のbyte数}, "done": bool, "stats": StatsContainer, "counters": dict,
+             "stage_profile": StageProfiler.to_dict(), "queue_depth": QueueDepthStats.to_dict()}
+        manifest_done.jsonl: 1行ごとに {"filename": jsonl_filename, "input": 完了時の入力signature}
+        """
+        self.output_dir = output_dir
+        self.manifest_file = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.lock_file = self.manifest_file + ".lock"
+        self.units_dir = os.path.join(output_dir, UNITS_DIRNAME)
+        self.done_log_file = os.path.join(output_dir, DONE_LOG_FILENAME)
+        self._file_inputs = {}      # start_filesで記録した入力signature (mark_file_doneでmanifest.jsonを読み直さない)
+
+    def _get_file_units_dir(self, jsonl_filename: str) -> str:
+        """fileのwork unitの進捗を置くdirectory. sub directory内のfile(e.g. sub/a.jsonl)も1階層のdirectory名とする"""
+        return os.path.join(self.units_dir, urllib.parse.quote(jsonl_filename, safe=""))
+
+    def _load_done_inputs(self) -> dict:
+        """manifest_done.jsonl -> {jsonl_filename: 完了時の入力signature}. 追記の途中で中断した末尾の行は無視する"""
+        done_inputs = {}
+        if not os.path.exists(self.done_log_file):
+            return done_inputs
+        with open(self.done_log_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done_inputs[record["filename"]] = record["input"]
+        return done_inputs
+
+    def load(self) -> dict:
+        """
+        Returns:
+            `dict`: manifest.jsonの内容. files[jsonl_filename]["done"] に完了したかどうかを加える (work unitの進捗は load_unit)
+        """
+        if not os.path.exists(self.manifest_file):
+            return {"version": MANIFEST_VERSION, "files": {}}
+        with open(self.manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        done_inputs = self._load_done_inputs()
+        for jsonl_filename, entry in manifest.get("files", {}).items():
+            entry["done"] = done_inputs.get(jsonl_filename) == entry["input"]
+        return manifest
+
+    def load_unit(self, jsonl_filename: str, unit_key: str):
+        """work unitの進捗 (update_unitで記録したもの). 記録がない場合はNone"""
+        unit_file = os.path.join(self._get_file_units_dir(jsonl_filename), f"{unit_key}.json")
+        if not os.path.exists(unit_file):
+            return None
+        with open(unit_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _update(self, update_func):
+        """排他制御下でmanifest.jsonを読み込み，update_func(manifest)で更新して書き込む"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.manifest_file):
+                with open(self.manifest_file, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            else:
+                manifest = {"version": MANIFEST_VERSION, "files": {}}
+            update_func(manifest)
+            _write_json_atomic(self.manifest_file, manifest)
+
+    def check_or_reset_config(self, config: dict, resume: bool):
+        """resume=False -> 新規実行として以前の進捗を破棄する.
+        resume=True -> 以前の進捗を引き継ぐ. 出力内容に影響する引数(config)が前回と異なる場合は出力が混在するためValueError
+        """
+        def _check_or_reset(manifest):
+            if resume and len(manifest["files"]) > 0:
+                if manifest.get("version") != MANIFEST_VERSION:
+                    raise ValueError(f"--resume: the progress was recorded in another format (version {manifest.get('version')}, expected {MANIFEST_VERSION}). run without --resume")
+                if manifest.get("config") != config:
+                    raise ValueError(f"--resume: arguments differ from the previous run: previous={manifest.get('config')}, current={config}")
+                return
+            manifest.clear()
+            manifest.update({"version": MANIFEST_VERSION, "config": config, "files": {}})
+            shutil.rmtree(self.units_dir, ignore_errors=True)
+            if os.path.exists(self.done_log_file):
+                os.remove(self.done_log_file)
+        self._update(_check_or_reset)
+
+    def start_files(self, file_entries: dict):
+        """処理するfileをまとめて記録する (計画時に1回). 入力fileが変更されたfileは以前の進捗を破棄する
+        Args:
+            file_entries: {jsonl_filename: (input_signature, chunks)}. chunks: [[start, end], ...] or None
+        """
+        def _start(manifest):
+            for jsonl_filename, (input_signature, chunks) in file_entries.items():
+                entry = manifest["files"].get(jsonl_filename)
+                if entry is None or entry["input"] != input_signature:
+                    manifest["files"][jsonl_filename] = {"input": input_signature, "chunks": chunks}
+                    shutil.rmtree(self._get_file_units_dir(jsonl_filename), ignore_errors=True)
+        self._update(_start)
+        self._file_inputs.update({jsonl_filename: input_signature for jsonl_filename, (input_signature, _) in file_entries.items()})
+
+    def update_unit(self, jsonl_filename: str, unit_key: str, progress: dict):
+        """work unitの進捗(処理済み行数, 出力byte数, 統計情報)を記録する. work unitのfileのみを書き換える (他のworkerとのlockは不要)"""
+        file_units_dir = self._get_file_units_dir(jsonl_filename)
+        os.makedirs(file_units_dir, exist_ok=True)
+        _write_json_atomic(os.path.join(file_units_dir, f"{unit_key}.json"), progress)
+
+    def mark_file_done(self, jsonl_filename: str):
+        """fileの完了を追記する. 完了したfileのwork unitの進捗は不要のため削除する"""
+        input_signature = self._file_inputs.get(jsonl_filename)
+        if input_signature is None:
+            input_signature = self.load()["files"][jsonl_filename]["input"]
+        record = {"filename": jsonl_filename, "input": input_signature}
+        with open(self.done_log_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.rmtree(self._get_file_units_dir(jsonl_filename), ignore_errors=True)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+# 複数nodeで共有filesystem上のwork directoryを介して作業単位(task)を分担する (coordinatorなし)
+# - plan.json: 全nodeで共通の作業単位の一覧. 最初に起動したnodeが作成し，以降のnodeは同じplanを読み込む
+# - leases/<task_id>.lease.<gen>: taskの処理権(lease). 世代(gen)ごとに O_CREAT|O_EXCL で作成し，作成できたnodeのみが処理する
+#       保持しているnodeは定期的にmtimeを更新(renew)する. mtimeが lease_timeout 秒間変化しないleaseは期限切れとみなし，
+#       他のnodeが次の世代のleaseを作成して処理し直す (停止したnodeのtaskの回収)
+#       保持しているleaseのrenewはbackground thread(start_renewal)で行うため，長時間の処理(連結など)の間も期限切れとならない
+# - done/<task_id>.json: taskの完了記録. link()で作成するため最初に完了した1つのみが記録される
+# NOTE: 期限切れの判定は各nodeがmtimeの変化を自身の時計で観測して行うため，node間の時計のずれに影響されない
+#       lock(flock)は用いず，原子的なfile作成(O_EXCL, link)とrenameのみを用いる (NFSなどでも動作する)
+
+import os
+import json
+import time
+import socket
+import threading
+
+LEASE_TIMEOUT = 300     # 秒. renewされないleaseを期限切れとみなすまでの時間
+POLL_INTERVAL = 10      # 秒. 取得できるtaskがない場合に待つ間隔の上限
+MIN_POLL_INTERVAL = 0.5 # 秒. 取得できるtaskがない場合に待つ間隔の初期値 (状況が変わらない間は倍にしてPOLL_INTERVALまで延ばす)
+PLAN_FILENAME = "plan.json"
+
+
+def get_default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Lease(object):
+    def __init__(self, task_id: str, gen: int, path: str) -> None:
+        self.task_id = task_id
+        self.gen = gen
+        self.path = path
+
+
+class SharedWorkQueue(object):
+    def __init__(self, work_dir: str, node_id=None, lease_timeout=LEASE_TIMEOUT) -> None:
+        """
+        Args:
+            work_dir: 全nodeで共有するdirectory
+            node_id: leaseの保持者の識別子 (log, debug用). None -> hostname-pid
+            lease_timeout: mtimeがこの秒数変化しないleaseは期限切れとみなす. renewはこれより短い間隔で行うこと
+        """
+        self.work_dir = work_dir
+        self.node_id = node_id if node_id is not None else get_default_node_id()
+        self.lease_timeout = lease_timeout
+        self.lease_dir = os.path.join(work_dir, "leases")
+        self.done_dir = os.path.join(work_dir, "done")
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self._observed = {}     # {lease path: (mtime_ns, mtimeを最初に観測した時刻(monotonic))}
+        self._held = {}         # {lease path: Lease} このnodeが保持しているlease
+        self._held_lock = threading.Lock()
+        self._stop_renewal = threading.Event()
+        self._renewal_thread = None
+
+    def _create_exclusive(self, path: str, content: dict) -> bool:
+        """pathが存在しない場合のみcontentを書き込んだfileを作成する. 一時fileに書き込んでからlink()するため，作成されたfileは常に完全な内容を持つ"""
+        tmp_path = f"{path}.{self.node_id}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(content, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    # plan
+    # -------------------------------------------------------------------------------------
+    def load_or_create_plan(self, create_plan) -> dict:
+        """plan.jsonを読み込む. 存在しない場合はcreate_plan()で作成する (同時に作成した場合は最初に作成されたplanを用いる)"""
+        plan_file = os.path.join(self.work_dir, PLAN_FILENAME)
+        if not os.path.exists(plan_file):
+            self._create_exclusive(plan_file, create_plan())
+        with open(plan_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    # lease
+    # -------------------------------------------------------------------------------------
+    def scan(self) -> tuple:
+        """work directoryの現在の状態
+        Returns:
+            `tuple`: ({task_id: 最新の世代のLease}, set(完了したtask_id))
+        """
+        leases = {}
+        for filename in os.listdir(self.lease_dir):
+            task_id, sep, gen = filename.rpartition(".lease.")
+            if sep == "" or not gen.isdigit():
+                continue    # 作成途中の一時fileなど
+            if task_id not in leases or leases[task_id].gen < int(gen):
+                leases[task_id] = Lease(task_id, int(gen), os.path.join(self.lease_dir, filename))
+        done = {filename[:-len(".json")] for filename in os.listdir(self.done_dir) if filename.endswith(".json")}
+        return leases, done
+
+    def _is_expired(self, lease: Lease) -> bool:
+        """mtimeがlease_timeout秒間変化していないか (この時点で初めて観測したmtimeの場合はFalse)"""
+        try:
+            mtime_ns = os.stat(lease.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        now = time.monotonic()
+        observed = self._observed.get(lease.path)
+        if observed is None or observed[0] != mtime_ns:
+            self._observed[lease.path] = (mtime_ns, now)
+            return False
+        return now - observed[1] >= self.lease_timeout
+
+    def get_expiry_wait(self, leases: list):
+        """leases(scan()で得た未完了のtaskの最新のlease)のうち，他のnodeが保持しているleaseが最も早く期限切れとなり得るまでの秒数
+        mtimeを観測した時刻から求めるため，その後にrenewされていた場合は期限切れとならない (次の観測から数え直す)
+        Returns:
+            `float`: 0以上. 観測したleaseがない場合はNone
+        """
+        now = time.monotonic()
+        waits = []
+        for lease in leases:
+            observed = self._observed.get(lease.path)
+            if observed is not None and lease.path not in self._held:
+                waits.append(observed[1] + self.lease_timeout - now)
+        return max(min(waits), 0.0) if len(waits) > 0 else None
+
+    def try_claim(self, task_id: str, current: Lease = None):
+        """taskのleaseの取得を試みる
+        Args:
+            current: scan()で得た現在の最新のlease. None -> leaseが存在しないtask
+        Returns:
+            `Lease`: 取得したlease. 他のnodeが保持している(期限切れでない), または取得で競合した場合はNone
+        """
+        if current is not None and (current.path in self._held or not self._is_expired(current)):
+            return None
+        gen = 0 if current is None else current.gen + 1
+        path = os.path.join(self.lease_dir, f"{task_id}.lease.{gen}")
+        if not self._create_exclusive(path, {"node_id": self.node_id, "gen": gen, "claimed_at": time.time()}):
+            return None
+        lease = Lease(task_id, gen, path)
+        with self._held_lock:
+            self._held[path] = lease
+        if current is not None:
+            print(f"[{self.node_id}] reclaimed expired lease: {task_id} (gen {current.gen} -> {gen})")
+        return lease
+
+    def renew(self, lease: Lease):
+        """leaseのmtimeを更新し，他のnodeに処理中であることを示す"""
+        try:
+            os.utime(lease.path)
+        except FileNotFoundError:
+            pass
+
+    def is_current(self, lease: Lease) -> bool:
+        """leaseが最新の世代か (期限切れとみなされ，他のnodeが次の世代を取得していないか)"""
+        return not os.path.exists(os.path.join(self.lease_dir, f"{lease.task_id}.lease.{lease.gen + 1}"))
+
+    def release(self, lease: Lease):
+        """leaseのrenewを止める (lease fileは次の世代の作成と区別するため削除しない)"""
+        with self._held_lock:
+            self._held.pop(lease.path, None)
+
+    def _renew_held(self):
+        while not self._stop_renewal.wait(self.lease_timeout / 4):
+            with self._held_lock:
+                leases = list(self._held.values())
+            for lease in leases:
+                self.renew(lease)
+
+    def start_renewal(self):
+        """保持しているleaseをlease_timeout/4秒ごとにrenewするbackground threadを開始する"""
+        if self._renewal_thread is None:
+            self._renewal_thread = threading.Thread(target=self._renew_held, daemon=True)
+            self._renewal_thread.start()
+
+    def stop_renewal(self):
+        if self._renewal_thread is not None:
+            self._stop_renewal.set()
+            self._renewal_thread.join()
+            self._renewal_thread = None
+            self._stop_renewal.clear()
+
+    # done
+    # -------------------------------------------------------------------------------------
+    def mark_done(self, lease: Lease, result: dict) -> bool:
+        """taskの完了を記録する
+        Returns:
+            bool: False -> 他のnode(期限切れとみなされた以前の世代を含む)が先に完了を記録していた
+        """
+        return self._create_exclusive(os.path.join(self.done_dir, f"{lease.task_id}.json"),
+                                      {"node_id": self.node_id, "gen": lease.gen, "result": result})
+
+    def load_done(self, task_id: str) -> dict:
+        """mark_doneで記録した内容 {"node_id", "gen", "result"}"""
+        with open(os.path.join(self.done_dir, f"{task_id}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+
+### test
+def test_lease_expiry(work_dir: str):
+    """期限切れでないleaseは取得できず，renewされないleaseは期限切れ後に次の世代として取得できること. 完了記録は1つのみ"""
+    node_a = SharedWorkQueue(work_dir, node_id="a", lease_timeout=0.5)
+    node_b = SharedWorkQueue(work_dir, node_id="b", lease_timeout=0.5)
+    lease_a = node_a.try_claim("task")
+    assert lease_a is not None and lease_a.gen == 0
+    current = node_b.scan()[0]["task"]
+    assert node_b.try_claim("task", current) is None
+    node_a.start_renewal()
+    for _ in range(3):  # renewしている間は取得できない
+        time.sleep(0.3)
+        assert node_b.try_claim("task", node_b.scan()[0]["task"]) is None
+    node_a.stop_renewal()   # renewが止まる (node aの停止)
+    assert node_b.try_claim("task", node_b.scan()[0]["task"]) is None   # 停止後のmtimeを観測してから期限切れとなる
+    time.sleep(0.6)
+    lease_b = node_b.try_claim("task", node_b.scan()[0]["task"])
+    assert lease_b is not None and lease_b.gen == 1
+    assert not node_a.is_current(lease_a) and node_b.is_current(lease_b)
+    assert node_b.mark_done(lease_b, {"x": 1}) and not node_a.mark_done(lease_a, {"x": 2})
+    assert node_a.load_done("task")["gen"] == 1 and node_a.scan()[1] == {"task"}
+    print("OK")
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_lease_expiry(tmp_dir)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# 処理段階(stage)ごとの1文書あたりの処理時間の記録
+# 処理時間は対数間隔のbucketのhistogramとして保持する. bucketごとの文書数の和でmergeできるため，
+# chunkごと(worker process)に記録した結果を親processで合算してもpercentileを求められる
+# batch単位でのみ計測できる処理段階(読み込み, 書き込み, 分類器など)はbatch平均を各文書の値として記録し，
+# percentileは文書ごとの分布ではなくbatch平均の分布となる (batch_averaged)
+
+import time
+
+SUB_BUCKET_BITS = 3     # 2倍の範囲ごとに 2**3=8 個のbucket (bucketの代表値の相対誤差は最大約6%)
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def _bucket_index(elapsed_ns: int) -> int:
+    """処理時間(ns) -> bucket番号. SUB_BUCKETS未満は値そのもの, それ以上は 2**e ごとにSUB_BUCKETS分割"""
+    if elapsed_ns < SUB_BUCKETS:
+        return max(elapsed_ns, 0)
+    e = elapsed_ns.bit_length() - 1 - SUB_BUCKET_BITS
+    return ((e + 1) << SUB_BUCKET_BITS) + (elapsed_ns >> e) - SUB_BUCKETS
+
+def _bucket_value(index: int) -> float:
+    """bucket番号 -> bucketの代表値(ns). bucketの範囲の中央"""
+    if index < SUB_BUCKETS:
+        return float(index)
+    e = (index >> SUB_BUCKET_BITS) - 1
+    lower = ((index & (SUB_BUCKETS - 1)) + SUB_BUCKETS) << e
+    return lower + (1 << e) / 2
+
+
+class StageProfiler(object):
+    def __init__(self) -> None:
+        """
+        stages: {stage名: {"doc_num": 文書数, "total_ns": 処理時間の合計, "buckets": {bucket番号: 文書数}, "batch_averaged": bool}}
+            doc_num はその処理段階に到達した文書数
+            batch_averaged: add_batch()で記録した(batch平均の)処理段階
+        """
+        self.stages = {}
+
+    def _get_stage(self, stage: str) -> dict:
+        stage_info = self.stages.get(stage)
+        if stage_info is None:
+            stage_info = {"doc_num": 0, "total_ns": 0, "buckets": {}, "batch_averaged": False}
+            self.stages[stage] = stage_info
+        return stage_info
+
+    def add(self, stage: str, elapsed_ns: int, doc_num=1):
+        """1文書あたりの処理時間を記録する
+        Args:
+            doc_num: 複数文書をまとめて処理した場合の文書数. elapsed_nsはbatch全体の処理時間を文書数で割った値とする
+        """
+        stage_info = self._get_stage(stage)
+        stage_info["doc_num"] += doc_num
+        stage_info["total_ns"] += elapsed_ns * doc_num
+        buckets = stage_info["buckets"]
+        index = _bucket_index(elapsed_ns)
+        buckets[index] = buckets.get(index, 0) + doc_num
+
+    def add_batch(self, stage: str, elapsed_ns: int, doc_num: int):
+        """batch全体の処理時間を各文書に均等に割り当てて記録する. stageはbatch平均(batch_averaged)とする"""
+        if doc_num > 0:
+            self._get_stage(stage)["batch_averaged"] = True
+            self.add(stage, elapsed_ns // doc_num, doc_num)
+
+    def measure(self, stage: str, doc_num=None):
+        """with文のblockの処理時間を記録する
+        Args:
+            doc_num: None -> 1文書の処理時間. 指定した場合はbatchとしてdoc_numで割って各文書に割り当てる (add_batch)
+        """
+        return _StageTimer(self, stage, doc_num)
+
+    def merge(self, other):
+        """otherの記録を合算する"""
+        for stage, other_info in other.stages.items():
+            stage_info = self._get_stage(stage)
+            stage_info["doc_num"] += other_info["doc_num"]
+            stage_info["total_ns"] += other_info["total_ns"]
+            stage_info["batch_averaged"] = stage_info["batch_averaged"] or other_info["batch_averaged"]
+            buckets = stage_info["buckets"]
+            for index, count in other_info["buckets"].items():
+                buckets[index] = buckets.get(index, 0) + count
+        return self
+
+    def reset(self):
+        self.stages = {}
+
+    def percentile(self, stage: str, q: float) -> float:
+        """処理時間のpercentile(ns). bucketの代表値で返す
+        Args:
+            q: 0-100
+        """
+        stage_info = self.stages[stage]
+        threshold = stage_info["doc_num"] * q / 100
+        cumulative = 0
+        for index in sorted(stage_info["buckets"].keys()):
+            cumulative += stage_info["buckets"][index]
+            if cumulative >= threshold:
+                return _bucket_value(index)
+        return 0.0
+
+    def get_human_readable_values(self) -> dict:
+        """stat_ファイルへの出力用
+        Returns:
+            `dict`: {stage名: {"doc_num", "total_time", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "batch_averaged"}}
+                batch_averaged=True の処理段階のpercentileはbatch平均の分布 (文書ごとの処理時間の分布ではない)
+        """
+        values = {}
+        for stage, stage_info in self.stages.items():
+            doc_num = stage_info["doc_num"]
+            values[stage] = {
+                "doc_num": doc_num,
+                "total_time": stage_info["total_ns"] / 10**9,
+                "mean_ms": (stage_info["total_ns"] / doc_num / 10**6) if doc_num > 0 else 0.0,
+                "p50_ms": self.percentile(stage, 50) / 10**6,
+                "p95_ms": self.percentile(stage, 95) / 10**6,
+                "p99_ms": self.percentile(stage, 99) / 10**6,
+                "batch_averaged": stage_info["batch_averaged"],
+            }
+        return values
+
+    def to_dict(self) -> dict:
+        """json保存可能なdict (from_dictで復元). jsonのkeyは文字列のためbucket番号は文字列にする"""
+        return {stage: {"doc_num": info["doc_num"], "total_ns": info["total_ns"],
+                        "buckets": {str(index): count for index, count in info["buckets"].items()}, "batch_averaged": info["batch_averaged"]}
+                for stage, info in self.stages.items()}
+
+    @classmethod
+    def from_dict(cls, stages_dict: dict):
+        profiler = cls()
+        for stage, info in stages_dict.items():
+            profiler.stages[stage] = {"doc_num": info["doc_num"], "total_ns": info["total_ns"],
+                                      "buckets": {int(index): count for index, count in info["buckets"].items()},
+                                      "batch_averaged": info.get("batch_averaged", False)}
+        return profiler
+
+
+class _StageTimer(object):
+    def __init__(self, profiler: StageProfiler, stage: str, doc_num: int) -> None:
+        self.profiler = profiler
+        self.stage = stage
+        self.doc_num = doc_num
+
+    def __enter__(self):
+        self.s_time_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_ns = time.perf_counter_ns() - self.s_time_ns
+        if self.doc_num is None:
+            self.profiler.add(self.stage, elapsed_ns)
+        else:
+            self.profiler.add_batch(self.stage, elapsed_ns, self.doc_num)
+
+
+### test
+def test_percentile(n=100000, seed=0):
+    """bucketから求めたpercentileが，処理時間のリストから求めたpercentileと相対誤差約6%以内で一致するか. mergeしても同じか"""
+    import random
+    random.seed(seed)
+    values = [int(random.lognormvariate(14, 1.5)) for _ in range(n)]    # 約1ms中心
+    profiler, profiler_a, profiler_b = StageProfiler(), StageProfiler(), StageProfiler()
+    for i, value in enumerate(values):
+        profiler.add("stage", value)
+        (profiler_a if i % 2 == 0 else profiler_b).add("stage", value)
+    merged = StageProfiler.from_dict(profiler_a.to_dict()).merge(profiler_b)
+    assert merged.to_dict() == profiler.to_dict()
+
+    sorted_values = sorted(values)
+    for q in [50, 95, 99]:
+        expected = sorted_values[int(n * q / 100) - 1]
+        assert abs(profiler.percentile("stage", q) - expected) <= expected * 0.07, (q, profiler.percentile("stage", q), expected)
+    for value in range(1, 10**6, 7):    # bucketの代表値の相対誤差
+        assert abs(_bucket_value(_bucket_index(value)) - value) <= value * 0.07
+    print(profiler.get_human_readable_values())
+
+
+if __name__ == "__main__":
+    test_percentile()
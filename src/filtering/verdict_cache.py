@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# 判定結果(verdict)のcache
+# 重複文書, 定型文(boilerplate)のみの文書など同じtextが繰り返し現れる場合に，MeCab解析と分類器を省略する
+# keyはtextのhash(xxh3 128bit)と，判定に用いるmodel, 辞書の内容から求めたversion stamp. model, 辞書が変わると別のkeyとなる
+# - memory: worker processごとのLRU (OrderedDict, 最大entry数)
+# - disk (optional): sqlite3. 複数のworker process, 複数回の実行で共有する
+#   WAL modeは共有memory(-shm)とfile lockを用いるため，同じnodeのprocess間でのみ共有できる. NFSなどnetwork filesystem上に置かないこと
+
+import os
+import sqlite3
+from collections import OrderedDict
+
+VERDICT_CACHE_VERSION = 1       # 判定処理(rule, 分類器の適用方法)を変更した場合に更新し，以前の判定結果を無効にする
+SQLITE_BUSY_TIMEOUT = 60        # 他processの書き込み中に待つ時間(秒)
+SQLITE_MAX_PARAMS = 500         # 1回のSELECTで IN (...) に指定するkey数
+HASH_READ_SIZE = 1024 * 1024    # version stampの計算でfileを読み込む単位 (1MB)
+
+
+def _import_xxhash():
+    """xxhashはoptional dependency (pip install xxhash). verdict cacheの利用時のみimportする"""
+    try:
+        import xxhash
+    except ImportError as e:
+        raise ImportError("verdict cache requires the `xxhash` package: pip install xxhash") from e
+    return xxhash
+
+def get_text_hash(text: str) -> bytes:
+    """textのhash (xxh3 128bit, 16byte). surrogateを含むtextもencodeできるようにsurrogatepassとする"""
+    return _import_xxhash().xxh3_128_digest(text.encode('utf-8', 'surrogatepass'))
+
+def get_version_stamp(paths: list) -> str:
+    """判定に用いるfile(model, 辞書)の内容から求めたversion stamp
+    fileの絶対pathは含めないため，同じ内容であれば別の場所に配置しても同じstampとなる
+    Args:
+        paths: list(str) file, またはdirectory (compact modelなど. 配下の全fileを対象とする)
+    Returns:
+        `str`: 16桁の16進数文字列
+    """
+    xxhash = _import_xxhash()
+    h = xxhash.xxh3_64()
+    h.update(f"verdict_cache_v{VERDICT_CACHE_VERSION}".encode())
+    for path in paths:
+        if os.path.isdir(path):
+            file_paths = sorted(os.path.join(root, filename) for root, _, filenames in os.walk(path) for filename in filenames)
+        else:
+            file_paths = [path]
+        for file_path in file_paths:
+            h.update(os.path.relpath(file_path, os.path.dirname(path)).encode('utf-8', 'surrogatepass') + b'\0')
+            with open(file_path, 'rb') as fp:
+                while True:
+                    chunk = fp.read(HASH_READ_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+class VerdictCache(object):
+    def __init__(self, version_stamp: str, max_entries: int, db_path: str = None) -> None:
+        """
+        Args:
+            version_stamp: get_version_stamp() の結果. disk cacheは同じstampの判定結果のみを参照する
+            max_entries: memory(LRU)に保持する判定結果の最大数. 1件あたり約150byte
+            db_path: disk cache(sqlite3)のpath. None -> memoryのみ
+        """
+        self.version_stamp = version_stamp
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._memory = OrderedDict()    # {text_hash: is_rejected}. 末尾が最近参照したentry
+        self._db = None                 # sqlite3 connectionは利用するprocessで作成する (fork前の接続は共有できない)
+
+    def _get_db(self) -> sqlite3.Connection:
+        if self._db is None:
+            db_dir = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(db_dir, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT)
+            # WAL: 読み込みは書き込み中のprocessを待たない
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                             "stamp TEXT NOT NULL, text_hash BLOB NOT NULL, is_rejected INTEGER NOT NULL, "
+                             "PRIMARY KEY (stamp, text_hash)) WITHOUT ROWID")
+            self._db.commit()
+        return self._db
+
+    def _remember(self, text_hash: bytes, is_rejected: bool):
+        self._memory[text_hash] = is_rejected
+        self._memory.move_to_end(text_hash)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, text_hashes: list) -> tuple:
+        """
+        Args:
+            text_hashes: list(bytes) get_text_hash() の結果. 重複を含んでもよい
+        Returns:
+            `tuple`: ({text_hash: is_rejected} cacheに存在した判定結果, set(text_hash) うちdisk cacheに存在したkey)
+        """
+        found = {}
+        for text_hash in text_hashes:
+            if text_hash in found:
+                continue
+            is_rejected = self._memory.get(text_hash)
+            if is_rejected is not None:
+                self._memory.move_to_end(text_hash)
+                found[text_hash] = is_rejected
+
+        disk_hashes = set()
+        if self.db_path is not None:
+            missing = list(dict.fromkeys(h for h in text_hashes if h not in found))
+            db = self._get_db()
+            for start in range(0, len(missing), SQLITE_MAX_PARAMS):
+                chunk = missing[start:start + SQLITE_MAX_PARAMS]
+                rows = db.execute(f"SELECT text_hash, is_rejected FROM verdicts WHERE stamp = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                                  [self.version_stamp] + chunk).fetchall()
+                for text_hash, is_rejected in rows:
+                    text_hash = bytes(text_hash)
+                    found[text_hash] = bool(is_rejected)
+                    self._remember(text_hash, bool(is_rejected))
+                    disk_hashes.add(text_hash)
+        return found, disk_hashes
+
+    def put_many(self, verdicts: dict):
+        """
+        Args:
+            verdicts: {text_hash: is_rejected} 新しく判定した結果. disk cacheは既存の判定結果を上書きしない
+        """
+        for text_hash, is_rejected in verdicts.items():
+            self._remember(text_hash, is_rejected)
+        if self.db_path is not None and len(verdicts) > 0:
+            db = self._get_db()
+            with db:    # 1回のtransactionで書き込む
+                db.executemany("INSERT OR IGNORE INTO verdicts (stamp, text_hash, is_rejected) VALUES (?, ?, ?)",
+                               [(self.version_stamp, text_hash, int(is_rejected)) for text_hash, is_rejected in verdicts.items()])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+
+### test
+def test_verdict_cache(db_path: str, n=2000):
+    """memoryのLRU上限, disk cacheの共有, version stampによる区別を確認する"""
+    text_hashes = [get_text_hash(f"text {i}") for i in range(n)]
+    verdicts = {h: i % 3 == 0 for i, h in enumerate(text_hashes)}
+
+    cache = VerdictCache("stamp_a", max_entries=n // 2, db_path=db_path)
+    cache.put_many(verdicts)
+    assert len(cache) == n // 2
+    found, disk_hashes = cache.get_many(text_hashes + text_hashes[:10])
+    assert found == verdicts and disk_hashes == set(text_hashes[:n - n // 2]), len(disk_hashes)
+    cache.close()
+
+    other_process_cache = VerdictCache("stamp_a", max_entries=n, db_path=db_path)
+    assert other_process_cache.get_many(text_hashes)[0] == verdicts
+    other_stamp_cache = VerdictCache("stamp_b", max_entries=n, db_path=db_path)
+    assert other_stamp_cache.get_many(text_hashes)[0] == {}
+    memory_cache = VerdictCache("stamp_a", max_entries=n)
+    assert memory_cache.get_many(text_hashes)[0] == {}
+    print("OK")
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_verdict_cache(os.path.join(tmp_dir, "verdict_cache.sqlite"))
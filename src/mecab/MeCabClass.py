@@ -24,6 +24,7 @@ class MeCabClass(object):
                         #   '/app/src/mecab/mecab_userdic/dic/ipa_race_ethnic_generation_202412.dic', # 人種，民族，世系
                           ]
 
+        self.user_dic_paths = user_dic_paths
         self.tagger = MeCab.Tagger('-u ' + ','.join(user_dic_paths)) # 複数指定 -> -u <path2dic1>,<path2dic2>,...
         self.tagger.parse('')
 
@@ -201,6 +202,64 @@ class MeCabClass(object):
         else:
             return False, None, None
 
+    # ======= フルネーム & NgWords 一括判定 ======
+    def scan_fullname_and_NgWords(self, parsedNode, mecabUserDicTag2NgTag:dict, ng_word_db:dict, stop_early=False, surfaces=None) -> tuple:
+        """detect_fullname, detect_NgWords_by_userdic, detect_NgWords_by_wordDB を1回のnode走査で行う
+        node.feature.split(',') は1nodeにつき1回のみ
+        Args:
+            stop_early: True -> fullnameとNgWordsの両方を検出した時点で判定を終了する (判定結果のみが必要な場合)
+            surfaces: listを与えた場合，全形態素の表層形(get_wakati_by_parseNodeと同一)を追加する.
+                      分類器のn-gram特徴量で再度MeCab解析しないために利用. stop_early=Trueでも表層形は最後まで収集する
+        Returns:
+            list: fullnameの文字列リスト (stop_early=Trueの場合は走査を終了するまでに検出したもの)
+            str: NgWordsのユーザ辞書識別用タグ(NG tag). 未検出の場合None
+            str: wordDBにマッチしたNgWordsの単語 (文書中で最初に出現したもの). 未検出の場合None
+            str: NgWordsDB-file名. 未検出の場合None
+        """
+        user_dic_tag_idx = 9    # IPA dictionaryの場合
+        fullnames = []
+        lastname_surface = None     # 連続する姓候補の先頭の表層形
+        ng_type = None
+        ng_word = None
+        node = parsedNode
+        while node:
+            surface = node.surface
+            if surface == "":
+                node = node.next
+                continue
+            if surfaces is not None:
+                surfaces.append(surface)
+            features = node.feature.split(',')  # 品詞,品詞細分類1,品詞細分類2,品詞細分類3,活用形,活用型,原形,読み,発音(,ユーザ辞書tag)
+
+            # 姓の検出 (名詞,固有名詞,地域) or (名詞,固有名詞,人名,姓) -> 姓が見つかった上で，名の検出: (名詞,固有名詞,人名,名)
+            if self._match_properNoun_lastName(features) or self._match_properNoun_place(features):
+                if lastname_surface is None:
+                    lastname_surface = surface
+            elif lastname_surface is not None:
+                if self._match_properNoun_firstName(features):
+                    fullnames.append(lastname_surface + surface)
+                lastname_surface = None
+
+            # NgWords: user_dic
+            if ng_type is None and len(features) >= user_dic_tag_idx+1:
+                ng_type = mecabUserDicTag2NgTag.get(features[user_dic_tag_idx])
+            # NgWords: wordDB
+            if ng_word is None and surface in ng_word_db:
+                ng_word = surface
+
+            if stop_early and len(fullnames) > 0 and (ng_type is not None or ng_word is not None):
+                # 判定に必要な情報はそろったため，以降は表層形の収集のみ
+                node = node.next
+                while surfaces is not None and node:
+                    surface = node.surface
+                    if surface != "":
+                        surfaces.append(surface)
+                    node = node.next
+                break
+            node = node.next
+
+        return fullnames, ng_type, ng_word, (ng_word_db[ng_word] if ng_word is not None else None)
+
 
 ### test
 # fullname test
@@ -225,6 +284,28 @@ def parseNGWords():
     print(mecab.detect_NgWords_by_userdic(parsedNode, mecabUserDicTag2NgTag, debug=True))
 
 
+# fused scan test: 3回のnode走査による判定と一致するか
+def test_scan_fullname_and_NgWords(txts: list, mecabUserDicTag2NgTag: dict, ng_word_db: dict):
+    mecab = MeCabClass()
+    for txt in txts:
+        parsedNode = mecab.get_parsedNode(txt)
+        fullnames = mecab.detect_fullname(parsedNode)
+        is_userdic, ng_type = mecab.detect_NgWords_by_userdic(parsedNode, mecabUserDicTag2NgTag)
+        is_worddb, _, _ = mecab.detect_NgWords_by_wordDB(parsedNode, ng_word_db)
+        expected = len(fullnames) > 0 and (is_userdic or is_worddb)
+
+        for stop_early in [False, True]:
+            scan_fullnames, scan_ng_type, scan_ng_word, _ = mecab.scan_fullname_and_NgWords(parsedNode, mecabUserDicTag2NgTag, ng_word_db, stop_early=stop_early)
+            verdict = len(scan_fullnames) > 0 and (scan_ng_type is not None or scan_ng_word is not None)
+            assert verdict == expected, txt
+            if stop_early is False:
+                assert scan_fullnames == fullnames and scan_ng_type == ng_type and (scan_ng_word is not None) == is_worddb, txt
+            surfaces = []
+            mecab.scan_fullname_and_NgWords(parsedNode, mecabUserDicTag2NgTag, ng_word_db, stop_early=stop_early, surfaces=surfaces)
+            assert surfaces == mecab.get_wakati_by_parseNode(txt), txt
+    print(f'OK: {len(txts)} texts')
+
+
 if __name__ == "__main__":
     # parseTest()
     parseNGWords()
\ No newline at end of file